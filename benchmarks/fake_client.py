@@ -0,0 +1,61 @@
+# benchmarks/fake_client.py
+
+import json
+import random
+import threading
+import time
+from typing import Iterator, List, Tuple
+
+from parsers.dom_chunker import serialize_dom_elements, dom_format_note
+
+class FakeLLMClient:
+    # ClaudeClient / GPT4Client と同じインターフェースを持ち、API を呼ばずに決まったアクションを返す。
+    # 応答時間は latency_seconds に、seed で決まる 0〜jitter_seconds の揺らぎを加えたもの
+    def __init__(self, latency_seconds: float = 0.0, jitter_seconds: float = 0.0, seed: int = 0):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.calls = 0
+        self.prompt_chars = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _build_prompt(self, user_instruction: str, dom_elements: list = None) -> str:
+        # 実際のクライアントと同じく DOM をシリアライズしてプロンプトに埋め込む
+        dom_elements_str = serialize_dom_elements(dom_elements) if dom_elements else 'なし'
+        return f"ユーザー指示: {user_instruction}\nDOM要素:{dom_format_note(dom_elements)}\n{dom_elements_str}"
+
+    def generate_actions(self, user_instruction: str, dom_elements: list = None) -> Tuple[List[dict], str]:
+        prompt = self._build_prompt(user_instruction, dom_elements)
+        self._wait(prompt)
+        actions = self.plan(dom_elements or [])
+        return actions, json.dumps(actions, ensure_ascii=False)
+
+    def generate_next_action(self, user_instruction: str, conversation: List[dict]) -> Tuple[List[dict], str]:
+        self._wait("".join(message["content"] for message in conversation))
+        actions = [{"action": "DONE", "selector": None, "value": "ベンチマーク", "dom_id": None}]
+        return actions, json.dumps(actions, ensure_ascii=False)
+
+    def stream_actions(self, user_instruction: str, dom_elements: list = None) -> Iterator[dict]:
+        actions, _ = self.generate_actions(user_instruction, dom_elements)
+        yield from actions
+
+    @staticmethod
+    def plan(dom_elements: list) -> List[dict]:
+        # id を持つ最初の入力欄に入力し、最初のボタンを押す
+        actions = []
+        for tag, action, value in (("input", "TYPE", "benchmark"), ("button", "CLICK", None)):
+            for element in dom_elements:
+                element_id = element.get("attributes", {}).get("id")
+                if element["tag"] == tag and element_id:
+                    actions.append({"action": action, "selector": f"#{element_id}", "value": value,
+                                    "dom_id": element["dom_id"]})
+                    break
+        return actions
+
+    def _wait(self, prompt: str):
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += len(prompt)
+            delay = self.latency_seconds + self._random.uniform(0, self.jitter_seconds)
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,105 @@
+# benchmarks/fixture_server.py
+
+import html
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlparse
+
+# 1つの入れ子の中に並べる葉の要素の数
+LEAVES_PER_SECTION = 8
+
+WORDS = ["注文", "検索", "ログイン", "設定", "詳細", "送信", "次へ", "戻る", "account", "search", "submit", "profile"]
+
+def generate_page(elements: int, depth: int = 5, seed: int = 0) -> str:
+    # depth 段の div の入れ子の中にボタン・入力欄・リンク・テキストを並べ、全体でおよそ elements 個の要素にする
+    rng = random.Random(seed)
+    parts = [f"<!DOCTYPE html><html><head><title>fixture {elements}/{depth}</title></head><body>"]
+    count = 0
+    section = 0
+    while count < elements:
+        for level in range(depth):
+            parts.append(f'<div class="level-{level} section-{section % 50}">')
+        count += depth
+        for _ in range(LEAVES_PER_SECTION):
+            if count >= elements:
+                break
+            parts.append(_leaf(rng, count))
+            count += 1
+        parts.append("</div>" * depth)
+        section += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+def _leaf(rng: random.Random, n: int) -> str:
+    word = html.escape(rng.choice(WORDS))
+    kind = rng.randrange(6)
+    if kind == 0:
+        return f'<button id="button-{n}" class="btn" type="button">{word} {n}</button>'
+    if kind == 1:
+        return f'<label for="field-{n}">{word}</label><input id="field-{n}" name="field-{n}" type="text" placeholder="{word}">'
+    if kind == 2:
+        return f'<a href="/page?item={n}" class="link">{word} {n}</a>'
+    if kind == 3:
+        return f'<select name="choice-{n}"><option value="1">{word}</option></select>'
+    if kind == 4:
+        return f'<span class="note">{word} {n}</span>'
+    return f'<p>{word}についての説明 {n}。{word}を選択してください。</p>'
+
+class FixtureServer:
+    # /page?elements=N&depth=D で生成した HTML を返すローカルの HTTP サーバー
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, seed: int = 0):
+        self.seed = seed
+        self._pages: Dict[Tuple[int, int], bytes] = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                try:
+                    elements = int(query.get("elements", ["100"])[0])
+                    depth = int(query.get("depth", ["5"])[0])
+                except ValueError:
+                    self.send_error(400)
+                    return
+                body = server.page(elements, depth)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    def page(self, elements: int, depth: int) -> bytes:
+        with self._lock:
+            body = self._pages.get((elements, depth))
+            if body is None:
+                body = generate_page(elements, depth, self.seed).encode("utf-8")
+                self._pages[(elements, depth)] = body
+            return body
+
+    def url(self, elements: int, depth: int) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/page?elements={elements}&depth={depth}"
+
+    def start(self) -> "FixtureServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fixture-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "FixtureServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
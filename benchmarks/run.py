@@ -0,0 +1,111 @@
+# benchmarks/run.py
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from typing import List, Optional
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="WebAgentAI オフラインベンチマーク")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="ページあたりの要素数 (カンマ区切り)")
+    parser.add_argument("--depths", default="3,12", help="div の入れ子の深さ (カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=3, help="各シナリオの繰り返し回数")
+    parser.add_argument("--latency", type=float, default=0.5, help="擬似 LLM の応答時間 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="擬似 LLM の応答時間の揺らぎの上限 (秒)")
+    parser.add_argument("--seed", type=int, default=0, help="HTML と応答時間の揺らぎの乱数シード")
+    parser.add_argument("--browser", action="store_true", help="ヘッドレスブラウザでのアクション実行も計測する")
+    parser.add_argument("--output", default="benchmark_results.json", help="結果を書き出す JSON")
+    parser.add_argument("--compare", metavar="PREVIOUS_JSON", help="以前の結果と中央値を比較する")
+    return parser.parse_args(argv)
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous: dict, current: dict, threshold: float = 0.1) -> List[str]:
+    # シナリオ・要素数・深さが同じ結果の中央値を比べ、threshold 以上遅くなったものに印を付ける
+    def key(result):
+        return result["scenario"], result["elements"], result["depth"]
+
+    before = {key(result): result for result in previous.get("results", [])}
+    lines = []
+    for result in current["results"]:
+        old = before.get(key(result))
+        if old is None or not old["median_seconds"]:
+            continue
+        ratio = result["median_seconds"] / old["median_seconds"]
+        mark = " 遅くなりました" if ratio > 1 + threshold else ""
+        lines.append(
+            f"{result['scenario']:<16} {result['elements']:>7}要素 深さ{result['depth']:>3}: "
+            f"{old['median_seconds']:.4f}秒 -> {result['median_seconds']:.4f}秒 (x{ratio:.2f}){mark}"
+        )
+    return lines
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    # 擬似クライアントは API を呼ばないが、設定の検証を通すため未設定ならダミーのキーを入れる。
+    # キャッシュと実行レポートは計測に影響するため無効にする
+    os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+    os.environ["LLM_CACHE_ENABLED"] = "false"
+    os.environ["PAGE_CACHE_ENABLED"] = "false"
+    os.environ["TRACE_REPORT_DIR"] = ""
+
+    from config import Config
+    from clients.openai_client import OpenAIClient
+    from controllers.playwright_controller import PlaywrightController
+    from .fake_client import FakeLLMClient
+    from .fixture_server import FixtureServer
+    from .scenarios import BenchmarkSuite
+
+    config = Config(env_path=os.devnull)
+    openai_client = OpenAIClient(config)
+    fake_client = FakeLLMClient(args.latency, args.jitter, args.seed)
+    for model in ("Claude", "GPT4o"):
+        openai_client.register_client(model, fake_client)
+
+    controller = PlaywrightController.from_config(config, headless=True) if args.browser else None
+    results = []
+    try:
+        with FixtureServer(seed=args.seed) as server:
+            suite = BenchmarkSuite(openai_client, fake_client, server, repeat=args.repeat, controller=controller)
+            for elements in _int_list(args.sizes):
+                for depth in _int_list(args.depths):
+                    for result in suite.run_page(elements, depth):
+                        results.append(result)
+                        print(f"{result['scenario']:<16} {elements:>7}要素 深さ{depth:>3}: "
+                              f"中央値 {result['median_seconds']:.4f}秒 (最小 {result['min_seconds']:.4f}秒)")
+    finally:
+        if controller is not None:
+            controller.shutdown()
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        for line in compare(previous, report):
+            print(line)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
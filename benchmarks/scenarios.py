@@ -0,0 +1,83 @@
+# benchmarks/scenarios.py
+
+import statistics
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from clients.openai_client import OpenAIClient
+from controllers.playwright_controller import PlaywrightController
+from parsers.dom_chunker import chunk_dom_elements
+from parsers.dom_parser import DOMParser
+from runner.pipeline import InstructionPipeline
+from .fake_client import FakeLLMClient
+from .fixture_server import FixtureServer
+
+TASK = "入力欄に benchmark と入力してボタンを押す"
+
+def measure(fn: Callable[[], Any], repeat: int) -> Tuple[dict, Any]:
+    runs = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        runs.append(time.perf_counter() - started)
+    stats = {
+        "runs": [round(seconds, 6) for seconds in runs],
+        "median_seconds": round(statistics.median(runs), 6),
+        "min_seconds": round(min(runs), 6),
+        "max_seconds": round(max(runs), 6),
+    }
+    return stats, result
+
+class BenchmarkSuite:
+    # 擬似 LLM クライアントとローカルの HTML で、各処理と全体の所要時間を計測する
+    def __init__(self, openai_client: OpenAIClient, fake_client: FakeLLMClient, server: FixtureServer,
+                 model: str = "Claude", repeat: int = 3, controller: Optional[PlaywrightController] = None):
+        self.openai_client = openai_client
+        self.fake_client = fake_client
+        self.server = server
+        self.model = model
+        self.repeat = repeat
+        self.controller = controller
+        self.pipeline = InstructionPipeline(openai_client)
+        # プロンプトの組み立ては実際のクライアントで計測する (生成は通信しない)。送信だけを擬似クライアントで行う
+        try:
+            self.prompt_client = openai_client._create_client(model)
+        except ImportError as e:
+            print(f"{model} のクライアントを読み込めないため、prompt の計測を省略します: {e}")
+            self.prompt_client = None
+
+    def run_page(self, elements: int, depth: int) -> List[dict]:
+        url = self.server.url(elements, depth)
+        instruction = f"{url} {TASK}"
+        results = []
+
+        def record(scenario: str, fn: Callable[[], Any], **details) -> Any:
+            stats, result = measure(fn, self.repeat)
+            results.append({"scenario": scenario, "elements": elements, "depth": depth, **stats, **details})
+            return result
+
+        html = record("fetch", lambda: self.pipeline.fetch_html(url))
+        dom_elements = record("parse", lambda: DOMParser.parse(html), html_bytes=len(html.encode("utf-8")))
+        record("parse_pruned", lambda: DOMParser.parse(html, prune=True))
+        budget = self.openai_client.chunk_token_budget(self.model)
+        encoding = self.openai_client.dom_encoding
+        chunks = record("chunk", lambda: chunk_dom_elements(dom_elements, budget, encoding),
+                        dom_elements=len(dom_elements), encoding=encoding)
+        if self.prompt_client is not None:
+            record("prompt", lambda: [self.prompt_client._build_prompt(TASK, chunk) for chunk in chunks],
+                   chunks=len(chunks), tokens=sum(chunk.tokens for chunk in chunks))
+        calls = self.fake_client.calls
+        record("dispatch", lambda: self.openai_client.generate_actions_for_chunks(self.model, TASK, chunks),
+               latency_seconds=self.fake_client.latency_seconds)
+        results[-1]["llm_calls"] = (self.fake_client.calls - calls) // self.repeat
+        actions = record("end_to_end_plan", lambda: self.pipeline.process_instruction(self.model, instruction, True)[0])
+
+        if self.controller is not None and actions:
+            record("perform_actions", lambda: self.controller.perform_actions(actions, url), actions=len(actions))
+            record("end_to_end", lambda: self._plan_and_perform(instruction, url))
+        return results
+
+    def _plan_and_perform(self, instruction: str, url: str):
+        actions, _ = self.pipeline.process_instruction(self.model, instruction, True)
+        return self.controller.perform_actions(actions, url)
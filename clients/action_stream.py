@@ -0,0 +1,128 @@
+# clients/action_stream.py
+
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
+
+from utils.logger import preview
+from utils.tracing import bind
+
+class IncrementalActionParser:
+    # LLM の出力を少しずつ受け取り、トップレベルの JSON 配列の要素 (dict) が閉じた時点で返す
+    def __init__(self):
+        self._text = ""
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = None
+
+    def feed(self, text: str) -> List[dict]:
+        actions = []
+        position = len(self._text)
+        self._text += text
+        while position < len(self._text):
+            char = self._text[position]
+            if not self._started:
+                # コードブロックなど配列の前に付いた文字は読み飛ばす
+                if char == "[":
+                    self._started = True
+                    self._depth = 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 1 and char == "{":
+                    self._object_start = position
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 1 and char == "}" and self._object_start is not None:
+                    action = self._decode(self._text[self._object_start:position + 1])
+                    if action is not None:
+                        actions.append(action)
+                    self._object_start = None
+                elif self._depth == 0:
+                    self._started = False
+            position += 1
+        # 閉じていない要素の先頭より前は不要なので捨てる
+        if self._object_start is None:
+            self._text = ""
+        else:
+            self._text = self._text[self._object_start:]
+            self._object_start = 0
+        return actions
+
+    @staticmethod
+    def _decode(fragment: str):
+        try:
+            action = json.loads(fragment)
+        except json.JSONDecodeError:
+            logging.error(f"ストリーム中のアクションのJSON解析に失敗しました: {preview(fragment)}")
+            return None
+        return action if isinstance(action, dict) else None
+
+def parse_action_stream(chunks: Iterable[str], transcript: Optional[List[str]] = None) -> Iterator[dict]:
+    # transcript を渡すと、受け取った出力をそのまま追加していく (応答の全文をログに残すため)
+    parser = IncrementalActionParser()
+    for chunk in chunks:
+        if chunk:
+            if transcript is not None:
+                transcript.append(chunk)
+            yield from parser.feed(chunk)
+
+class ActionStream:
+    # 別スレッドで LLM のストリームを読み進め、生成済みのアクションから順に取り出せるようにする。
+    # cancel がセットされたら、次のアクションの生成を待たずに取り出しを終える
+    _DONE = object()
+    _POLL_SECONDS = 0.2
+
+    def __init__(self, actions: Iterable[dict], cancel: Optional[threading.Event] = None):
+        self.cancel = cancel
+        self.actions = []
+        self.error = None
+        self.first_action_seconds = None
+        self._started = time.monotonic()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=bind(self._produce), args=(actions,), name="llm-stream", daemon=True)
+        self._thread.start()
+
+    def __iter__(self) -> Iterator[dict]:
+        while True:
+            if self.cancel is None:
+                item = self._queue.get()
+            else:
+                try:
+                    item = self._queue.get(timeout=self._POLL_SECONDS)
+                except queue.Empty:
+                    if self.cancel.is_set():
+                        return
+                    continue
+            if item is self._DONE:
+                return
+            yield item
+
+    def _produce(self, actions: Iterable[dict]):
+        try:
+            for action in actions:
+                if self.first_action_seconds is None:
+                    self.first_action_seconds = time.monotonic() - self._started
+                    logging.info(f"最初のアクションが生成されるまで: {self.first_action_seconds:.2f}秒")
+                self.actions.append(action)
+                self._queue.put(action)
+        except Exception as e:
+            self.error = e
+            logging.error(f"アクションのストリーミング中にエラーが発生しました: {e}")
+        finally:
+            logging.info(f"ストリーミングで生成されたアクションの総数: {len(self.actions)} "
+                         f"(所要時間: {time.monotonic() - self._started:.2f}秒)")
+            self._queue.put(self._DONE)
@@ -4,43 +4,79 @@ import json
 import re
 import logging
 import anthropic
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
+
+from parsers.dom_chunker import serialize_dom_elements, dom_format_note
+from utils.logger import log_payload, preview
+from utils.token_estimator import estimate_tokens
+from utils.tracing import span
+from .action_stream import parse_action_stream
+from .exceptions import RateLimitError, get_retry_after
+
+CLAUDE_MODEL = "claude-3-5-sonnet-20241022"
+SYSTEM_PROMPT = "あなたはウェブ操作を生成するアシスタントです。"
 
 class ClaudeClient:
     def __init__(self, api_key: str):
         self.client = anthropic.Anthropic(api_key=api_key)
 
-    def generate_actions(self, user_instruction: str, dom_elements: list = None) -> Tuple[List[dict], str]:
-        dom_elements_str = json.dumps(dom_elements, ensure_ascii=False) if dom_elements else 'なし'
+    def _build_prompt(self, user_instruction: str, dom_elements: list = None) -> str:
+        dom_elements_str = serialize_dom_elements(dom_elements) if dom_elements else 'なし'
 
         prompt = f"""
         以下のユーザー指示に基づいて、必要なウェブ操作を純粋なJSON形式で出力してください。コードブロック（```json と ```）は使用しないでください。
         ユーザー指示: {user_instruction}
-        DOM要素:
+        DOM要素:{dom_format_note(dom_elements)}
         {dom_elements_str}
         出力形式は直接オブジェクトのリストで、各オブジェクトは辞書型であることを保証してください。
         [
-            {{"action": "ACTION_TYPE", "selector": "CSS_SELECTOR", "value": "VALUE"}}
+            {{"action": "ACTION_TYPE", "selector": "CSS_SELECTOR", "value": "VALUE", "dom_id": DOM_ID}}
         ]
         ACTION_TYPEは "CLICK", "TYPE", "NAVIGATE", "SCREENSHOT" のいずれかとします。
+        DOM_IDには操作対象の要素の dom_id を数値で指定し、対象の要素がない場合は null とします。
+        """
+        return prompt
+
+    def _build_step_prompt(self, user_instruction: str, observation: str) -> str:
+        prompt = f"""
+        あなたはブラウザを1操作ずつ操作しています。ユーザー指示を達成するために次に実行する操作を1つだけ、純粋なJSON形式で出力してください。コードブロック（```json と ```）は使用しないでください。
+        ユーザー指示: {user_instruction}
+        2回目以降は、これまでの操作の履歴と、前回から追加・変更・削除された要素、変わっていない要素の要約を送ります。
+        出力形式:
+        [
+            {{"action": "ACTION_TYPE", "selector": "CSS_SELECTOR", "value": "VALUE", "dom_id": DOM_ID}}
+        ]
+        ACTION_TYPEは "CLICK", "TYPE", "NAVIGATE", "SCREENSHOT", "DONE" のいずれかとします。ユーザー指示を達成した場合は "DONE" を出力してください。
+        DOM_IDには操作対象の要素の dom_id を数値で指定し、対象の要素がない場合は null とします。
+        現在のページの状態:
+        {observation}
         """
+        return prompt
 
+    def generate_actions(self, user_instruction: str, dom_elements: list = None) -> Tuple[List[dict], str]:
+        return self._send([{"role": "user", "content": self._build_prompt(user_instruction, dom_elements)}])
+
+    def generate_next_action(self, user_instruction: str, conversation: List[dict]) -> Tuple[List[dict], str]:
+        # 過去の観察結果は送り直さず、現在の観察結果 (履歴・差分・状態の要約) だけに指示を付けて送る
+        observation = conversation[-1]["content"]
+        return self._send([{"role": "user", "content": self._build_step_prompt(user_instruction, observation)}])
+
+    def _send(self, messages: List[dict]) -> Tuple[List[dict], str]:
         try:
             logging.debug("Claude APIへのリクエストを送信します。")
-            response = self.client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=5000,
-                temperature=0.0,
-                system="あなたはウェブ操作を生成するアシスタントです。",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
-
-            logging.debug(f"Claude APIからのレスポンス: {response}")
+            prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+            with span("api", provider="Claude", prompt_tokens=prompt_tokens) as attributes:
+                response = self.client.messages.create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=5000,
+                    temperature=0.0,
+                    system=SYSTEM_PROMPT,
+                    messages=messages
+                )
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    attributes["input_tokens"] = usage.input_tokens
+                    attributes["output_tokens"] = usage.output_tokens
 
             if isinstance(response.content, list) and len(response.content) > 0:
                 gpt_response = response.content[0].text.strip()
@@ -48,7 +84,7 @@ class ClaudeClient:
                 logging.error("予期しないレスポンス形式です。")
                 return [], ""
 
-            logging.debug(f"Claude APIからの生のレスポンステキスト: {gpt_response}")
+            log_payload("Claude", messages, gpt_response)
 
             if not gpt_response:
                 logging.error("Claude APIからの応答が空です。")
@@ -58,7 +94,7 @@ class ClaudeClient:
             gpt_response = re.sub(r'```$', '', gpt_response).strip()
 
             actions = json.loads(gpt_response)
-            logging.debug(f"生成されたアクション: {actions}")
+            logging.debug("生成されたアクション: %s", actions)
 
             if isinstance(actions, list) and all(isinstance(action, dict) for action in actions):
                 return actions, gpt_response
@@ -67,8 +103,42 @@ class ClaudeClient:
                 return [], ""
 
         except json.JSONDecodeError:
-            logging.error(f"JSON解析エラー: {gpt_response}")
+            logging.error(f"JSON解析エラー: {preview(gpt_response)}")
             return [], ""
+        except anthropic.RateLimitError as e:
+            logging.warning(f"Claude API のレート制限に達しました: {e}")
+            raise RateLimitError(str(e), retry_after=get_retry_after(e)) from e
         except Exception as e:
             logging.error(f"Claude API エラー: {e}")
             return [], ""
+
+    def stream_actions(self, user_instruction: str, dom_elements: list = None) -> Iterator[dict]:
+        # 応答の完了を待たず、配列の要素が閉じたものから順にアクションを返す
+        prompt = self._build_prompt(user_instruction, dom_elements)
+        transcript = []
+        try:
+            logging.debug("Claude APIへのストリーミングリクエストを送信します。")
+            with self.client.messages.stream(
+                model=CLAUDE_MODEL,
+                max_tokens=5000,
+                temperature=0.0,
+                system=SYSTEM_PROMPT,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ]
+            ) as stream:
+                for action in parse_action_stream(stream.text_stream, transcript):
+                    logging.debug("ストリームから生成されたアクション: %s", action)
+                    yield action
+        except anthropic.RateLimitError as e:
+            logging.warning(f"Claude API のレート制限に達しました: {e}")
+            raise RateLimitError(str(e), retry_after=get_retry_after(e)) from e
+        except Exception as e:
+            logging.error(f"Claude API エラー: {e}")
+            raise
+        finally:
+            # 途中で閉じられた場合も、それまでに受け取った応答を残す
+            log_payload("Claude", prompt, "".join(transcript))
@@ -0,0 +1,24 @@
+# clients/exceptions.py
+
+from typing import Optional
+
+
+class RateLimitError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status_code == 429 or "RateLimit" in type(error).__name__
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
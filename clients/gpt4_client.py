@@ -5,7 +5,14 @@ import re
 import logging
 from langchain.chat_models import AzureChatOpenAI
 from langchain.schema import HumanMessage
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
+
+from parsers.dom_chunker import serialize_dom_elements, dom_format_note
+from utils.logger import log_payload, preview
+from utils.token_estimator import estimate_tokens
+from utils.tracing import span
+from .action_stream import parse_action_stream
+from .exceptions import RateLimitError, is_rate_limit_error, get_retry_after
 
 class GPT4Client:
     def __init__(self, api_key: str, api_base: str, api_version: str, deployment_name: str):
@@ -16,38 +23,100 @@ class GPT4Client:
             openai_api_version=api_version,
         )
 
-    def generate_actions(self, user_instruction: str, dom_elements: list = None) -> Tuple[List[dict], str]:
-        dom_elements_str = json.dumps(dom_elements, ensure_ascii=False) if dom_elements else 'なし'
+    def _build_prompt(self, user_instruction: str, dom_elements: list = None) -> str:
+        dom_elements_str = serialize_dom_elements(dom_elements) if dom_elements else 'なし'
         
         prompt = f"""
         以下のユーザー指示に基づいて、必要なウェブ操作を純粋なJSON形式で出力してください。コードブロック（```json と ```）は使用しないでください。
         ユーザー指示: {user_instruction}
-        DOM要素:
+        DOM要素:{dom_format_note(dom_elements)}
         {dom_elements_str}
         出力形式:
         [
-            {{"action": "ACTION_TYPE", "selector": "CSS_SELECTOR", "value": "VALUE"}}
+            {{"action": "ACTION_TYPE", "selector": "CSS_SELECTOR", "value": "VALUE", "dom_id": DOM_ID}}
         ]
         ACTION_TYPEは "CLICK", "TYPE", "NAVIGATE", "SCREENSHOT" のいずれかとします。
+        DOM_IDには操作対象の要素の dom_id を数値で指定し、対象の要素がない場合は null とします。
         """
+        return prompt
 
-        messages = [HumanMessage(content=prompt)]
+    def _build_step_prompt(self, user_instruction: str, observation: str) -> str:
+        prompt = f"""
+        あなたはブラウザを1操作ずつ操作しています。ユーザー指示を達成するために次に実行する操作を1つだけ、純粋なJSON形式で出力してください。コードブロック（```json と ```）は使用しないでください。
+        ユーザー指示: {user_instruction}
+        2回目以降は、これまでの操作の履歴と、前回から追加・変更・削除された要素、変わっていない要素の要約を送ります。
+        出力形式:
+        [
+            {{"action": "ACTION_TYPE", "selector": "CSS_SELECTOR", "value": "VALUE", "dom_id": DOM_ID}}
+        ]
+        ACTION_TYPEは "CLICK", "TYPE", "NAVIGATE", "SCREENSHOT", "DONE" のいずれかとします。ユーザー指示を達成した場合は "DONE" を出力してください。
+        DOM_IDには操作対象の要素の dom_id を数値で指定し、対象の要素がない場合は null とします。
+        現在のページの状態:
+        {observation}
+        """
+        return prompt
+
+    def generate_actions(self, user_instruction: str, dom_elements: list = None) -> Tuple[List[dict], str]:
+        return self._send([{"role": "user", "content": self._build_prompt(user_instruction, dom_elements)}])
+
+    def generate_next_action(self, user_instruction: str, conversation: List[dict]) -> Tuple[List[dict], str]:
+        # 過去の観察結果は送り直さず、現在の観察結果 (履歴・差分・状態の要約) だけに指示を付けて送る
+        observation = conversation[-1]["content"]
+        return self._send([{"role": "user", "content": self._build_step_prompt(user_instruction, observation)}])
+
+    def _send(self, messages: List[dict]) -> Tuple[List[dict], str]:
+        chat_messages = [HumanMessage(content=message["content"]) for message in messages]
         try:
             logging.debug("Azure OpenAIへのリクエストを送信します。")
-            response = self.llm(messages)
+            prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+            with span("api", provider="GPT4o", prompt_tokens=prompt_tokens) as attributes:
+                response = self.llm(chat_messages)
+                # langchain のバージョンによっては使用量が返らない
+                usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+                if usage:
+                    attributes["input_tokens"] = usage.get("prompt_tokens")
+                    attributes["output_tokens"] = usage.get("completion_tokens")
             gpt_response = response.content.strip()
-            logging.debug(f"Azure OpenAIからの生のレスポンステキスト: {gpt_response}")
+            log_payload("Azure OpenAI", messages, gpt_response)
             if not gpt_response:
                 logging.error("Azure OpenAIからの応答が空です。")
                 return [], ""
             gpt_response = re.sub(r'^```json\s*', '', gpt_response)
             gpt_response = re.sub(r'```$', '', gpt_response).strip()
             actions = json.loads(gpt_response)
-            logging.debug(f"生成されたアクション: {actions}")
+            logging.debug("生成されたアクション: %s", actions)
             return actions, gpt_response
         except json.JSONDecodeError:
-            logging.error(f"JSON解析エラー: {gpt_response}")
+            logging.error(f"JSON解析エラー: {preview(gpt_response)}")
             return [], ""
         except Exception as e:
+            if is_rate_limit_error(e):
+                logging.warning(f"Azure OpenAI のレート制限に達しました: {e}")
+                raise RateLimitError(str(e), retry_after=get_retry_after(e)) from e
             logging.error(f"Azure OpenAI エラー: {e}")
             return [], ""
+
+    def stream_actions(self, user_instruction: str, dom_elements: list = None) -> Iterator[dict]:
+        # 応答の完了を待たず、配列の要素が閉じたものから順にアクションを返す
+        if not hasattr(self.llm, "stream"):
+            # ストリーミングに対応していない langchain では一括生成の結果を順に返す
+            actions, _ = self.generate_actions(user_instruction, dom_elements)
+            yield from actions
+            return
+        prompt = self._build_prompt(user_instruction, dom_elements)
+        messages = [HumanMessage(content=prompt)]
+        transcript = []
+        try:
+            logging.debug("Azure OpenAIへのストリーミングリクエストを送信します。")
+            for action in parse_action_stream((chunk.content for chunk in self.llm.stream(messages)), transcript):
+                logging.debug("ストリームから生成されたアクション: %s", action)
+                yield action
+        except Exception as e:
+            if is_rate_limit_error(e):
+                logging.warning(f"Azure OpenAI のレート制限に達しました: {e}")
+                raise RateLimitError(str(e), retry_after=get_retry_after(e)) from e
+            logging.error(f"Azure OpenAI エラー: {e}")
+            raise
+        finally:
+            # 途中で閉じられた場合も、それまでに受け取った応答を残す
+            log_payload("Azure OpenAI", prompt, "".join(transcript))
@@ -0,0 +1,40 @@
+# clients/latency_tracker.py
+
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+class LatencyTracker:
+    # プロバイダごとに直近の応答時間を保持し、パーセンタイルを求める
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def count(self, provider: str) -> int:
+        with self._lock:
+            return len(self._samples.get(provider, ()))
+
+    def percentile(self, provider: str, percent: float) -> Optional[float]:
+        # 最近傍順位法で求める。記録がなければ None
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if not samples:
+            return None
+        rank = max(1, -(-len(samples) * percent // 100))
+        return samples[min(int(rank), len(samples)) - 1]
+
+    def summary(self) -> str:
+        with self._lock:
+            providers = sorted(self._samples)
+        parts = []
+        for provider in providers:
+            parts.append(
+                f"{provider}: p50 {self.percentile(provider, 50):.1f}秒 / p95 {self.percentile(provider, 95):.1f}秒 / "
+                f"p99 {self.percentile(provider, 99):.1f}秒 ({self.count(provider)}件)"
+            )
+        return ", ".join(parts) if parts else "記録なし"
@@ -1,27 +1,394 @@
 # clients/openai_client.py
 
+import copy
+import json
 import logging
-from typing import List, Tuple
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from typing import Callable, Iterator, List, Optional, Tuple
 
-from .claude_client import ClaudeClient
-from .gpt4_client import GPT4Client
+from .exceptions import RateLimitError
+from .latency_tracker import LatencyTracker
+from .response_cache import ResponseCache, cache_key
 from config import Config
+from utils.tracing import bind, record_span, span
+
+# 主プロバイダと副プロバイダに送信し、先に有効な計画を返したほうを採用するモード
+RACE_MODEL = "Race"
+
+# 中止されていないかを確認する間隔 (秒)
+CANCEL_POLL_SECONDS = 0.2
+
+# 有効な計画とみなす操作
+PLAN_ACTIONS = ("NAVIGATE", "CLICK", "TYPE", "SCREENSHOT", "DONE")
+
+def is_valid_plan(actions) -> bool:
+    return bool(actions) and all(isinstance(action, dict) and action.get("action") in PLAN_ACTIONS for action in actions)
 
 class OpenAIClient:
     def __init__(self, config: Config):
-        self.claude_client = ClaudeClient(api_key=config.ANTHROPIC_API_KEY)
-        self.gpt4_client = GPT4Client(
-            api_key=config.AZURE_OPENAI_API_KEY,
-            api_base=config.AZURE_OPENAI_API_BASE,
-            api_version=config.AZURE_OPENAI_API_VERSION,
-            deployment_name=config.DEPLOYMENT_GPT_NAME
-        )
+        # SDK の import とクライアント生成は、そのモデルを初めて使うときまで遅延させる
+        self.config = config
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.max_concurrency = config.LLM_MAX_CONCURRENCY
+        self.max_retries = config.LLM_MAX_RETRIES
+        self.retry_base_delay = config.LLM_RETRY_BASE_DELAY
+        self.dom_encoding = config.DOM_ENCODING
+        self.chunk_token_budgets = {
+            "Claude": config.CHUNK_TOKEN_BUDGET_CLAUDE,
+            "GPT4o": config.CHUNK_TOKEN_BUDGET_GPT4O,
+        }
+        self.cache = None
+        if config.LLM_CACHE_ENABLED:
+            self.cache = ResponseCache(
+                path=config.LLM_CACHE_PATH,
+                max_memory_entries=config.LLM_CACHE_MEMORY_ENTRIES,
+                max_disk_entries=config.LLM_CACHE_DISK_ENTRIES,
+                ttl_seconds=config.LLM_CACHE_TTL_SECONDS
+            )
+        self.latency = LatencyTracker()
+        self.race_primary = config.RACE_PRIMARY
+        self.race_hedge_delay = config.RACE_HEDGE_DELAY_SECONDS
+        self.race_hedge_auto = config.RACE_HEDGE_AUTO
+        self.race_hedge_percentile = config.RACE_HEDGE_PERCENTILE
+        self.race_min_samples = config.RACE_MIN_SAMPLES
 
-    def generate_actions(self, model: str, user_instruction: str, dom_elements: list = None) -> Tuple[List[dict], str]:
-        if model == "Claude":
-            return self.claude_client.generate_actions(user_instruction, dom_elements)
-        elif model == "GPT4o":
-            return self.gpt4_client.generate_actions(user_instruction, dom_elements)
+    def generate_actions(self, model: str, user_instruction: str, dom_elements: list = None,
+                         cancel: Optional[threading.Event] = None) -> Tuple[List[dict], str]:
+        if model == RACE_MODEL:
+            return self._race(lambda provider, event: self.generate_actions(provider, user_instruction, dom_elements, event),
+                              cancel)
+        if self.cache is None:
+            return self._with_retry(model, "generate_actions", user_instruction, dom_elements, cancel=cancel)
+        key = cache_key(model, user_instruction, dom_elements)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logging.info(f"LLM応答キャッシュを使用します。{self.cache.stats()}")
+            record_span("llm_cache_hit", 0.0, model=model, actions=len(cached[0]))
+            return copy.deepcopy(cached)
+        actions, raw_response = self._with_retry(model, "generate_actions", user_instruction, dom_elements, cancel=cancel)
+        if actions:
+            self.cache.put(key, model, (copy.deepcopy(actions), raw_response))
+        return actions, raw_response
+
+    def generate_next_action(self, model: str, user_instruction: str, conversation: List[dict],
+                             cancel: Optional[threading.Event] = None) -> Tuple[Optional[dict], str]:
+        # 観察結果のやり取りから次の1操作だけを生成する。ページの状態に依存するためキャッシュしない
+        if model == RACE_MODEL:
+            actions, raw_response = self._race(
+                lambda provider, event: self._with_retry(provider, "generate_next_action", user_instruction, conversation,
+                                                         cancel=event),
+                cancel
+            )
         else:
-            logging.error(f"サポートされていないモデル: {model}")
+            actions, raw_response = self._with_retry(model, "generate_next_action", user_instruction, conversation,
+                                                     cancel=cancel)
+        if not actions:
+            return None, raw_response
+        if len(actions) > 1:
+            logging.warning(f"次の操作として{len(actions)}件が返されたため、先頭の1件のみを使用します。")
+        return actions[0], raw_response
+
+    def _with_retry(self, model: str, method: str, *args, cancel: Optional[threading.Event] = None) -> Tuple[List[dict], str]:
+        # cancel がセットされたら (レースで相手が先に応答したら、または利用者が中止したら) それ以上リトライしない
+        with span("llm", model=model, method=method, retries=0) as attributes:
+            for attempt in range(self.max_retries + 1):
+                if cancel is not None and cancel.is_set():
+                    attributes["cancelled"] = True
+                    return [], ""
+                attributes["retries"] = attempt
+                try:
+                    started = time.perf_counter()
+                    result = self._dispatch_cancellable(model, method, *args, cancel=cancel)
+                    if result is None:
+                        attributes["cancelled"] = True
+                        logging.info(f"中止が要求されたため、{model} の応答を待たずに戻ります。")
+                        return [], ""
+                    actions, raw_response = result
+                    if raw_response:
+                        self.latency.record(model, time.perf_counter() - started)
+                    attributes["actions"] = len(actions)
+                    return actions, raw_response
+                except RateLimitError as e:
+                    if attempt >= self.max_retries:
+                        logging.error(f"レート制限のためリトライ上限 ({self.max_retries}回) に達しました: {e}")
+                        return [], ""
+                    delay = self._backoff_delay(attempt, e.retry_after)
+                    logging.warning(f"レート制限のため {delay:.1f} 秒後にリトライします。({attempt + 1}/{self.max_retries})")
+                    if cancel is not None:
+                        cancel.wait(delay)
+                    else:
+                        time.sleep(delay)
             return [], ""
+
+    def _race(self, request: Callable[[str, threading.Event], Tuple[List[dict], str]],
+              stop: Optional[threading.Event] = None) -> Tuple[List[dict], str]:
+        # 主プロバイダに送信し、一定時間内に有効な計画が返らなければ副プロバイダにも送信する。
+        # 先に有効な計画を返したほうを採用し、もう一方はリトライを止めて結果を捨てる。
+        # stop がセットされたら両方のリトライを止め、応答を待たずに戻る
+        primary = self.race_primary
+        secondary = self.race_secondary(primary)
+        if secondary is None:
+            logging.warning(f"副プロバイダを利用できないため、{primary} のみに送信します。")
+            return request(primary, stop or threading.Event())
+        delay = self.hedge_delay(primary)
+        cancel = threading.Event()
+        started = time.monotonic()
+        fallback = ([], "")
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm-race")
+        with span("race", primary=primary, hedge_delay_seconds=round(delay, 3), hedged=False) as attributes:
+            try:
+                pending = {executor.submit(bind(request), primary, cancel): primary}
+                hedged = False
+                while pending or not hedged:
+                    timeout = None if hedged else max(0.0, started + delay - time.monotonic())
+                    if stop is not None:
+                        timeout = CANCEL_POLL_SECONDS if timeout is None else min(timeout, CANCEL_POLL_SECONDS)
+                    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                    if stop is not None and stop.is_set():
+                        cancel.set()
+                        attributes["cancelled"] = True
+                        logging.info("中止が要求されたため、レースの応答を待たずに戻ります。")
+                        return [], ""
+                    for future in done:
+                        provider = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logging.error(f"{provider} へのリクエストに失敗しました: {e}")
+                            continue
+                        if is_valid_plan(result[0]):
+                            cancel.set()
+                            attributes["winner"] = provider
+                            logging.info(
+                                f"{provider} の計画を採用しました。({time.monotonic() - started:.1f}秒, "
+                                f"{'副プロバイダにも送信済み' if hedged else '副プロバイダへの送信なし'}) {self.latency.summary()}"
+                            )
+                            return result
+                        logging.warning(f"{provider} の応答は有効な計画ではありませんでした。")
+                        if result[1] and not fallback[1]:
+                            fallback = result
+                    if not hedged and (not pending or time.monotonic() >= started + delay):
+                        hedged = attributes["hedged"] = True
+                        logging.info(f"{primary} から {time.monotonic() - started:.1f} 秒以内に有効な計画が得られなかったため、{secondary} にも送信します。")
+                        pending[executor.submit(bind(request), secondary, cancel)] = secondary
+                logging.error("いずれのプロバイダからも有効な計画が得られませんでした。")
+                return fallback
+            finally:
+                # 負けた側の送信中のリクエストは中断できないため、完了を待たずに戻る
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def race_secondary(self, primary: str) -> Optional[str]:
+        for provider in self.chunk_token_budgets:
+            if provider != primary and not self.config.missing_provider_vars(provider):
+                return provider
+        return None
+
+    def hedge_delay(self, primary: str) -> float:
+        # 記録が十分にあれば、主プロバイダの応答時間のパーセンタイルを待ってから副プロバイダに送信する。
+        # 記録がない場合は設定値を使う
+        if self.race_hedge_auto and self.latency.count(primary) >= self.race_min_samples:
+            delay = self.latency.percentile(primary, self.race_hedge_percentile)
+            if delay is not None:
+                return delay
+        return self.race_hedge_delay
+
+    def stream_actions(self, model: str, user_instruction: str, dom_elements: list = None,
+                       cancel: Optional[threading.Event] = None) -> Iterator[dict]:
+        # 生成されたアクションから順に返す。キャッシュには最後まで生成できた応答だけを保存する。
+        # cancel がセットされたら次のアクションを受け取った時点でストリームを閉じ、それ以上生成させない
+        if model == RACE_MODEL:
+            # 応答全体を検証してから採用するため、レースではストリーミングしない
+            yield from self.generate_actions(model, user_instruction, dom_elements, cancel)[0]
+            return
+        key = None
+        if self.cache is not None:
+            key = cache_key(model, user_instruction, dom_elements)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logging.info(f"LLM応答キャッシュを使用します。{self.cache.stats()}")
+                yield from copy.deepcopy(cached[0])
+                return
+        client = self._resolve_client(model)
+        if client is None:
+            return
+        actions = []
+        started = time.perf_counter()
+        with span("llm_stream", model=model, retries=0) as attributes:
+            for attempt in range(self.max_retries + 1):
+                if cancel is not None and cancel.is_set():
+                    attributes["cancelled"] = True
+                    return
+                attributes["retries"] = attempt
+                attempt_started = time.perf_counter()
+                stream = client.stream_actions(user_instruction, dom_elements)
+                try:
+                    for action in stream:
+                        if cancel is not None and cancel.is_set():
+                            attributes["cancelled"] = True
+                            logging.info(f"中止が要求されたため、ストリーミングを打ち切ります。({len(actions)}件生成済み)")
+                            return
+                        if not actions:
+                            attributes["first_action_seconds"] = round(time.perf_counter() - started, 4)
+                        actions.append(copy.deepcopy(action))
+                        attributes["actions"] = len(actions)
+                        yield action
+                    if actions:
+                        # レースの待ち時間の算出に使うため、一括生成と同じく応答全体を受け取るまでの時間を記録する
+                        self.latency.record(model, time.perf_counter() - attempt_started)
+                    break
+                except RateLimitError as e:
+                    # 既に返したアクションは実行されている可能性があるため、途中からはリトライしない
+                    if actions:
+                        logging.error(f"ストリーミングの途中でレート制限に達したため、生成を中断します: {e}")
+                        return
+                    if attempt >= self.max_retries:
+                        logging.error(f"レート制限のためリトライ上限 ({self.max_retries}回) に達しました: {e}")
+                        return
+                    delay = self._backoff_delay(attempt, e.retry_after)
+                    logging.warning(f"レート制限のため {delay:.1f} 秒後にリトライします。({attempt + 1}/{self.max_retries})")
+                    if cancel is not None:
+                        cancel.wait(delay)
+                    else:
+                        time.sleep(delay)
+                except Exception as e:
+                    logging.error(f"アクションのストリーミングに失敗しました: {e}")
+                    return
+                finally:
+                    # 途中で打ち切った場合もストリームを閉じて接続を切る
+                    stream.close()
+        if actions and key is not None:
+            self.cache.put(key, model, (actions, json.dumps(actions, ensure_ascii=False)))
+
+    def generate_actions_for_chunks(self, model: str, user_instruction: str, chunks: List[list],
+                                    is_complete: Optional[Callable[[int, List[dict]], bool]] = None,
+                                    cancel: Optional[threading.Event] = None
+                                    ) -> List[Optional[Tuple[List[dict], str]]]:
+        # 結果はチャンクの順序で返す。is_complete が完了と判定した時点、または cancel がセットされた時点で
+        # 残りのチャンクは送信せず、その結果は None になる
+        results = [None] * len(chunks)
+        if len(chunks) <= 1 or self.max_concurrency <= 1:
+            for i, chunk in enumerate(chunks):
+                if self._is_cancelled(cancel, results):
+                    break
+                results[i] = self.generate_actions(model, user_instruction, chunk, cancel)
+                if self._is_complete(is_complete, i, results[i], len(chunks)):
+                    break
+            return results
+
+        max_workers = min(self.max_concurrency, len(chunks))
+        logging.info(f"{len(chunks)}チャンクを最大{max_workers}並列で送信します。")
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-chunk")
+        try:
+            pending = {}
+            next_index = 0
+            while pending or next_index < len(chunks):
+                # 完了判定で打ち切れるよう、同時に送信するのは並列数の分だけにする
+                while next_index < len(chunks) and len(pending) < max_workers:
+                    future = executor.submit(bind(self.generate_actions), model, user_instruction, chunks[next_index], cancel)
+                    pending[future] = next_index
+                    next_index += 1
+                timeout = None if cancel is None else CANCEL_POLL_SECONDS
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if self._is_cancelled(cancel, results):
+                    return results
+                for future in done:
+                    i = pending.pop(future)
+                    results[i] = future.result()
+                    if self._is_complete(is_complete, i, results[i], len(chunks)):
+                        return results
+            return results
+        finally:
+            # 打ち切った場合は送信中のリクエストの完了を待たない
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _is_cancelled(cancel: Optional[threading.Event], results: list) -> bool:
+        if cancel is None or not cancel.is_set():
+            return False
+        received = sum(1 for result in results if result is not None)
+        logging.info(f"中止が要求されたため、残りのチャンクの送信を打ち切ります。({received}/{len(results)}チャンク処理済み)")
+        return True
+
+    @staticmethod
+    def _is_complete(is_complete, index: int, result: Tuple[List[dict], str], total: int) -> bool:
+        if is_complete is None or not result[0] or not is_complete(index, result[0]):
+            return False
+        logging.info(f"チャンク {index + 1} で完結した計画が得られたため、残りのチャンクの送信を打ち切ります。(全{total}チャンク)")
+        return True
+
+    def chunk_token_budget(self, model: str) -> int:
+        # プロンプト本文と出力の分を残した、1チャンクあたりの DOM のトークン予算
+        return self.chunk_token_budgets.get(model, min(self.chunk_token_budgets.values()))
+
+    def get_client(self, model: str):
+        with self._clients_lock:
+            client = self._clients.get(model)
+            if client is None:
+                client = self._create_client(model)
+                self._clients[model] = client
+            return client
+
+    def register_client(self, model: str, client):
+        # SDK を使わないクライアント (ベンチマーク用の擬似クライアントなど) を差し替える
+        with self._clients_lock:
+            self._clients[model] = client
+
+    def _create_client(self, model: str):
+        self.config.validate_provider(model)
+        if model == "Claude":
+            from .claude_client import ClaudeClient
+            return ClaudeClient(api_key=self.config.ANTHROPIC_API_KEY)
+        from .gpt4_client import GPT4Client
+        return GPT4Client(
+            api_key=self.config.AZURE_OPENAI_API_KEY,
+            api_base=self.config.AZURE_OPENAI_API_BASE,
+            api_version=self.config.AZURE_OPENAI_API_VERSION,
+            deployment_name=self.config.DEPLOYMENT_GPT_NAME
+        )
+
+    def _resolve_client(self, model: str):
+        try:
+            return self.get_client(model)
+        except ValueError as e:
+            logging.error(str(e))
+        except ImportError as e:
+            logging.error(f"{model} のクライアントを読み込めませんでした: {e}")
+        return None
+
+    def _dispatch(self, model: str, method: str, *args) -> Tuple[List[dict], str]:
+        client = self._resolve_client(model)
+        if client is None:
+            return [], ""
+        return getattr(client, method)(*args)
+
+    def _dispatch_cancellable(self, model: str, method: str, *args,
+                              cancel: Optional[threading.Event] = None) -> Optional[Tuple[List[dict], str]]:
+        # cancel が渡された場合は別スレッドで送信して中止を確認しながら待ち、中止されたら None を返す。
+        # 送信中のリクエストは中断できないため、その応答は捨てる
+        if cancel is None:
+            return self._dispatch(model, method, *args)
+        future = Future()
+        dispatch = bind(self._dispatch)
+
+        def run():
+            try:
+                future.set_result(dispatch(model, method, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="llm-request", daemon=True).start()
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_SECONDS)
+            except FutureTimeoutError:
+                if cancel.is_set():
+                    return None
+
+    def _backoff_delay(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after:
+            return retry_after
+        return self.retry_base_delay * (2 ** attempt) + random.uniform(0, self.retry_base_delay)
@@ -0,0 +1,142 @@
+# clients/response_cache.py
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from parsers.dom_chunker import serialize_dom_elements
+
+def normalize_task(user_instruction: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", user_instruction).split())
+
+def dom_digest(dom_elements: Optional[list]) -> str:
+    payload = serialize_dom_elements(dom_elements or [])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def cache_key(model: str, user_instruction: str, dom_elements: Optional[list]) -> str:
+    material = json.dumps([model, normalize_task(user_instruction), dom_digest(dom_elements)], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    # メモリ上の LRU と SQLite を組み合わせた LLM 応答キャッシュ
+    def __init__(self, path: Optional[str] = "llm_cache.sqlite3", max_memory_entries: int = 256,
+                 max_disk_entries: int = 5000, ttl_seconds: float = 7 * 24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, model TEXT, value TEXT, created_at REAL, accessed_at REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"LLM応答キャッシュのデータベースを開けませんでした。メモリのみで動作します: {e}")
+                self._db = None
+
+    def get(self, key: str) -> Optional[Tuple[List[dict], str]]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+            value = self._get_from_disk(key, now)
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            return value
+
+    def put(self, key: str, model: str, value: Tuple[List[dict], str]):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, value, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, json.dumps(list(value), ensure_ascii=False), now, now)
+                )
+                self._evict_disk(now)
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"LLM応答キャッシュへの保存に失敗しました: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _remember(self, key: str, created_at: float, value: Tuple[List[dict], str]):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _get_from_disk(self, key: str, now: float) -> Optional[Tuple[List[dict], str]]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"LLM応答キャッシュの読み込みに失敗しました: {e}")
+            return None
+        actions, raw_response = json.loads(row[0])
+        value = (actions, raw_response)
+        self._remember(key, row[1], value)
+        return value
+
+    def _evict_disk(self, now: float):
+        self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_disk_entries,)
+            )
@@ -1,6 +1,12 @@
 import os
 from dotenv import load_dotenv
 
+# モデルごとに必要な環境変数
+PROVIDER_ENV_VARS = {
+    "Claude": ["ANTHROPIC_API_KEY"],
+    "GPT4o": ["AZURE_OPENAI_API_KEY", "AZURE_OPENAI_API_BASE", "AZURE_OPENAI_API_VERSION", "DEPLOYMENT_GPT_NAME"],
+}
+
 class Config:
     def __init__(self, env_path='.env'):
         load_dotenv(env_path)
@@ -10,11 +16,156 @@ class Config:
         self.AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
         self.DEPLOYMENT_GPT_NAME = os.getenv("DEPLOYMENT_GPT_NAME")
 
+        # チャンクの並列送信とレート制限時のリトライ設定
+        self.LLM_MAX_CONCURRENCY = self._get_int("LLM_MAX_CONCURRENCY", 4)
+        self.LLM_MAX_RETRIES = self._get_int("LLM_MAX_RETRIES", 3)
+        self.LLM_RETRY_BASE_DELAY = self._get_float("LLM_RETRY_BASE_DELAY", 1.0)
+
+        # ブラウザの設定 (指定したセッション数または JS ヒープ使用量を超えたらブラウザを再起動する。0 で無効)
+        self.BROWSER_MAX_SESSIONS = self._get_int("BROWSER_MAX_SESSIONS", 50)
+        self.BROWSER_MEMORY_LIMIT_MB = self._get_int("BROWSER_MEMORY_LIMIT_MB", 512)
+        self.BROWSER_HEADLESS = self._get_bool("BROWSER_HEADLESS", False)
+
+        # アクション後の待機方式 (adaptive: DOM の安定やセレクタの表示を検知 / fixed: 従来の固定スリープ)
+        self.WAIT_STRATEGY = os.getenv("WAIT_STRATEGY", "adaptive")
+        self.WAIT_DOM_QUIET_MS = self._get_int("WAIT_DOM_QUIET_MS", 300)
+        self.WAIT_DOM_MAX_MS = self._get_int("WAIT_DOM_MAX_MS", 5000)
+        self.WAIT_MIN_TIMEOUT_MS = self._get_int("WAIT_MIN_TIMEOUT_MS", 5000)
+        self.WAIT_MAX_TIMEOUT_MS = self._get_int("WAIT_MAX_TIMEOUT_MS", 60000)
+
+        # 画像・フォント・広告などのリソース取得を止める (既定は無効)
+        self.BLOCK_RESOURCES = self._get_bool("BLOCK_RESOURCES", False)
+        self.BLOCK_RESOURCE_TYPES = self._get_list("BLOCK_RESOURCE_TYPES")
+        self.BLOCK_HOST_PATTERNS = self._get_list("BLOCK_HOST_PATTERNS")
+
+        # プロンプトに埋め込む DOM の形式 (json / outline)
+        self.DOM_ENCODING = os.getenv("DOM_ENCODING", "json")
+
+        # 1チャンクあたりの DOM のトークン予算 (モデルごと)
+        self.CHUNK_TOKEN_BUDGET_CLAUDE = self._get_int("CHUNK_TOKEN_BUDGET_CLAUDE", 50000)
+        self.CHUNK_TOKEN_BUDGET_GPT4O = self._get_int("CHUNK_TOKEN_BUDGET_GPT4O", 30000)
+
+        # 実行前にセレクタを解析済みの DOM で検証し、一致しないものを修復・修正依頼する
+        self.SELECTOR_VALIDATION = self._get_bool("SELECTOR_VALIDATION", True)
+        self.SELECTOR_CORRECTION = self._get_bool("SELECTOR_CORRECTION", True)
+
+        # 操作対象がすべて含まれる計画を返したチャンクがあれば、残りのチャンクの送信を打ち切る
+        self.CHUNK_EARLY_STOP = self._get_bool("CHUNK_EARLY_STOP", True)
+
+        # レース実行 (主プロバイダに送信し、応答が遅ければ副プロバイダにも送信する) の設定
+        self.RACE_PRIMARY = os.getenv("RACE_PRIMARY", "Claude")
+        self.RACE_HEDGE_DELAY_SECONDS = self._get_float("RACE_HEDGE_DELAY_SECONDS", 3.0)
+        self.RACE_HEDGE_AUTO = self._get_bool("RACE_HEDGE_AUTO", True)
+        self.RACE_HEDGE_PERCENTILE = self._get_float("RACE_HEDGE_PERCENTILE", 95)
+        self.RACE_MIN_SAMPLES = self._get_int("RACE_MIN_SAMPLES", 20)
+
+        # 1操作ずつページを観察しながら実行する場合の最大ステップ数
+        self.AGENT_MAX_STEPS = self._get_int("AGENT_MAX_STEPS", 20)
+
+        # LLM 応答キャッシュの設定
+        self.LLM_CACHE_ENABLED = self._get_bool("LLM_CACHE_ENABLED", True)
+        self.LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+        self.LLM_CACHE_MEMORY_ENTRIES = self._get_int("LLM_CACHE_MEMORY_ENTRIES", 256)
+        self.LLM_CACHE_DISK_ENTRIES = self._get_int("LLM_CACHE_DISK_ENTRIES", 5000)
+        self.LLM_CACHE_TTL_SECONDS = self._get_float("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+
+        # HTML 取得の設定。接続は requests.Session で再利用し、ETag / Last-Modified を返すページは
+        # 条件付きリクエストで再検証する。解析済みの DOM は本文のハッシュで引いて再利用する
+        self.HTTP_POOL_SIZE = self._get_int("HTTP_POOL_SIZE", 10)
+        self.PAGE_CACHE_ENABLED = self._get_bool("PAGE_CACHE_ENABLED", True)
+        self.PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "page_cache.sqlite3")
+        self.PAGE_CACHE_DISK_ENTRIES = self._get_int("PAGE_CACHE_DISK_ENTRIES", 500)
+        self.PAGE_CACHE_MEMORY_ENTRIES = self._get_int("PAGE_CACHE_MEMORY_ENTRIES", 1)
+
+        # ログの設定。プロンプトと応答の全文は PAYLOAD_LOG_FILE を指定した場合だけ別のファイルに書き出す
+        self.LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+        self.LOG_FILE = os.getenv("LOG_FILE", "web_agent.log")
+        self.LOG_MAX_BYTES = self._get_int("LOG_MAX_BYTES", 10 * 1024 * 1024)
+        self.LOG_BACKUP_COUNT = self._get_int("LOG_BACKUP_COUNT", 5)
+        self.PAYLOAD_LOG_FILE = os.getenv("PAYLOAD_LOG_FILE", "")
+        self.PAYLOAD_LOG_SAMPLE_RATE = self._get_float("PAYLOAD_LOG_SAMPLE_RATE", 1.0)
+
+        # 実行ごとの処理時間の内訳 (JSON) の保存先。空にすると保存しない
+        self.TRACE_REPORT_DIR = os.getenv("TRACE_REPORT_DIR", "traces")
+
+        # バッチ実行 (python main.py --batch) の既定値
+        self.BATCH_CONCURRENCY = self._get_int("BATCH_CONCURRENCY", 4)
+        self.BATCH_JOB_TIMEOUT_SECONDS = self._get_float("BATCH_JOB_TIMEOUT_SECONDS", 300)
+
         self.validate()
 
-    def validate(self):
-        missing = [var for var in ["ANTHROPIC_API_KEY", "AZURE_OPENAI_API_KEY", "AZURE_OPENAI_API_BASE", 
-                                   "AZURE_OPENAI_API_VERSION", "DEPLOYMENT_GPT_NAME"]
-                   if not getattr(self, var)]
+    @staticmethod
+    def _get_int(name: str, default: int) -> int:
+        value = os.getenv(name)
+        try:
+            return int(value) if value else default
+        except ValueError:
+            raise ValueError(f"環境変数 {name} は整数で指定してください: {value}")
+
+    @staticmethod
+    def _get_float(name: str, default: float) -> float:
+        value = os.getenv(name)
+        try:
+            return float(value) if value else default
+        except ValueError:
+            raise ValueError(f"環境変数 {name} は数値で指定してください: {value}")
+
+    @staticmethod
+    def _get_bool(name: str, default: bool) -> bool:
+        value = os.getenv(name)
+        if not value:
+            return default
+        return value.strip().lower() in ("1", "true", "yes", "on")
+
+    @staticmethod
+    def _get_list(name: str):
+        value = os.getenv(name)
+        if value is None:
+            return None
+        return [item.strip() for item in value.split(",") if item.strip()]
+
+    def missing_provider_vars(self, model: str) -> list:
+        return [var for var in PROVIDER_ENV_VARS.get(model, []) if not getattr(self, var)]
+
+    def validate_provider(self, model: str):
+        if model not in PROVIDER_ENV_VARS:
+            raise ValueError(f"サポートされていないモデル: {model}")
+        missing = self.missing_provider_vars(model)
         if missing:
+            raise ValueError(f"{model} に必要な環境変数が設定されていません: {', '.join(missing)}")
+
+    def validate(self):
+        # 少なくとも1つのモデルが利用可能であればよい。モデルごとの検証は初回利用時に行う
+        if all(self.missing_provider_vars(model) for model in PROVIDER_ENV_VARS):
+            missing = [var for model in PROVIDER_ENV_VARS for var in self.missing_provider_vars(model)]
             raise ValueError(f"必要な環境変数が設定されていません: {', '.join(missing)}")
+        if self.LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+            raise ValueError(f"LOG_LEVEL は DEBUG / INFO / WARNING / ERROR / CRITICAL のいずれかで指定してください: {self.LOG_LEVEL}")
+        if not 0 <= self.PAYLOAD_LOG_SAMPLE_RATE <= 1:
+            raise ValueError("PAYLOAD_LOG_SAMPLE_RATE は0以上1以下で指定してください。")
+        if self.DOM_ENCODING not in ("json", "outline"):
+            raise ValueError(f"DOM_ENCODING は json または outline で指定してください: {self.DOM_ENCODING}")
+        if self.WAIT_STRATEGY not in ("adaptive", "fixed"):
+            raise ValueError(f"WAIT_STRATEGY は adaptive または fixed で指定してください: {self.WAIT_STRATEGY}")
+        if self.LLM_MAX_CONCURRENCY < 1:
+            raise ValueError("LLM_MAX_CONCURRENCY は1以上で指定してください。")
+        if self.RACE_PRIMARY not in PROVIDER_ENV_VARS:
+            raise ValueError(f"RACE_PRIMARY は {' または '.join(PROVIDER_ENV_VARS)} で指定してください: {self.RACE_PRIMARY}")
+        if self.RACE_HEDGE_DELAY_SECONDS < 0:
+            raise ValueError("RACE_HEDGE_DELAY_SECONDS は0以上で指定してください。")
+        if not 0 < self.RACE_HEDGE_PERCENTILE <= 100:
+            raise ValueError("RACE_HEDGE_PERCENTILE は0より大きく100以下で指定してください。")
+        if self.RACE_MIN_SAMPLES < 1:
+            raise ValueError("RACE_MIN_SAMPLES は1以上で指定してください。")
+        if self.HTTP_POOL_SIZE < 1:
+            raise ValueError("HTTP_POOL_SIZE は1以上で指定してください。")
+        if self.BROWSER_MAX_SESSIONS < 0:
+            raise ValueError("BROWSER_MAX_SESSIONS は0以上で指定してください。")
+        if self.BROWSER_MEMORY_LIMIT_MB < 0:
+            raise ValueError("BROWSER_MEMORY_LIMIT_MB は0以上で指定してください。")
+        if self.PAGE_CACHE_MEMORY_ENTRIES < 0:
+            raise ValueError("PAGE_CACHE_MEMORY_ENTRIES は0以上で指定してください。")
+        if self.AGENT_MAX_STEPS < 1:
+            raise ValueError("AGENT_MAX_STEPS は1以上で指定してください。")
+        if self.BATCH_CONCURRENCY < 1:
+            raise ValueError("BATCH_CONCURRENCY は1以上で指定してください。")
@@ -0,0 +1,77 @@
+# controllers/dom_snapshot.py
+
+from typing import List, Optional
+
+from parsers.dom_parser import INTERACTIVE_ROLES
+
+# スナップショットに含める属性
+SNAPSHOT_ATTRIBUTES = [
+    "id", "name", "type", "role", "href", "placeholder", "aria-label", "title", "alt", "for", "data-testid",
+]
+SNAPSHOT_TEXT_LIMIT = 100
+
+# 表示されている操作可能な要素に data-agent-id を振り、解析済み DOM と同じ形式の要素として返す。
+# 一度振った番号は同じドキュメント内では変わらないため、前回との差分を番号で比較できる
+SNAPSHOT_SCRIPT = """
+([roles, attributeNames, textLimit]) => {
+    if (!window.__agentDocumentId) {
+        window.__agentDocumentId = String(Date.now()) + Math.random().toString(36).slice(2);
+        window.__agentNextId = 1;
+    }
+    const selector = 'a[href], button, input:not([type=hidden]), select, textarea, summary, [role], [onclick], '
+        + '[contenteditable]:not([contenteditable=false]), [tabindex]:not([tabindex="-1"])';
+    const elements = [];
+    for (const el of document.querySelectorAll(selector)) {
+        const role = (el.getAttribute('role') || '').toLowerCase();
+        if (el.matches('[role]') && !roles.includes(role) && !el.matches('a[href], button, input, select, textarea, summary')) continue;
+        const rect = el.getBoundingClientRect();
+        const style = getComputedStyle(el);
+        if ((rect.width === 0 && rect.height === 0) || style.visibility === 'hidden' || style.display === 'none') continue;
+        let id = el.getAttribute('data-agent-id');
+        if (!id) {
+            id = String(window.__agentNextId++);
+            el.setAttribute('data-agent-id', id);
+        }
+        const attributes = {};
+        for (const name of attributeNames) {
+            const value = el.getAttribute(name);
+            if (value !== null) attributes[name] = value.slice(0, textLimit);
+        }
+        if (el.classList.length) attributes['class'] = Array.from(el.classList).slice(0, 3);
+        if ('value' in el && el.value && el.type !== 'password') attributes['value'] = String(el.value).slice(0, textLimit);
+        if (el.checked) attributes['checked'] = '';
+        if (el.disabled) attributes['disabled'] = '';
+        const labelElement = el.labels && el.labels.length ? el.labels[0] : null;
+        const label = el.getAttribute('aria-label') || (labelElement ? labelElement.innerText : '') || el.getAttribute('placeholder') || '';
+        const text = (el.innerText || '').trim().replace(/\\s+/g, ' ').slice(0, textLimit);
+        const record = {dom_id: Number(id), tag: el.tagName.toLowerCase(), attributes, text, parent_id: null};
+        if (label.trim() && label.trim() !== text) record.label = label.trim().slice(0, textLimit);
+        elements.push(record);
+    }
+    return {document_id: window.__agentDocumentId, url: location.href, title: document.title, elements};
+}
+"""
+
+def snapshot_arguments() -> list:
+    return [sorted(INTERACTIVE_ROLES), SNAPSHOT_ATTRIBUTES, SNAPSHOT_TEXT_LIMIT]
+
+def agent_selector(dom_id: int) -> str:
+    return f'[data-agent-id="{dom_id}"]'
+
+def diff_snapshots(previous: Optional[dict], current: dict) -> Optional[dict]:
+    # 別のドキュメントに移った場合は差分を取れないため None を返す
+    if previous is None or previous.get("document_id") != current.get("document_id"):
+        return None
+    before = {element["dom_id"]: element for element in previous["elements"]}
+    added: List[dict] = []
+    changed: List[dict] = []
+    seen = set()
+    for element in current["elements"]:
+        seen.add(element["dom_id"])
+        old = before.get(element["dom_id"])
+        if old is None:
+            added.append(element)
+        elif old != element:
+            changed.append(element)
+    removed = [dom_id for dom_id in before if dom_id not in seen]
+    return {"added": added, "changed": changed, "removed": removed}
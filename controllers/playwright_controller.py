@@ -1,87 +1,419 @@
 # controllers/playwright_controller.py
 
+import glob
+import json
 import logging
+import os
+import queue
 import subprocess
+import sys
+import threading
 import time
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
-from typing import List, Callable, Optional
+from concurrent.futures import Future
+from importlib import metadata
+from typing import Iterable, List, Callable, Optional
+
+from .dom_snapshot import SNAPSHOT_SCRIPT, snapshot_arguments
+from .resource_blocker import ResourceBlocker, log_blocked_requests, DEFAULT_BLOCKED_RESOURCE_TYPES, DEFAULT_BLOCKED_HOST_PATTERNS
+from .wait_strategy import AdaptiveWaitStrategy, cap_timeout, create_wait_strategy, remaining_ms
+from config import Config
+from utils.tracing import bind, record_span, span
+
+INSTALL_MARKER_PATH = os.path.join(os.path.expanduser("~"), ".cache", "web_agent", "playwright_install.json")
+# page.screenshot の既定のタイムアウト (Playwright の既定値と同じ)
+SCREENSHOT_TIMEOUT_MS = 30000
+
+def playwright_browsers_path() -> str:
+    path = os.getenv("PLAYWRIGHT_BROWSERS_PATH")
+    if path and path != "0":
+        return path
+    if sys.platform == "win32":
+        return os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")), "ms-playwright")
+    if sys.platform == "darwin":
+        return os.path.join(os.path.expanduser("~"), "Library", "Caches", "ms-playwright")
+    return os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "ms-playwright")
+
+class PlaywrightSession:
+    def __init__(self, controller: "PlaywrightController", context, page):
+        self.controller = controller
+        self.context = context
+        self.page = page
+        self.blocker_stats = None
+
+    def goto(self, url: str, timeout_ms: Optional[int] = None):
+        self.controller.call(self._goto, url, timeout_ms)
+
+    def content(self) -> str:
+        # JavaScript で描画された後の DOM を取得する
+        with span("content") as attributes:
+            html = self.controller.call(self.page.content)
+            attributes["chars"] = len(html)
+        logging.info(f"ページのDOMを取得しました。文字数: {len(html)}")
+        return html
+
+    def perform_actions(self, actions: Iterable[dict], callback: Optional[Callable] = None, start_index: int = 1,
+                        cancel: Optional[threading.Event] = None, deadline: Optional[float] = None) -> List[dict]:
+        return self.controller.call(self._perform_actions, actions, callback, start_index, cancel, deadline)
+
+    def snapshot(self) -> dict:
+        # 表示されている操作可能な要素の一覧を取得する (観察しながら1操作ずつ実行するモードで使用)
+        with span("snapshot") as attributes:
+            snapshot = self.controller.call(self._snapshot)
+            attributes["elements"] = len(snapshot["elements"])
+        return snapshot
+
+    def close(self):
+        self.controller.call(self.controller._release_context, self)
+
+    def _goto(self, url: str, timeout_ms: Optional[int] = None):
+        logging.info(f"URLにアクセスします: {url}")
+        with span("navigate", url=url) as attributes:
+            waited = self.controller.wait_strategy.navigate(self.page, url, timeout_ms)
+            attributes["wait_seconds"] = round(waited, 4)
+        logging.info(f"URLにアクセスしました: {url} (待機時間: {waited:.2f}秒)")
+
+    def _snapshot(self) -> dict:
+        for _ in range(2):
+            try:
+                return self.page.evaluate(SNAPSHOT_SCRIPT, snapshot_arguments())
+            except Exception as e:
+                # 遷移中で実行コンテキストが破棄された場合は読み込みを待って再試行する
+                logging.debug(f"ページのスナップショットを再試行します: {e}")
+                self.page.wait_for_load_state('domcontentloaded')
+        return self.page.evaluate(SNAPSHOT_SCRIPT, snapshot_arguments())
+
+    def _perform_actions(self, actions: Iterable[dict], callback: Optional[Callable] = None, start_index: int = 1,
+                         cancel: Optional[threading.Event] = None, deadline: Optional[float] = None) -> List[dict]:
+        # cancel がセットされたら、次のアクションに進まず、対象のセレクタ待ちも打ち切る。
+        # deadline (time.monotonic() の値) を指定すると、各操作と待機のタイムアウトを期限までの残り時間以下にする
+        from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+        page = self.page
+        wait = self.controller.wait_strategy
+        wait_metrics = []
+        for index, action in enumerate(actions, start=start_index):
+            if cancel is not None and cancel.is_set():
+                logging.warning(f"中止が要求されたため、アクション {index} の前で打ち切ります。")
+                break
+            act = action.get("action")
+            sel = action.get("selector")
+            val = action.get("value")
+            code_snippet = ""
+            waited = 0.0
+            succeeded = False
+            started = time.monotonic()
+            verified = action.get("selector_status") != "missing"
+
+            try:
+                if act == "NAVIGATE" and val:
+                    logging.info(f"ナビゲートします: {val}")
+                    waited += wait.navigate(page, val, remaining_ms(deadline))
+                    waited += wait.settle(page, act, remaining_ms(deadline))
+                    logging.info(f"ナビゲートしました: {val}")
+                    code_snippet = f'page.goto("{val}")'
+                    succeeded = True
+                    if callback:
+                        callback(index, act, sel, val, code_snippet, success=True)
+                elif act == "CLICK" and sel:
+                    logging.info(f"クリックします: {sel}")
+                    waited += wait.wait_for_target(page, act, sel, verified, cancel, remaining_ms(deadline))
+                    if cancel is not None and cancel.is_set():
+                        logging.warning(f"中止が要求されたため、アクション {index} の対象の待機を打ち切りました。")
+                        break
+                    page.click(sel, timeout=cap_timeout(wait.action_timeout_ms(act, verified), remaining_ms(deadline)))
+                    waited += wait.settle(page, act, remaining_ms(deadline))
+                    logging.info(f"クリックしました: {sel}")
+                    code_snippet = f'page.click("{sel}")'
+                    succeeded = True
+                    if callback:
+                        callback(index, act, sel, val, code_snippet, success=True)
+                elif act == "TYPE" and sel:
+                    logging.info(f"タイプします: '{val}' into {sel}")
+                    waited += wait.wait_for_target(page, act, sel, verified, cancel, remaining_ms(deadline))
+                    if cancel is not None and cancel.is_set():
+                        logging.warning(f"中止が要求されたため、アクション {index} の対象の待機を打ち切りました。")
+                        break
+                    page.fill(sel, val, timeout=cap_timeout(wait.action_timeout_ms(act, verified), remaining_ms(deadline)))
+                    waited += wait.settle(page, act, remaining_ms(deadline))
+                    logging.info(f"タイプしました: '{val}' into {sel}")
+                    code_snippet = f'page.fill("{sel}", "{val}")'
+                    succeeded = True
+                    if callback:
+                        callback(index, act, sel, val, code_snippet, success=True)
+                elif act == "SCREENSHOT":
+                    path = val or "screenshot.png"
+                    page.screenshot(path=path, timeout=cap_timeout(SCREENSHOT_TIMEOUT_MS, remaining_ms(deadline)))
+                    logging.info(f"スクリーンショットを保存しました: {path}")
+                    code_snippet = f'page.screenshot(path="{path}")'
+                    succeeded = True
+                    if callback:
+                        callback(index, act, sel, val, code_snippet, success=True)
+                else:
+                    logging.warning(f"未知のアクション: {action}")
+                    if callback:
+                        callback(index, act, sel, val, code_snippet, success=False)
+            except PlaywrightTimeoutError:
+                waited = time.monotonic() - started
+                logging.error(f"タイムアウトエラー: アクション '{act}' のセレクタ '{sel}' が見つかりませんでした。")
+                if callback:
+                    callback(index, act, sel, val, code_snippet, success=False)
+            except Exception as e:
+                logging.error(f"{act} エラー: {e}")
+                if callback:
+                    callback(index, act, sel, val, code_snippet, success=False)
+            finally:
+                elapsed = time.monotonic() - started
+                wait_metrics.append({"index": index, "action": act, "wait_seconds": round(waited, 3),
+                                     "elapsed_seconds": round(elapsed, 3)})
+                record_span("action", elapsed, index=index, action=act, wait_seconds=round(waited, 4), success=succeeded)
+                logging.info(f"アクション {index} ({act}) の待機時間: {waited:.2f}秒 / 所要時間: {elapsed:.2f}秒")
+
+        total_wait = sum(metric["wait_seconds"] for metric in wait_metrics)
+        logging.info(f"待機時間の合計: {total_wait:.2f}秒 ({wait.name})")
+        return wait_metrics
 
 class PlaywrightController:
-    def __init__(self):
+    # ブラウザは起動したまま再利用し、セッションごとに新しいブラウザコンテキストを作る。
+    # コンテキストを使い回すと localStorage や IndexedDB、権限などが次の実行に持ち越されるため再利用しない。
+    # 長時間動かしたブラウザのメモリ増加を抑えるため、max_sessions 回使うか、セッション終了時のページの
+    # JS ヒープ使用量が memory_limit_mb を超えたら、実行中のセッションがなくなった時点でブラウザを再起動する
+    def __init__(self, wait_strategy=None, resource_blocker: Optional[ResourceBlocker] = None, headless: bool = False,
+                 max_sessions: int = 50, memory_limit_mb: int = 512):
+        self.wait_strategy = wait_strategy or AdaptiveWaitStrategy()
+        self.resource_blocker = resource_blocker
+        self.headless = headless
+        self.max_sessions = max_sessions
+        self.memory_limit_mb = memory_limit_mb
         self.install_browsers()
+        # sync API のオブジェクトは生成したスレッドでしか使えないため、専用スレッドで Playwright を保持する
+        self._tasks = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._playwright = None
+        self._browser = None
+        self._active_contexts = {}
+        self._sessions_started = 0
+        self._recycle_reason = None
 
-    def install_browsers(self):
+    @classmethod
+    def from_config(cls, config: Config, headless: Optional[bool] = None) -> "PlaywrightController":
+        resource_blocker = None
+        if config.BLOCK_RESOURCES:
+            resource_blocker = ResourceBlocker(
+                resource_types=DEFAULT_BLOCKED_RESOURCE_TYPES if config.BLOCK_RESOURCE_TYPES is None else config.BLOCK_RESOURCE_TYPES,
+                host_patterns=DEFAULT_BLOCKED_HOST_PATTERNS if config.BLOCK_HOST_PATTERNS is None else config.BLOCK_HOST_PATTERNS
+            )
+        return cls(
+            wait_strategy=create_wait_strategy(
+                config.WAIT_STRATEGY,
+                dom_quiet_ms=config.WAIT_DOM_QUIET_MS,
+                dom_max_ms=config.WAIT_DOM_MAX_MS,
+                min_timeout_ms=config.WAIT_MIN_TIMEOUT_MS,
+                max_timeout_ms=config.WAIT_MAX_TIMEOUT_MS
+            ),
+            resource_blocker=resource_blocker,
+            headless=config.BROWSER_HEADLESS if headless is None else headless,
+            max_sessions=config.BROWSER_MAX_SESSIONS,
+            memory_limit_mb=config.BROWSER_MEMORY_LIMIT_MB
+        )
+
+    def install_browsers(self, force: bool = False):
+        # インストール済みなら起動のたびに subprocess を実行しない
+        if not force and self._browsers_installed():
+            logging.info("Playwrightのブラウザはインストール済みのため、インストールを省略します。")
+            return
         try:
             subprocess.run(["playwright", "install"], check=True)
             logging.info("Playwrightのブラウザをインストールしました。")
         except subprocess.CalledProcessError as e:
             logging.error(f"Playwrightブラウザのインストールに失敗しました: {e}")
             raise
+        self._write_install_marker()
+
+    @staticmethod
+    def _playwright_version() -> str:
+        try:
+            return metadata.version("playwright")
+        except metadata.PackageNotFoundError:
+            return ""
+
+    def _browsers_installed(self) -> bool:
+        try:
+            with open(INSTALL_MARKER_PATH, encoding="utf-8") as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if marker.get("playwright_version") != self._playwright_version():
+            return False
+        if os.getenv("PLAYWRIGHT_BROWSERS_PATH") == "0":
+            return True
+        return bool(glob.glob(os.path.join(playwright_browsers_path(), "chromium-*")))
 
-    def perform_actions(self, actions: List[dict], url: Optional[str] = None, callback: Optional[Callable] = None):
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=False)
-            page = browser.new_page()
+    def _write_install_marker(self):
+        try:
+            os.makedirs(os.path.dirname(INSTALL_MARKER_PATH), exist_ok=True)
+            with open(INSTALL_MARKER_PATH, "w", encoding="utf-8") as f:
+                json.dump({"playwright_version": self._playwright_version(), "installed_at": time.time()}, f)
+        except OSError as e:
+            logging.warning(f"インストール状態の記録に失敗しました: {e}")
+
+    def call(self, fn: Callable, *args, **kwargs):
+        if threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+        self._ensure_thread()
+        future = Future()
+        self._tasks.put((bind(fn), args, kwargs, future))
+        return future.result()
+
+    def open_session(self, url: Optional[str] = None, timeout_ms: Optional[int] = None) -> PlaywrightSession:
+        # 同じページで DOM の取得とアクションの実行を行うためのセッションを開く。
+        # timeout_ms を指定すると、最初のページの読み込みをその時間で打ち切る
+        session = self.call(self._acquire_context)
+        if url:
             try:
-                if url:
-                    logging.info(f"URLにアクセスします: {url}")
-                    page.goto(url, timeout=60000)
-                    page.wait_for_load_state('networkidle', timeout=60000)
-                    logging.info(f"URLにアクセスしました: {url}")
-            
-                for index, action in enumerate(actions, start=1):
-                    act = action.get("action")
-                    sel = action.get("selector")
-                    val = action.get("value")
-                    code_snippet = ""
-
-                    try:
-                        if act == "NAVIGATE" and val:
-                            logging.info(f"ナビゲートします: {val}")
-                            page.goto(val, timeout=60000)
-                            page.wait_for_load_state('networkidle', timeout=60000)
-                            logging.info(f"ナビゲートしました: {val}")
-                            time.sleep(2)
-                            code_snippet = f'page.goto("{val}")'
-                            if callback:
-                                callback(index, act, sel, val, code_snippet, success=True)
-                        elif act == "CLICK" and sel:
-                            logging.info(f"クリックします: {sel}")
-                            page.wait_for_selector(sel, timeout=60000)
-                            page.click(sel, timeout=60000)
-                            logging.info(f"クリックしました: {sel}")
-                            time.sleep(1)
-                            code_snippet = f'page.click("{sel}")'
-                            if callback:
-                                callback(index, act, sel, val, code_snippet, success=True)
-                        elif act == "TYPE" and sel:
-                            logging.info(f"タイプします: '{val}' into {sel}")
-                            page.wait_for_selector(sel, timeout=60000)
-                            page.fill(sel, val, timeout=60000)
-                            logging.info(f"タイプしました: '{val}' into {sel}")
-                            time.sleep(1)
-                            code_snippet = f'page.fill("{sel}", "{val}")'
-                            if callback:
-                                callback(index, act, sel, val, code_snippet, success=True)
-                        elif act == "SCREENSHOT":
-                            path = val or "screenshot.png"
-                            page.screenshot(path=path)
-                            logging.info(f"スクリーンショットを保存しました: {path}")
-                            code_snippet = f'page.screenshot(path="{path}")'
-                            if callback:
-                                callback(index, act, sel, val, code_snippet, success=True)
-                        else:
-                            logging.warning(f"未知のアクション: {action}")
-                            if callback:
-                                callback(index, act, sel, val, code_snippet, success=False)
-                    except PlaywrightTimeoutError:
-                        logging.error(f"タイムアウトエラー: アクション '{act}' のセレクタ '{sel}' が見つかりませんでした。")
-                        if callback:
-                            callback(index, act, sel, val, code_snippet, success=False)
-                    except Exception as e:
-                        logging.error(f"{act} エラー: {e}")
-                        if callback:
-                            callback(index, act, sel, val, code_snippet, success=False)
-            finally:
-                browser.close()
+                session.goto(url, timeout_ms)
+            except Exception:
+                session.close()
+                raise
+        return session
+
+    def perform_actions(self, actions: Iterable[dict], url: Optional[str] = None, callback: Optional[Callable] = None,
+                        cancel: Optional[threading.Event] = None, timeout_ms: Optional[int] = None) -> List[dict]:
+        # timeout_ms を指定すると、ページの読み込みからすべてのアクションまでをその時間内に収める
+        deadline = None if timeout_ms is None else time.monotonic() + timeout_ms / 1000
+        session = self.open_session(url, timeout_ms)
+        try:
+            return session.perform_actions(actions, callback, cancel=cancel, deadline=deadline)
+        finally:
+            session.close()
+
+    def shutdown(self):
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._tasks.put(None)
+        thread.join(timeout=30)
+        logging.info("Playwrightを終了しました。")
+
+    def _ensure_thread(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="playwright", daemon=True)
+                self._thread.start()
+
+    def _worker(self):
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                fn, args, kwargs, future = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            self._close_browser()
+
+    def _ensure_browser(self):
+        if self._browser is not None and self._browser.is_connected():
+            return self._browser
+        if self._browser is not None:
+            logging.warning("ブラウザとの接続が切れたため再起動します。")
+            self._active_contexts.clear()
+            self._browser = None
+        self._sessions_started = 0
+        self._recycle_reason = None
+        if self._playwright is None:
+            from playwright.sync_api import sync_playwright
+            self._playwright = sync_playwright().start()
+        started = time.monotonic()
+        try:
+            self._browser = self._playwright.chromium.launch(headless=self.headless)
+        except Exception as e:
+            if "Executable doesn't exist" not in str(e):
+                raise
+            # キャッシュしたインストール状態が古い場合はインストールし直して再試行する
+            logging.warning("ブラウザが見つからないため再インストールします。")
+            self.install_browsers(force=True)
+            self._browser = self._playwright.chromium.launch(headless=self.headless)
+        logging.info(f"ブラウザを起動しました。({time.monotonic() - started:.2f}秒)")
+        return self._browser
+
+    def _acquire_context(self) -> PlaywrightSession:
+        if self._recycle_reason and not self._active_contexts:
+            self._recycle_browser()
+        browser = self._ensure_browser()
+        context = browser.new_context()
+        self._sessions_started += 1
+        if self.resource_blocker:
+            self.resource_blocker.attach(context)
+        page = context.new_page()
+        session = PlaywrightSession(self, context, page)
+        if self.resource_blocker:
+            session.blocker_stats = self.resource_blocker.stats()
+        self._active_contexts[id(session)] = context
+        return session
+
+    def _release_context(self, session: PlaywrightSession):
+        context = self._active_contexts.pop(id(session), None)
+        if context is None:
+            return
+        if self.resource_blocker and session.blocker_stats:
+            log_blocked_requests(session.blocker_stats, self.resource_blocker.stats())
+        if self._recycle_reason is None:
+            if self.max_sessions and self._sessions_started >= self.max_sessions:
+                self._recycle_reason = f"{self._sessions_started}回のセッションで使用しました"
+            elif self.memory_limit_mb:
+                heap_mb = self._heap_usage_mb(session.page)
+                if heap_mb > self.memory_limit_mb:
+                    self._recycle_reason = f"JS ヒープ使用量が {heap_mb:.0f}MB (上限 {self.memory_limit_mb}MB) に達しました"
+        self._discard(context)
+        if self._recycle_reason and not self._active_contexts:
+            self._recycle_browser()
+
+    def _recycle_browser(self):
+        # Playwright は起動したまま、ブラウザのプロセスだけを閉じる。次のセッションで起動し直す
+        logging.info(f"ブラウザを再起動します: {self._recycle_reason}")
+        try:
+            if self._browser is not None:
+                self._browser.close()
+        except Exception as e:
+            logging.warning(f"ブラウザのクローズに失敗しました: {e}")
+        self._browser = None
+        self._sessions_started = 0
+        self._recycle_reason = None
+
+    @staticmethod
+    def _heap_usage_mb(page) -> float:
+        try:
+            used = page.evaluate("() => (performance.memory && performance.memory.usedJSHeapSize) || 0")
+            return used / (1024 * 1024)
+        except Exception:
+            return 0.0
+
+    @staticmethod
+    def _discard(context):
+        try:
+            context.close()
+        except Exception as e:
+            logging.debug(f"ブラウザコンテキストのクローズに失敗しました: {e}")
+
+    def _close_browser(self):
+        for context in list(self._active_contexts.values()):
+            self._discard(context)
+        self._active_contexts.clear()
+        try:
+            if self._browser is not None:
+                self._browser.close()
                 logging.info("ブラウザを閉じました。")
+        except Exception as e:
+            logging.warning(f"ブラウザのクローズに失敗しました: {e}")
+        finally:
+            self._browser = None
+            if self._playwright is not None:
+                self._playwright.stop()
+                self._playwright = None
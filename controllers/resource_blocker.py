@@ -0,0 +1,62 @@
+# controllers/resource_blocker.py
+
+import fnmatch
+import logging
+import threading
+from typing import Iterable
+from urllib.parse import urlsplit
+
+DEFAULT_BLOCKED_RESOURCE_TYPES = ("image", "media", "font")
+DEFAULT_BLOCKED_HOST_PATTERNS = (
+    "*doubleclick.net",
+    "*googlesyndication.com",
+    "*google-analytics.com",
+    "*googletagmanager.com",
+    "*googleadservices.com",
+    "*facebook.net",
+    "*hotjar.com",
+    "*scorecardresearch.com",
+    "*criteo.com",
+    "*adnxs.com",
+)
+
+class ResourceBlocker:
+    # クリックや入力に不要なリソースの取得をブラウザコンテキスト単位で止める
+    def __init__(self, resource_types: Iterable[str] = DEFAULT_BLOCKED_RESOURCE_TYPES,
+                 host_patterns: Iterable[str] = DEFAULT_BLOCKED_HOST_PATTERNS):
+        self.resource_types = frozenset(t.strip().lower() for t in resource_types if t.strip())
+        self.host_patterns = tuple(p.strip().lower() for p in host_patterns if p.strip())
+        self._lock = threading.Lock()
+        self.blocked = 0
+        self.allowed = 0
+        self.blocked_by_type = {}
+
+    def attach(self, context):
+        context.route("**/*", self._handle_route)
+
+    def should_block(self, resource_type: str, url: str) -> bool:
+        if resource_type in self.resource_types:
+            return True
+        host = (urlsplit(url).hostname or "").lower()
+        return any(fnmatch.fnmatch(host, pattern) for pattern in self.host_patterns)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"blocked": self.blocked, "allowed": self.allowed, "blocked_by_type": dict(self.blocked_by_type)}
+
+    def _handle_route(self, route):
+        request = route.request
+        if self.should_block(request.resource_type, request.url):
+            with self._lock:
+                self.blocked += 1
+                self.blocked_by_type[request.resource_type] = self.blocked_by_type.get(request.resource_type, 0) + 1
+            route.abort("blockedbyclient")
+        else:
+            with self._lock:
+                self.allowed += 1
+            route.continue_()
+
+def log_blocked_requests(before: dict, after: dict):
+    blocked = after["blocked"] - before["blocked"]
+    allowed = after["allowed"] - before["allowed"]
+    logging.info(f"リソースのブロック数: {blocked}, 許可数: {allowed}")
@@ -0,0 +1,165 @@
+# controllers/wait_strategy.py
+
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+# 一定時間 DOM の変更が止まるまで待つ。ページ遷移で実行コンテキストが破棄された場合は呼び出し側で再試行する
+DOM_STABLE_SCRIPT = """
+([quietMs, maxMs]) => new Promise(resolve => {
+    const started = performance.now();
+    let quietTimer = null;
+    let observer = null;
+    const done = () => {
+        if (observer) observer.disconnect();
+        clearTimeout(quietTimer);
+        resolve(performance.now() - started);
+    };
+    observer = new MutationObserver(() => {
+        clearTimeout(quietTimer);
+        quietTimer = setTimeout(done, quietMs);
+    });
+    observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    quietTimer = setTimeout(done, quietMs);
+    setTimeout(done, maxMs);
+})
+"""
+
+# 事前検証で DOM に見つからなかったセレクタを待つ時間の上限
+UNVERIFIED_TIMEOUT_MS = 5000
+
+# 中止できるようにセレクタ待ちを区切る間隔
+CANCEL_POLL_MS = 250
+
+def cap_timeout(timeout_ms: int, limit_ms: Optional[int] = None) -> int:
+    # 期限までの残り時間 (limit_ms) が指定されていれば、タイムアウトをそれ以下にする
+    return timeout_ms if limit_ms is None else max(1, min(timeout_ms, limit_ms))
+
+def remaining_ms(deadline: Optional[float]) -> Optional[int]:
+    return None if deadline is None else max(1, int((deadline - time.monotonic()) * 1000))
+
+def wait_for_selector(page, selector: str, timeout_ms: int, cancel=None, **options):
+    # cancel が渡された場合は短い間隔に区切って待ち、中止されたらタイムアウトを待たずに戻る
+    if cancel is None:
+        page.wait_for_selector(selector, timeout=timeout_ms, **options)
+        return
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+    deadline = time.monotonic() + timeout_ms / 1000
+    while True:
+        remaining_ms = (deadline - time.monotonic()) * 1000
+        try:
+            page.wait_for_selector(selector, timeout=max(1, min(CANCEL_POLL_MS, remaining_ms)), **options)
+            return
+        except PlaywrightTimeoutError:
+            if cancel.is_set():
+                return
+            if time.monotonic() >= deadline:
+                raise
+
+class FixedWaitStrategy:
+    # 従来どおり networkidle と固定スリープで待機する
+    name = "fixed"
+
+    def __init__(self, timeout_ms: int = 60000, navigate_sleep: float = 2.0, action_sleep: float = 1.0):
+        self.timeout_ms = timeout_ms
+        self.navigate_sleep = navigate_sleep
+        self.action_sleep = action_sleep
+
+    # 各メソッドの timeout_ms には期限までの残り時間を渡し、設定値より短い場合はその時間で待機を打ち切る
+    def navigate(self, page, url: str, timeout_ms: Optional[int] = None) -> float:
+        deadline = None if timeout_ms is None else time.monotonic() + timeout_ms / 1000
+        page.goto(url, timeout=cap_timeout(self.timeout_ms, timeout_ms))
+        started = time.monotonic()
+        page.wait_for_load_state('networkidle', timeout=cap_timeout(self.timeout_ms, remaining_ms(deadline)))
+        return time.monotonic() - started
+
+    def wait_for_target(self, page, action: str, selector: str, verified: bool = True, cancel=None,
+                        timeout_ms: Optional[int] = None) -> float:
+        started = time.monotonic()
+        wait_for_selector(page, selector, cap_timeout(self.action_timeout_ms(action, verified), timeout_ms), cancel)
+        return time.monotonic() - started
+
+    def action_timeout_ms(self, action: str, verified: bool = True) -> int:
+        return self.timeout_ms if verified else min(self.timeout_ms, UNVERIFIED_TIMEOUT_MS)
+
+    def settle(self, page, action: str, timeout_ms: Optional[int] = None) -> float:
+        delay = self.navigate_sleep if action == "NAVIGATE" else self.action_sleep
+        if timeout_ms is not None:
+            delay = min(delay, timeout_ms / 1000)
+        time.sleep(delay)
+        return delay
+
+class AdaptiveWaitStrategy:
+    # ナビゲーションのコミット、対象セレクタの表示、DOM の安定を検知して待機する。
+    # セレクタ待ちのタイムアウトは直近の実測値から操作の種類ごとに決める
+    name = "adaptive"
+
+    def __init__(self, dom_quiet_ms: int = 300, dom_max_ms: int = 5000,
+                 min_timeout_ms: int = 5000, max_timeout_ms: int = 60000,
+                 timeout_factor: float = 3.0, history_size: int = 20):
+        self.dom_quiet_ms = dom_quiet_ms
+        self.dom_max_ms = dom_max_ms
+        self.min_timeout_ms = min_timeout_ms
+        self.max_timeout_ms = max_timeout_ms
+        self.timeout_factor = timeout_factor
+        self.history = defaultdict(lambda: deque(maxlen=history_size))
+
+    def navigate(self, page, url: str, timeout_ms: Optional[int] = None) -> float:
+        deadline = None if timeout_ms is None else time.monotonic() + timeout_ms / 1000
+        page.goto(url, wait_until='commit', timeout=cap_timeout(self.max_timeout_ms, timeout_ms))
+        started = time.monotonic()
+        page.wait_for_load_state('domcontentloaded', timeout=cap_timeout(self.max_timeout_ms, remaining_ms(deadline)))
+        self._wait_dom_stable(page, remaining_ms(deadline))
+        return time.monotonic() - started
+
+    def wait_for_target(self, page, action: str, selector: str, verified: bool = True, cancel=None,
+                        timeout_ms: Optional[int] = None) -> float:
+        started = time.monotonic()
+        wait_for_selector(page, selector, cap_timeout(self.action_timeout_ms(action, verified), timeout_ms), cancel,
+                          state='visible')
+        elapsed = time.monotonic() - started
+        if cancel is None or not cancel.is_set():
+            # 中止で打ち切った待ち時間はタイムアウトの算出に使わない
+            self.history[action].append(elapsed)
+        return elapsed
+
+    def action_timeout_ms(self, action: str, verified: bool = True) -> int:
+        if not verified:
+            # 事前検証で見つからなかったセレクタは、描画後に現れる場合に備えて短時間だけ待つ
+            return min(self.min_timeout_ms, UNVERIFIED_TIMEOUT_MS)
+        observed = self.history.get(action)
+        if not observed:
+            return self.max_timeout_ms
+        timeout = max(observed) * 1000 * self.timeout_factor
+        return int(min(max(timeout, self.min_timeout_ms), self.max_timeout_ms))
+
+    def settle(self, page, action: str, timeout_ms: Optional[int] = None) -> float:
+        if action == "NAVIGATE":
+            return 0.0
+        started = time.monotonic()
+        self._wait_dom_stable(page, timeout_ms)
+        return time.monotonic() - started
+
+    def _wait_dom_stable(self, page, timeout_ms: Optional[int] = None):
+        deadline = None if timeout_ms is None else time.monotonic() + timeout_ms / 1000
+        for _ in range(2):
+            try:
+                page.evaluate(DOM_STABLE_SCRIPT, [self.dom_quiet_ms, cap_timeout(self.dom_max_ms, remaining_ms(deadline))])
+                return
+            except Exception as e:
+                # クリックでページ遷移した場合は新しいドキュメントの読み込みを待ってから再試行する
+                logging.debug(f"DOMの安定待ちを再試行します: {e}")
+                try:
+                    page.wait_for_load_state('domcontentloaded',
+                                             timeout=cap_timeout(self.max_timeout_ms, remaining_ms(deadline)))
+                except Exception:
+                    return
+
+def create_wait_strategy(name: str = "adaptive", **options):
+    if name == FixedWaitStrategy.name:
+        return FixedWaitStrategy()
+    if name == AdaptiveWaitStrategy.name:
+        return AdaptiveWaitStrategy(**options)
+    raise ValueError(f"サポートされていない待機方式: {name}")
@@ -1,29 +1,48 @@
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 import threading
-import json
 import re
 import logging
 import queue
-import requests
-from typing import List
+from collections import deque
+from typing import Iterator, List, Optional, Tuple
 
-from clients.openai_client import OpenAIClient
+from clients.action_stream import ActionStream
+from clients.openai_client import RACE_MODEL, OpenAIClient
 from controllers.playwright_controller import PlaywrightController
-from parsers.dom_parser import DOMParser
+from runner.agent_loop import AgentLoop
+from runner.pipeline import InstructionPipeline, extract_url, is_cancelled
 from utils.logger import setup_logging
+from utils.tracing import trace_run
+
+# 操作リストを更新する間隔 (ミリ秒) と、1回の更新で取り出すメッセージ数の上限
+RENDER_INTERVAL_MS = 100
+RENDER_BATCH_LIMIT = 500
+
+# ステータスごとに共有する Text のタグ
+STATUS_TAGS = {"完了": "completed", "失敗": "failed"}
 
 class WebAgentGUI:
     def __init__(self, openai_client: OpenAIClient, playwright_controller: PlaywrightController):
         self.openai_client = openai_client
         self.playwright_controller = playwright_controller
+        self.pipeline = InstructionPipeline(openai_client)
+        self.agent_loop = AgentLoop(openai_client, playwright_controller, openai_client.config.AGENT_MAX_STEPS)
         self.queue = queue.Queue()
+        # 操作リストの各行 (テキスト, タグ)。Text には _dirty_from 以降の行だけを描画し直す
+        self.action_lines: List[Tuple[str, Optional[str]]] = []
+        self.summary_lines: List[Tuple[str, Optional[str]]] = []
+        self._dirty_from = None
+        self.pending_dialogs = deque()
+        self._dialog_open = False
+        self.cancel_event = None
         self.setup_logging()
         self.setup_gui()
         self.running = False
 
     def setup_logging(self):
-        setup_logging()
+        # main で設定済みの場合は何もしない
+        setup_logging(self.openai_client.config)
 
     def setup_gui(self):
         self.root = tk.Tk()
@@ -44,7 +63,61 @@ class WebAgentGUI:
         )
         chk_chunk.pack(pady=5)
 
-        btn_frame = tk.Frame(self.root)
+        # 操作可能な要素だけをLLMに送るプルーニングのチェックボックス
+        self.prune_var = tk.BooleanVar(value=False)
+        chk_prune = tk.Checkbutton(
+            self.root,
+            text="操作可能な要素のみ送信する",
+            variable=self.prune_var
+        )
+        chk_prune.pack(pady=5)
+
+        # 指示に関連する要素だけをLLMに送るチェックボックス
+        self.relevance_var = tk.BooleanVar(value=False)
+        chk_relevance = tk.Checkbutton(
+            self.root,
+            text="指示に関連する要素のみ送信する",
+            variable=self.relevance_var
+        )
+        chk_relevance.pack(pady=5)
+
+        # requests で別途取得せず、ブラウザで開いたページのDOMをそのまま使うチェックボックス
+        self.live_dom_var = tk.BooleanVar(value=False)
+        chk_live_dom = tk.Checkbutton(
+            self.root,
+            text="ブラウザで描画したDOMを使用する",
+            variable=self.live_dom_var
+        )
+        chk_live_dom.pack(pady=5)
+
+        # LLM の応答を待たずに、生成されたアクションから順に実行するチェックボックス
+        self.stream_var = tk.BooleanVar(value=False)
+        chk_stream = tk.Checkbutton(
+            self.root,
+            text="生成されたアクションから順に実行する",
+            variable=self.stream_var
+        )
+        chk_stream.pack(pady=5)
+
+        # 最初に全手順を計画せず、1操作ごとにページの変化を観察して次の操作を決めるチェックボックス
+        self.agent_loop_var = tk.BooleanVar(value=False)
+        chk_agent_loop = tk.Checkbutton(
+            self.root,
+            text="1操作ずつページを観察しながら実行する",
+            variable=self.agent_loop_var
+        )
+        chk_agent_loop.pack(pady=5)
+
+        # 実行後に取得・解析・LLM・ブラウザ操作ごとの処理時間を操作リストの下に表示するチェックボックス
+        self.trace_var = tk.BooleanVar(value=False)
+        chk_trace = tk.Checkbutton(
+            self.root,
+            text="処理時間の内訳を表示する",
+            variable=self.trace_var
+        )
+        chk_trace.pack(pady=5)
+
+        self.btn_frame = btn_frame = tk.Frame(self.root)
         btn_frame.pack(pady=10)
 
         btn_execute_claude = tk.Button(btn_frame, text="Claudeで実行", command=lambda: self.on_execute("Claude"))
@@ -53,6 +126,14 @@ class WebAgentGUI:
         btn_execute_gpt4o = tk.Button(btn_frame, text="GPT4oで実行", command=lambda: self.on_execute("GPT4o"))
         btn_execute_gpt4o.pack(side=tk.LEFT, padx=10)
 
+        # 両方のモデルに送信し、先に有効な計画を返したほうを使う
+        btn_execute_race = tk.Button(btn_frame, text="レースで実行", command=lambda: self.on_execute(RACE_MODEL))
+        btn_execute_race.pack(side=tk.LEFT, padx=10)
+
+        # 実行中の LLM へのリクエストとブラウザ操作を打ち切る
+        self.btn_stop = tk.Button(btn_frame, text="中止", command=self.on_stop, state=tk.DISABLED)
+        self.btn_stop.pack(side=tk.LEFT, padx=10)
+
         lbl_actions = tk.Label(self.root, text="実行中の操作:")
         lbl_actions.pack(pady=10)
 
@@ -60,11 +141,14 @@ class WebAgentGUI:
             self.root, width=80, height=20, state=tk.DISABLED, font=("Helvetica", 12)
         )
         self.txt_actions.pack(pady=10)
+        self.txt_actions.tag_config("completed", foreground="green")
+        self.txt_actions.tag_config("failed", foreground="red")
+        self.txt_actions.tag_config("cancelled", foreground="gray")
 
         btn_save = tk.Button(self.root, text="保存", command=self.save_actions)
         btn_save.pack(pady=10)
 
-        self.root.after(100, self.process_queue)
+        self.root.after(RENDER_INTERVAL_MS, self.process_queue)
 
     def validate_user_instruction(self, user_instruction: str) -> (bool, str):
         if not user_instruction:
@@ -86,159 +170,282 @@ class WebAgentGUI:
             messagebox.showwarning("入力エラー", message)
             return
 
-        for widget in self.root.winfo_children():
+        for widget in self.root.winfo_children() + self.btn_frame.winfo_children():
             self.set_widget_state(widget, tk.DISABLED)
+        self.set_widget_state(self.btn_stop, tk.NORMAL)
 
-        self.txt_actions.config(state=tk.NORMAL)
-        self.txt_actions.delete("1.0", tk.END)
-        self.txt_actions.config(state=tk.DISABLED)
+        self.clear_action_list()
 
         self.running = True
+        self.cancel_event = threading.Event()
 
         # チャンクフラグを取得
         chunking_enabled = self.chunk_var.get()
+        pruning_enabled = self.prune_var.get()
+        relevance_enabled = self.relevance_var.get()
+        live_dom_enabled = self.live_dom_var.get()
+        streaming_enabled = self.stream_var.get()
+        agent_loop_enabled = self.agent_loop_var.get()
+        trace_summary_enabled = self.trace_var.get()
 
         threading.Thread(
-            target=self.run_execution, args=(model, user_instruction, chunking_enabled), daemon=True
+            target=self.run_execution,
+            args=(model, user_instruction, chunking_enabled, pruning_enabled, relevance_enabled, live_dom_enabled,
+                  streaming_enabled, agent_loop_enabled, trace_summary_enabled, self.cancel_event),
+            daemon=True
         ).start()
 
-    def run_execution(self, model: str, user_instruction: str, chunking_enabled: bool):
+    def on_stop(self):
+        # 送信前のチャンクとリトライは送らず、送信中のリクエストは応答を待たずに結果を捨てる。
+        # ブラウザ操作は次のアクションに進まず、対象のセレクタ待ちもタイムアウトを待たずに打ち切る
+        if not self.running or self.cancel_event is None:
+            return
+        logging.info("実行の中止が要求されました。")
+        self.cancel_event.set()
+        self.set_widget_state(self.btn_stop, tk.DISABLED)
+        self.add_summary_line("中止しています...", "cancelled")
+        self.render_action_list()
+
+    def run_execution(self, model: str, user_instruction: str, chunking_enabled: bool,
+                      pruning_enabled: bool = False, relevance_enabled: bool = False, live_dom_enabled: bool = False,
+                      streaming_enabled: bool = False, agent_loop_enabled: bool = False,
+                      trace_summary_enabled: bool = False, cancel: Optional[threading.Event] = None):
+        with trace_run("gui", self.openai_client.config.TRACE_REPORT_DIR, model=model, chunking=chunking_enabled,
+                       pruning=pruning_enabled, relevance=relevance_enabled, live_dom=live_dom_enabled,
+                       streaming=streaming_enabled, agent_loop=agent_loop_enabled) as trace:
+            self.execute_instruction(model, user_instruction, chunking_enabled, pruning_enabled, relevance_enabled,
+                                     live_dom_enabled, streaming_enabled, agent_loop_enabled, cancel)
+        if trace_summary_enabled:
+            self.queue.put(("trace_summary", trace.summary()))
+
+    def execute_instruction(self, model: str, user_instruction: str, chunking_enabled: bool,
+                            pruning_enabled: bool = False, relevance_enabled: bool = False, live_dom_enabled: bool = False,
+                            streaming_enabled: bool = False, agent_loop_enabled: bool = False,
+                            cancel: Optional[threading.Event] = None):
+        # ワーカースレッドで実行する。ダイアログは notify でメインスレッドに表示させる
+        session = None
         try:
             logging.info(f"ユーザー指示の実行を開始しました。モデル: {model}")
-            actions, raw_response = self.process_instruction(model, user_instruction, chunking_enabled)
-            if not actions:
-                messagebox.showerror("エラー", "アクションの生成に失敗しました。ログを確認してください。")
+            if agent_loop_enabled:
+                self.run_agent_loop(model, user_instruction, cancel)
                 return
-            self.queue.put(("add_actions", actions))
-            self.playwright_controller.perform_actions(
-                actions, self.extract_url(user_instruction), self.action_callback
-            )
-            messagebox.showinfo("完了", "操作が完了しました。")
+            url = self.extract_url(user_instruction)
+            html_content = None
+            if live_dom_enabled and url:
+                # ページを一度だけ開き、DOMの取得とアクションの実行に同じページを使う
+                session = self.playwright_controller.open_session(url)
+                html_content = session.content()
+            stream = None
+            if streaming_enabled:
+                # 生成を待たずに実行を始め、アクションは生成されたものから順に操作リストへ追加する
+                stream = self.pipeline.stream_instruction(
+                    model, user_instruction, chunking_enabled, pruning_enabled, relevance_enabled, html_content, cancel
+                )
+                if stream is None:
+                    self.notify_failure(cancel)
+                    return
+                actions = self.queue_streamed_actions(stream)
+            else:
+                actions, raw_response = self.pipeline.process_instruction(
+                    model, user_instruction, chunking_enabled, pruning_enabled, relevance_enabled, html_content, cancel
+                )
+                if not actions:
+                    self.notify_failure(cancel)
+                    return
+                self.queue.put(("add_actions", actions))
+            if session:
+                wait_metrics = session.perform_actions(actions, self.action_callback, cancel=cancel)
+            else:
+                wait_metrics = self.playwright_controller.perform_actions(actions, url, self.action_callback, cancel)
+            self.queue.put(("wait_metrics", wait_metrics or []))
+            if is_cancelled(cancel):
+                self.notify_cancelled()
+                return
+            if stream is not None and not stream.actions:
+                self.notify_failure(cancel)
+                return
+            self.notify(messagebox.showinfo, "完了", "操作が完了しました。")
             logging.info("ユーザー指示の実行が完了しました。")
         except Exception as e:
             logging.error(f"実行中にエラーが発生しました: {e}")
-            messagebox.showerror("エラー", f"実行中にエラーが発生しました: {e}")
+            self.notify(messagebox.showerror, "エラー", f"実行中にエラーが発生しました: {e}")
         finally:
-            self.running = False
-            self.root.after(0, lambda: self.enable_widgets())
+            if session:
+                session.close()
+            # ウィジェットの操作はメインスレッドで行うため、終了もキュー経由で伝える
+            self.queue.put(("finished",))
+
+    def run_agent_loop(self, model: str, user_instruction: str, cancel: Optional[threading.Event] = None):
+        # 操作は決まったものから順に操作リストへ追加する
+        result = self.agent_loop.run(
+            model, user_instruction, self.action_callback,
+            on_action=lambda index, action: self.queue.put(("add_action", index, action)),
+            cancel=cancel
+        )
+        self.queue.put(("wait_metrics", result["wait_metrics"]))
+        if result["cancelled"]:
+            self.notify_cancelled()
+            return
+        if not result["actions"] and not result["done"]:
+            self.notify_failure(cancel)
+            return
+        self.notify(messagebox.showinfo, "完了", f"操作が完了しました。({result['steps']}ステップ)")
+        logging.info("ユーザー指示の実行が完了しました。")
+
+    def notify(self, show, title: str, message: str):
+        # messagebox はメインスレッドからしか呼べないため、キュー経由で表示する
+        self.queue.put(("dialog", show, title, message))
+
+    def notify_failure(self, cancel: Optional[threading.Event] = None):
+        if is_cancelled(cancel):
+            self.notify_cancelled()
+            return
+        self.notify(messagebox.showerror, "エラー", "アクションの生成に失敗しました。ログを確認してください。")
+
+    def notify_cancelled(self):
+        logging.info("ユーザー指示の実行を中止しました。")
+        self.queue.put(("cancelled",))
+        self.notify(messagebox.showinfo, "中止", "操作を中止しました。")
 
     def enable_widgets(self):
-        for widget in self.root.winfo_children():
+        for widget in self.root.winfo_children() + self.btn_frame.winfo_children():
             self.set_widget_state(widget, tk.NORMAL)
+        self.set_widget_state(self.btn_stop, tk.DISABLED)
 
     def extract_url(self, user_instruction: str) -> str:
-        url_match = re.search(r'https?://\S+', user_instruction)
-        return url_match.group() if url_match else ""
+        return extract_url(user_instruction)
 
-    def process_instruction(self, model: str, user_instruction: str, chunking_enabled: bool):
-        url = self.extract_url(user_instruction)
-        task = user_instruction.replace(url, "") if url else user_instruction
-
-        dom_elements = []
-        if url:
-            logging.info(f"指定されたURLからHTMLコンテンツを取得します: {url}")
-            try:
-                response = requests.get(url, timeout=60)
-                response.raise_for_status()
-                html_content = response.text
-                logging.info("HTMLコンテンツの取得に成功しました。")
-            except requests.exceptions.Timeout:
-                logging.error(f"タイムアウトエラー: URL '{url}' のページをロードできませんでした。")
-                return [], ""
-            except requests.exceptions.RequestException as e:
-                logging.error(f"HTMLコンテンツの取得に失敗しました: {e}")
-                return [], ""
-
-            dom_elements = DOMParser.parse(html_content or "")
-            
-            if chunking_enabled:
-                chunks = self.chunk_dom_elements(dom_elements, max_chunk_size=100000)
-            else:
-                chunks = [dom_elements]  # チャンク処理を無効にする場合、全体を一つのチャンクとして扱う
-
-            all_actions = []
-            for i, chunk in enumerate(chunks, start=1):
-                logging.info(f"チャンク {i} を処理しています。")
-                actions, raw_response = self.openai_client.generate_actions(model, task, chunk)
-                if actions:
-                    all_actions.extend(actions)
-                else:
-                    logging.warning(f"チャンク {i} でアクションの生成に失敗しました。")
-
-            if not all_actions:
-                logging.error("すべてのチャンクでアクションの生成に失敗しました。")
-                return [], ""
-
-            logging.info(f"全チャンクから生成されたアクションの総数: {len(all_actions)}")
-            return all_actions, ""
-        else:
-            actions, raw_response = self.openai_client.generate_actions(model, task, dom_elements)
-            if raw_response:
-                logging.debug(f"APIからの生のレスポンス: {raw_response}")
-            logging.info(f"生成されたアクション: {actions}")
-            return actions, raw_response
+    def queue_streamed_actions(self, stream: ActionStream) -> Iterator[dict]:
+        # 実行する直前に操作リストへ追加し、ステータス更新の行と対応させる
+        for index, action in enumerate(stream, start=1):
+            self.queue.put(("add_action", index, action))
+            yield action
 
     def action_callback(self, index, action, selector, value, code_snippet='', success=True):
         if success:
             status = "完了"
             self.queue.put((index, status, code_snippet))
-            logging.debug(f"アクション {index}: {action} - {status} - {code_snippet}")
+            logging.debug("アクション %s: %s - %s - %s", index, action, status, code_snippet)
         else:
             status = "失敗"
             self.queue.put((index, status, "不明なエラー"))
-            logging.debug(f"アクション {index}: {action} - {status} - 不明なエラー")
+            logging.debug("アクション %s: %s - %s - 不明なエラー", index, action, status)
 
     def process_queue(self):
+        # 溜まったメッセージをまとめて取り出して行の内容に反映し、Text への描画は1回で行う
         try:
-            while True:
+            for _ in range(RENDER_BATCH_LIMIT):
                 message = self.queue.get_nowait()
                 if isinstance(message, tuple):
                     if message[0] == "add_actions":
                         actions = message[1]
                         self.add_actions_to_list(actions)
+                    elif message[0] == "add_action":
+                        self.add_action_to_list(message[1], message[2])
+                    elif message[0] == "wait_metrics":
+                        self.add_wait_summary(message[1])
+                    elif message[0] == "trace_summary":
+                        self.add_trace_summary(message[1])
+                    elif message[0] == "dialog":
+                        self.pending_dialogs.append(message[1:])
+                    elif message[0] == "cancelled":
+                        self.add_summary_line("実行を中止しました。", "cancelled")
+                    elif message[0] == "finished":
+                        self.running = False
+                        self.enable_widgets()
                     elif len(message) == 3:
                         index, status, info = message
                         self.update_action_status(index, status, info)
         except queue.Empty:
             pass
         finally:
-            self.root.after(100, self.process_queue)
+            self.render_action_list()
+            # 取り出しきれなかった場合はすぐに続きを処理する
+            self.root.after(RENDER_INTERVAL_MS if self.queue.empty() else 1, self.process_queue)
+            self.show_pending_dialog()
+
+    def show_pending_dialog(self):
+        # ダイアログの表示中も描画は続くため、表示中に届いたダイアログは閉じた後に順に表示する
+        if self._dialog_open:
+            return
+        self._dialog_open = True
+        try:
+            while self.pending_dialogs:
+                show, title, message = self.pending_dialogs.popleft()
+                show(title, message)
+        finally:
+            self._dialog_open = False
 
-    def add_actions_to_list(self, actions: List[dict]):
-        logging.debug("add_actions_to_list が呼び出されました。")
+    def clear_action_list(self):
+        self.action_lines.clear()
+        self.summary_lines.clear()
+        self._dirty_from = None
         self.txt_actions.config(state=tk.NORMAL)
-        for index, action in enumerate(actions, start=1):
-            act = action.get("action")
-            sel = action.get("selector")
-            val = action.get("value")
-            action_text = f"{index}. {act} - Selector: {sel}, Value: {val}"
-            self.txt_actions.insert(tk.END, action_text + "\n")
+        self.txt_actions.delete("1.0", tk.END)
+        self.txt_actions.config(state=tk.DISABLED)
+
+    def set_action_line(self, index: int, text: str, tag: Optional[str] = None):
+        while len(self.action_lines) < index:
+            self.action_lines.append(("", None))
+        self.action_lines[index - 1] = (text, tag)
+        self._mark_dirty(index - 1)
+
+    def add_summary_line(self, text: str, tag: Optional[str] = None):
+        self.summary_lines.append((text, tag))
+        self._mark_dirty(len(self.action_lines) + len(self.summary_lines) - 1)
+
+    def _mark_dirty(self, position: int):
+        if self._dirty_from is None or position < self._dirty_from:
+            self._dirty_from = position
+
+    def render_action_list(self):
+        # 変更のあった最初の行から末尾までを、1回の削除と1回の挿入で描き直す
+        if self._dirty_from is None:
+            return
+        lines = self.action_lines + self.summary_lines
+        start = self._dirty_from
+        self._dirty_from = None
+        # 値に改行を含む行もあるため、Text 上の行番号は前の行の改行の数から求める
+        line_number = 1 + sum(text.count("\n") + 1 for text, _ in lines[:start])
+        chunks = []
+        for text, tag in lines[start:]:
+            chunks.extend((text + "\n", tag or ()))
+        self.txt_actions.config(state=tk.NORMAL)
+        self.txt_actions.delete(f"{line_number}.0", tk.END)
+        if chunks:
+            self.txt_actions.insert(tk.END, *chunks)
         self.txt_actions.config(state=tk.DISABLED)
         self.txt_actions.see(tk.END)
+
+    def add_actions_to_list(self, actions: List[dict]):
+        logging.debug("add_actions_to_list が呼び出されました。")
+        for index, action in enumerate(actions, start=1):
+            self.add_action_to_list(index, action)
         logging.debug("操作リストにアクションが追加されました。")
 
-    def update_action_status(self, index: int, status: str, info: str = None):
-        logging.debug(f"update_action_status が呼び出されました。ステップ: {index}, ステータス: {status}, 情報: {info}")
-        self.txt_actions.config(state=tk.NORMAL)
+    def add_action_to_list(self, index: int, action: dict):
+        act = action.get("action")
+        sel = action.get("selector")
+        val = action.get("value")
+        self.set_action_line(index, f"{index}. {act} - Selector: {sel}, Value: {val}")
 
-        line_start_pos = f"{index}.0"
-        line_end_pos = f"{index}.end"
+    def add_wait_summary(self, wait_metrics: List[dict]):
+        if not wait_metrics:
+            return
+        total_wait = sum(metric["wait_seconds"] for metric in wait_metrics)
+        total_elapsed = sum(metric["elapsed_seconds"] for metric in wait_metrics)
+        self.add_summary_line(f"待機時間の合計: {total_wait:.2f}秒 / 実行時間の合計: {total_elapsed:.2f}秒")
+
+    def add_trace_summary(self, summary: str):
+        self.add_summary_line(summary)
 
+    def update_action_status(self, index: int, status: str, info: str = None):
+        logging.debug("update_action_status が呼び出されました。ステップ: %s, ステータス: %s, 情報: %s", index, status, info)
         if status == "完了":
-            tag_name = f"completed_{index}"
-            self.txt_actions.tag_config(tag_name, foreground="green")
             action_text = f"{index}. 完了: {info}"
         else:
-            tag_name = f"failed_{index}"
-            self.txt_actions.tag_config(tag_name, foreground="red")
             action_text = f"{index}. 失敗: {info or '不明なエラー'}"
-
-        self.txt_actions.delete(f"{index}.0", f"{index}.end")
-        self.txt_actions.insert(f"{index}.0", action_text + "\n")
-        self.txt_actions.tag_add(tag_name, line_start_pos, f"{index}.end")
-
-        self.txt_actions.config(state=tk.DISABLED)
-        logging.debug(f"ステップ {index} が {status} に色付けされました。")
+        self.set_action_line(index, action_text, STATUS_TAGS.get(status, "failed"))
 
     def save_actions(self):
         actions_text = self.txt_actions.get("1.0", tk.END).strip()
@@ -255,25 +462,3 @@ class WebAgentGUI:
 
     def start(self):
         self.root.mainloop()
-
-    def chunk_dom_elements(self, dom_elements: list, max_chunk_size: int = 10000) -> list:
-        chunks = []
-        current_chunk = []
-        current_size = 0
-
-        for element in dom_elements:
-            element_str = json.dumps(element, ensure_ascii=False)
-            element_size = len(element_str)
-            if current_size + element_size > max_chunk_size:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                    current_chunk = []
-                    current_size = 0
-            current_chunk.append(element)
-            current_size += element_size
-
-        if current_chunk:
-            chunks.append(current_chunk)
-
-        logging.info(f"dom_elementsを{len(chunks)}チャンクに分割しました。")
-        return chunks
@@ -1,30 +1,80 @@
+import argparse
 import logging
+import sys
 from config import Config
 from clients.openai_client import OpenAIClient
 from controllers.playwright_controller import PlaywrightController
-from gui.web_agent_gui import WebAgentGUI
 from utils.logger import setup_logging
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="WebAgentAI")
+    parser.add_argument("--batch", metavar="JOBS_JSONL", help="GUI を起動せず、JSONL のジョブをまとめて実行する")
+    parser.add_argument("--output", default="batch_results.jsonl", help="バッチ実行の結果を書き出す JSONL")
+    parser.add_argument("--model", default="Claude", choices=["Claude", "GPT4o", "Race"], help="バッチ実行で使うモデル")
+    parser.add_argument("--concurrency", type=int, help="並列に実行するブラウザ数 (既定: BATCH_CONCURRENCY)")
+    parser.add_argument("--timeout", type=float, help="1ジョブあたりのタイムアウト秒数 (既定: BATCH_JOB_TIMEOUT_SECONDS)")
+    parser.add_argument("--no-chunk", action="store_true", help="チャンク処理を無効にする")
+    parser.add_argument("--prune", action="store_true", help="操作可能な要素のみ送信する")
+    parser.add_argument("--relevance", action="store_true", help="指示に関連する要素のみ送信する")
+    parser.add_argument("--live-dom", action="store_true", help="ブラウザで描画したDOMを使用する")
+    parser.add_argument("--headed", action="store_true", help="バッチ実行でもブラウザを表示する")
+    return parser.parse_args(argv)
+
+def run_batch(config: Config, openai_client: OpenAIClient, args) -> int:
+    from runner.batch_runner import BatchRunner, load_jobs
+
+    try:
+        jobs = load_jobs(args.batch)
+    except OSError as e:
+        print(f"ジョブファイルを読み込めませんでした: {e}")
+        return 1
+    runner = BatchRunner(
+        openai_client,
+        controller_factory=lambda: PlaywrightController.from_config(config, headless=not args.headed),
+        model=args.model,
+        concurrency=args.concurrency or config.BATCH_CONCURRENCY,
+        job_timeout=args.timeout or config.BATCH_JOB_TIMEOUT_SECONDS,
+        chunking_enabled=not args.no_chunk,
+        pruning_enabled=args.prune,
+        relevance_enabled=args.relevance,
+        live_dom_enabled=args.live_dom
+    )
+    summary = runner.run(jobs, args.output)
+    print(f"バッチ実行が完了しました: {summary} (結果: {args.output})")
+    return 0 if summary.get("success", 0) == summary["total"] else 1
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
     try:
         config = Config()
     except ValueError as e:
         print(f"設定エラー: {e}")
-        return
+        return 1
 
-    setup_logging()
+    setup_logging(config)
 
     openai_client = OpenAIClient(config)
 
+    if args.batch:
+        return run_batch(config, openai_client, args)
+
     try:
-        playwright_controller = PlaywrightController()
+        playwright_controller = PlaywrightController.from_config(config)
     except Exception as e:
         logging.error(f"Playwrightの初期化に失敗しました: {e}")
         print(f"Playwrightの初期化に失敗しました: {e}")
-        return
+        return 1
+
+    # tkinter のないCI環境でもバッチ実行できるよう、GUI はここで読み込む
+    from gui.web_agent_gui import WebAgentGUI
 
     gui = WebAgentGUI(openai_client, playwright_controller)
-    gui.start()
+    try:
+        gui.start()
+    finally:
+        # GUI を閉じたら常駐しているブラウザを終了する
+        playwright_controller.shutdown()
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
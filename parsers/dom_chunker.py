@@ -0,0 +1,89 @@
+# parsers/dom_chunker.py
+
+import json
+import logging
+from typing import List, Optional
+
+from utils.token_estimator import estimate_tokens
+from .dom_element import element_to_dict
+from .dom_encoder import encode_elements, encode_json, join_encoded, format_note
+
+SAVINGS_SAMPLE_SIZE = 500
+
+class DOMChunk(list):
+    # 要素のリストとして振る舞いつつ、各要素を一度だけシリアライズした結果を保持する
+    def __init__(self, elements=(), serialized: Optional[List[str]] = None, tokens: Optional[List[int]] = None,
+                 encoding: str = "json"):
+        super().__init__(elements)
+        self.encoding = encoding
+        if serialized is None:
+            serialized = encode_elements(self, encoding)
+            tokens = [estimate_tokens(s) for s in serialized]
+            log_encoding_savings(self, tokens, encoding)
+        self.serialized = serialized
+        self.tokens = sum(tokens) if tokens is not None else sum(estimate_tokens(s) for s in serialized)
+
+    def payload(self) -> str:
+        return join_encoded(self.serialized, self.encoding)
+
+def serialize_dom_elements(dom_elements: list) -> str:
+    if isinstance(dom_elements, DOMChunk):
+        return dom_elements.payload()
+    return json.dumps(dom_elements, ensure_ascii=False, default=element_to_dict)
+
+def dom_format_note(dom_elements: list) -> str:
+    return format_note(dom_elements.encoding) if isinstance(dom_elements, DOMChunk) else ""
+
+def log_encoding_savings(dom_elements: list, tokens: List[int], encoding: str):
+    # JSON との比較は先頭の一部の要素で見積もり、全体に換算する
+    if encoding == "json" or not dom_elements:
+        return
+    sample = min(len(dom_elements), SAVINGS_SAMPLE_SIZE)
+    json_tokens = sum(estimate_tokens(encode_json(e)) for e in dom_elements[:sample])
+    encoded_tokens = sum(tokens[:sample])
+    if not json_tokens:
+        return
+    estimated_json_total = int(json_tokens * len(dom_elements) / sample)
+    saving = 1 - encoded_tokens / json_tokens
+    logging.info(
+        f"DOMのエンコード: {encoding} 推定{sum(tokens)}トークン / JSON 推定{estimated_json_total}トークン "
+        f"({saving:.0%} 削減)"
+    )
+
+def chunk_dom_elements(dom_elements: list, token_budget: int, encoding: str = "json") -> List[DOMChunk]:
+    count = len(dom_elements)
+    serialized = encode_elements(dom_elements, encoding)
+    tokens = [estimate_tokens(s) for s in serialized]
+    log_encoding_savings(dom_elements, tokens, encoding)
+
+    # 文書順では部分木が連続するため、各要素の部分木の終端とトークン数を後ろから集計する
+    index_by_dom_id = {element['dom_id']: i for i, element in enumerate(dom_elements)}
+    subtree_end = list(range(1, count + 1))
+    subtree_tokens = list(tokens)
+    for i in range(count - 1, -1, -1):
+        parent = index_by_dom_id.get(dom_elements[i].get('parent_id'))
+        if parent is not None and parent < i:
+            subtree_end[parent] = max(subtree_end[parent], subtree_end[i])
+            subtree_tokens[parent] += subtree_tokens[i]
+
+    # 予算に収まる部分木はまとめて1単位とし、収まらない場合は要素単体にして子の部分木へ降りる
+    chunks = []
+    start = 0
+    current_tokens = 0
+    i = 0
+    while i < count:
+        if subtree_tokens[i] <= token_budget:
+            unit_end, unit_tokens = subtree_end[i], subtree_tokens[i]
+        else:
+            unit_end, unit_tokens = i + 1, tokens[i]
+        if current_tokens + unit_tokens > token_budget and i > start:
+            chunks.append(DOMChunk(dom_elements[start:i], serialized[start:i], tokens[start:i], encoding))
+            start = i
+            current_tokens = 0
+        current_tokens += unit_tokens
+        i = unit_end
+    if start < count:
+        chunks.append(DOMChunk(dom_elements[start:], serialized[start:], tokens[start:], encoding))
+
+    logging.info(f"dom_elementsを{len(chunks)}チャンクに分割しました。(1チャンクあたり最大{token_budget}トークン)")
+    return chunks
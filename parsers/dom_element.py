@@ -0,0 +1,88 @@
+# parsers/dom_element.py
+
+import sys
+from types import MappingProxyType
+from typing import Optional
+
+# 属性を持たない要素で共有する空の属性
+EMPTY_ATTRIBUTES = MappingProxyType({})
+
+_FIELDS = ('dom_id', 'tag', 'attributes', 'text', 'parent_id', 'label')
+_FIELD_SET = frozenset(_FIELDS)
+
+class DOMElement:
+    # 解析済みの要素1つ分。要素ごとに dict を作らないよう __slots__ で保持し、
+    # 既存の処理からは element['tag'] や element.get('attributes', {}) のように dict と同じく参照できる。
+    # label はプルーニング時にだけ設定され、未設定の場合はキーがないものとして扱う
+    __slots__ = _FIELDS
+
+    def __init__(self, dom_id: int, tag: str, attributes=EMPTY_ATTRIBUTES, text: str = '',
+                 parent_id: Optional[int] = None, label: Optional[str] = None):
+        self.dom_id = dom_id
+        self.tag = tag
+        self.attributes = attributes
+        self.text = text
+        self.parent_id = parent_id
+        self.label = label
+
+    def __getitem__(self, key: str):
+        if key in _FIELD_SET and (key != 'label' or self.label is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key not in _FIELD_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in _FIELD_SET and (key != 'label' or self.label is not None)
+
+    def get(self, key: str, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return [key for key in _FIELDS if key in self]
+
+    def to_dict(self) -> dict:
+        # シリアライズ時にだけ dict に変換する。キーの順序は従来の dict と同じ
+        record = {
+            'dom_id': self.dom_id,
+            'tag': self.tag,
+            'attributes': self.attributes if isinstance(self.attributes, dict) else dict(self.attributes),
+            'text': self.text,
+            'parent_id': self.parent_id,
+        }
+        if self.label is not None:
+            record['label'] = self.label
+        return record
+
+    def to_row(self) -> list:
+        # キャッシュに保存するための配列。from_row で元に戻す
+        return [self.dom_id, self.tag, self.attributes or None, self.text, self.parent_id, self.label]
+
+    @classmethod
+    def from_row(cls, row: list) -> "DOMElement":
+        # 解析時と同じく、タグ名・属性名・クラス名は intern して共有する
+        dom_id, tag, attributes, text, parent_id, label = row
+        if attributes:
+            attributes = {
+                sys.intern(key): [sys.intern(token) for token in value] if isinstance(value, list) else value
+                for key, value in attributes.items()
+            }
+        else:
+            attributes = EMPTY_ATTRIBUTES
+        return cls(dom_id, sys.intern(tag), attributes, text, parent_id, label)
+
+    def __repr__(self) -> str:
+        return f"DOMElement({self.to_dict()!r})"
+
+def element_to_dict(value):
+    # json.dumps の default として使う
+    if isinstance(value, DOMElement):
+        return value.to_dict()
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
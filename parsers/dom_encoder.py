@@ -0,0 +1,104 @@
+# parsers/dom_encoder.py
+
+import json
+from typing import List
+
+from .dom_element import DOMElement
+
+ENCODINGS = ("json", "outline")
+
+# outline 形式で出力する属性。セレクタの組み立てやラベルの判断に使うものに限る
+OUTLINE_ATTRIBUTES = (
+    "id", "name", "type", "role", "href", "value", "placeholder", "aria-label", "title", "alt", "for",
+    "data-testid", "action", "src",
+)
+# 値を省略して有無だけを出力する属性
+OUTLINE_FLAGS = ("onclick", "contenteditable", "tabindex", "disabled", "checked", "selected", "required", "readonly")
+OUTLINE_VALUE_LIMIT = 40
+OUTLINE_TEXT_LIMIT = 80
+OUTLINE_MAX_INDENT = 20
+
+OUTLINE_FORMAT_NOTE = (
+    "DOM要素は1行1要素で `#dom_id タグ.クラス[属性=値] \"テキスト\" label=\"ラベル\"` の形式です。"
+    "行頭のインデントは親子関係を表します。"
+)
+
+def _truncate(value: str, limit: int) -> str:
+    return value if len(value) <= limit else value[:limit] + "…"
+
+def _quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ") + '"'
+
+def _attribute_value(value: str) -> str:
+    value = _truncate(value, OUTLINE_VALUE_LIMIT)
+    if not value or any(c in value for c in ' "]=\n'):
+        return _quote(value)
+    return value
+
+def encode_json(element: dict, depth: int = 0, inherited: bool = False) -> str:
+    return json.dumps(element.to_dict() if isinstance(element, DOMElement) else element, ensure_ascii=False)
+
+def encode_outline(element: dict, depth: int = 0, inherited: bool = False) -> str:
+    attributes = element.get("attributes", {})
+    parts = [" " * min(depth, OUTLINE_MAX_INDENT), f"#{element['dom_id']} ", element.get("tag", "")]
+    classes = attributes.get("class")
+    if classes:
+        class_list = classes if isinstance(classes, list) else str(classes).split()
+        parts.append("".join(f".{c}" for c in class_list[:3]))
+    for name in OUTLINE_ATTRIBUTES:
+        value = attributes.get(name)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = " ".join(value)
+        parts.append(f"[{name}={_attribute_value(str(value))}]")
+    for name in OUTLINE_FLAGS:
+        if name in attributes:
+            parts.append(f"[{name}]")
+    text = element.get("text")
+    # 子要素のテキストを連結しただけのテキストは子の行に任せて省略する
+    if text and not inherited:
+        parts.append(" " + _quote(_truncate(text, OUTLINE_TEXT_LIMIT)))
+    label = element.get("label")
+    if label:
+        parts.append(" label=" + _quote(_truncate(label, OUTLINE_TEXT_LIMIT)))
+    return "".join(parts)
+
+ENCODERS = {"json": encode_json, "outline": encode_outline}
+
+def element_depths(dom_elements: list) -> List[int]:
+    depth_by_dom_id = {}
+    depths = []
+    for element in dom_elements:
+        depth = depth_by_dom_id.get(element.get("parent_id"), -1) + 1
+        depth_by_dom_id[element["dom_id"]] = depth
+        depths.append(depth)
+    return depths
+
+def inherited_text_flags(dom_elements: list) -> List[bool]:
+    # テキストが子要素のテキストの連結と一致する (自身の直下にテキストを持たない) 要素を判定する
+    child_texts = {}
+    for element in dom_elements:
+        if element.get("parent_id") is not None and element.get("text"):
+            child_texts.setdefault(element["parent_id"], []).append(element["text"])
+    return [
+        element["dom_id"] in child_texts and "".join(child_texts[element["dom_id"]]).startswith(element.get("text", ""))
+        for element in dom_elements
+    ]
+
+def encode_elements(dom_elements: list, encoding: str = "json") -> List[str]:
+    encoder = ENCODERS[encoding]
+    if encoding == "json":
+        return [encoder(element) for element in dom_elements]
+    return [
+        encoder(element, depth, inherited)
+        for element, depth, inherited in zip(dom_elements, element_depths(dom_elements), inherited_text_flags(dom_elements))
+    ]
+
+def join_encoded(serialized: List[str], encoding: str = "json") -> str:
+    if encoding == "outline":
+        return "\n".join(serialized)
+    return "[" + ",".join(serialized) + "]"
+
+def format_note(encoding: str) -> str:
+    return OUTLINE_FORMAT_NOTE if encoding == "outline" else ""
@@ -0,0 +1,93 @@
+# parsers/dom_index.py
+
+import logging
+import math
+import re
+from collections import Counter, defaultdict
+from typing import List, Optional
+
+from .dom_encoder import inherited_text_flags
+
+_CJK_RANGE = '\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uff66-\uff9f'
+_WORD = re.compile(rf'[a-z0-9]+|[{_CJK_RANGE}]+')
+_CJK = re.compile(rf'[{_CJK_RANGE}]')
+
+
+def tokenize(text: str) -> List[str]:
+    # 英数字は単語単位、日本語は分かち書きせず文字bigramで扱う
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        if _CJK.match(word):
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def element_terms(element: dict, include_text: bool = True) -> List[str]:
+    parts = [element.get('tag', ''), element.get('text', '') if include_text else '', element.get('label', '')]
+    for value in element.get('attributes', {}).values():
+        parts.append(' '.join(value) if isinstance(value, list) else str(value))
+    # camelCase の属性値 (loginButton 等) も単語に分割する
+    return tokenize(re.sub(r'([a-z])([A-Z])', r'\1 \2', ' '.join(parts)))
+
+
+class DOMRelevanceIndex:
+    def __init__(self, dom_elements: list, k1: float = 1.2, b: float = 0.75):
+        self.elements = dom_elements
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        # 子要素のテキストを連結しただけの祖先要素はテキストを索引せず、上位候補が外側の要素で埋まるのを防ぐ
+        for index, (element, inherited) in enumerate(zip(dom_elements, inherited_text_flags(dom_elements))):
+            terms = Counter(element_terms(element, include_text=not inherited))
+            self.lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings[term].append((index, frequency))
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    def idf(self, term: str) -> float:
+        document_frequency = len(self.postings.get(term, ()))
+        total = len(self.elements)
+        return math.log(1 + (total - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def score(self, query: str) -> dict:
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for index, frequency in postings:
+                norm = 1 - self.b + self.b * self.lengths[index] / (self.average_length or 1.0)
+                scores[index] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+        return scores
+
+    def select(self, query: str, top_k: int = 30, min_score: float = 1.0) -> Optional[list]:
+        # 上位 top_k 件とその祖先要素を文書順で返す。信頼度が低い場合は None を返す
+        scores = self.score(query)
+        if not scores:
+            logging.info("関連要素が見つかりませんでした。全要素を送信します。")
+            return None
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        top_score = ranked[0][1]
+        if top_score < min_score:
+            logging.info(f"関連度が低いため全要素を送信します。最高スコア: {top_score:.2f}")
+            return None
+        if len(ranked) > top_k and ranked[top_k][1] >= top_score * 0.9:
+            logging.info(f"上位{top_k}件で候補を絞り込めないため全要素を送信します。")
+            return None
+
+        by_dom_id = {element['dom_id']: element for element in self.elements}
+        selected = {}
+        for index, _ in ranked[:top_k]:
+            element = self.elements[index]
+            while element is not None and element['dom_id'] not in selected:
+                selected[element['dom_id']] = element
+                element = by_dom_id.get(element.get('parent_id'))
+        logging.info(f"関連要素を{len(selected)}件に絞り込みました。最高スコア: {top_score:.2f}")
+        return [selected[dom_id] for dom_id in sorted(selected)]
@@ -1,21 +1,284 @@
 # parsers/dom_parser.py
 
 import logging
-import json
-from bs4 import BeautifulSoup
+import re
+import sys
+from html.parser import HTMLParser
+
+from .dom_element import EMPTY_ATTRIBUTES, DOMElement
+
+TEXT_LIMIT = 100
+
+# BeautifulSoup(html.parser) と同じ空要素・複数値属性・文字列コンテナの定義
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+    'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+    'image', 'isindex', 'nextid', 'spacer',
+])
+MULTI_VALUED_ATTRIBUTES = {
+    '*': frozenset(['class', 'accesskey', 'dropzone']),
+    'a': frozenset(['rel', 'rev']),
+    'link': frozenset(['rel', 'rev']),
+    'td': frozenset(['headers']),
+    'th': frozenset(['headers']),
+    'form': frozenset(['accept-charset']),
+    'object': frozenset(['archive']),
+    'area': frozenset(['rel']),
+    'icon': frozenset(['sizes']),
+    'iframe': frozenset(['sandbox']),
+    'output': frozenset(['for']),
+}
+_MULTI_VALUED_BY_TAG = {
+    tag: names | MULTI_VALUED_ATTRIBUTES['*'] for tag, names in MULTI_VALUED_ATTRIBUTES.items()
+}
+STRING_CONTAINERS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+
+# プルーニング時に残す操作可能な要素の定義
+INTERACTIVE_TAGS = frozenset(['a', 'button', 'input', 'select', 'textarea', 'summary'])
+INTERACTIVE_ROLES = frozenset([
+    'button', 'link', 'checkbox', 'radio', 'switch', 'tab', 'menuitem', 'menuitemcheckbox',
+    'menuitemradio', 'option', 'treeitem', 'textbox', 'searchbox', 'combobox', 'listbox',
+    'slider', 'spinbutton',
+])
+INTERACTIVE_ATTRIBUTES = frozenset(['onclick', 'onmousedown', 'onmouseup', 'ng-click', '@click', 'v-on:click'])
+
+_NON_WHITESPACE = re.compile(r'\S+')
+
+
+def is_interactive(tag: str, attributes: dict) -> bool:
+    if tag == 'input':
+        return attributes.get('type', '').lower() != 'hidden'
+    if tag == 'a':
+        # href のない a はリンクとして扱わず、role や tabindex などの共通の判定に任せる
+        if 'href' in attributes:
+            return True
+    elif tag in INTERACTIVE_TAGS:
+        return True
+    if attributes.get('role', '').lower() in INTERACTIVE_ROLES:
+        return True
+    if attributes.get('contenteditable', 'false').lower() != 'false':
+        return True
+    if attributes.get('tabindex', '-1').strip() not in ('', '-1'):
+        return True
+    return any(name in attributes for name in INTERACTIVE_ATTRIBUTES)
+
+
+class _OpenElement:
+    __slots__ = ('record', 'parts', 'length')
+
+    def __init__(self, record: DOMElement):
+        self.record = record
+        self.parts = []
+        self.length = 0
+
+
+class _SinglePassParser(HTMLParser):
+    def __init__(self, prune: bool = False):
+        super().__init__(convert_charrefs=True)
+        self.elements = []
+        self.prune = prune
+        self.total_elements = 0
+        self._stack = []
+        self._containers = []
+        self._data = []
+        self._closed_void = []
+        # プルーニング用: 開いている label 要素、直前のテキスト、操作可能要素とそのラベル候補
+        self._labels = []
+        self._labels_by_for = {}
+        self._last_text = ''
+        self._interactive = []
+        self._kept_stack = []
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        self._open(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            self._close(tag)
+            self._closed_void.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush()
+        self._open(tag, attrs)
+        self._close(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_void:
+            # 閉じ済みの空要素の終了タグは無視し、前後のテキストも分断しない
+            self._closed_void.remove(tag)
+        else:
+            self._flush()
+            self._close(tag)
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def unknown_decl(self, data):
+        self._flush()
+        if data.upper().startswith('CDATA['):
+            self._data.append(data[len('CDATA['):])
+            self._flush()
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def close(self):
+        super().close()
+        self._flush()
+        while self._stack:
+            self._finish(self._stack.pop())
+        self._containers.clear()
+        self._labels.clear()
+        self._kept_stack.clear()
+        self.total_elements = len(self.elements)
+        if self.prune:
+            self.elements = self._pruned_elements()
+
+    def _open(self, tag, attrs):
+        # タグ名・属性名・クラス名は同じ文字列が繰り返し現れるため intern して共有する
+        tag = sys.intern(tag)
+        attributes = EMPTY_ATTRIBUTES
+        if attrs:
+            multi_valued = _MULTI_VALUED_BY_TAG.get(tag, MULTI_VALUED_ATTRIBUTES['*'])
+            attributes = {}
+            for key, value in attrs:
+                if value is None:
+                    value = ''
+                if key in multi_valued:
+                    value = [sys.intern(token) for token in _NON_WHITESPACE.findall(value)]
+                attributes[sys.intern(key)] = value
+        record = DOMElement(len(self.elements), tag, attributes, '', self._stack[-1].record.dom_id if self._stack else None)
+        self.elements.append(record)
+        opened = _OpenElement(record)
+        self._stack.append(opened)
+        if tag in STRING_CONTAINERS:
+            self._containers.append(opened)
+        if self.prune:
+            if tag == 'label':
+                self._labels.append(opened)
+                if attributes.get('for'):
+                    self._labels_by_for.setdefault(attributes['for'], record)
+            if is_interactive(tag, attributes):
+                enclosing_label = self._labels[-1].record if self._labels else None
+                kept_parent = self._kept_stack[-1].record.dom_id if self._kept_stack else None
+                self._interactive.append((record, enclosing_label, self._last_text, kept_parent))
+                self._kept_stack.append(opened)
+
+    def _close(self, tag):
+        # 開いている同名タグまでを閉じる。該当がなければ無視する（BeautifulSoup と同じ挙動）
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i].record.tag == tag:
+                break
+        else:
+            return
+        while len(self._stack) > i:
+            opened = self._stack.pop()
+            if self._containers and self._containers[-1] is opened:
+                self._containers.pop()
+            if self._labels and self._labels[-1] is opened:
+                self._labels.pop()
+            if self._kept_stack and self._kept_stack[-1] is opened:
+                self._kept_stack.pop()
+            self._finish(opened)
+
+    def _finish(self, opened: _OpenElement):
+        if opened.parts:
+            opened.record.text = ''.join(opened.parts)[:TEXT_LIMIT]
+
+    def _flush(self):
+        if not self._data:
+            return
+        text = ''.join(self._data).strip()
+        self._data.clear()
+        if not text:
+            return
+        if self._containers:
+            # script/style 等の文字列は同じ種類のコンテナ要素のテキストにのみ含まれる
+            container_tag = self._containers[-1].record.tag
+            for opened in self._containers:
+                if opened.record.tag == container_tag:
+                    self._append(opened, text)
+            return
+        self._last_text = text[:TEXT_LIMIT]
+        # 子孫要素のテキストは祖先のテキストの部分列なので、上限に達した要素より下は走査不要
+        for i in range(len(self._stack) - 1, -1, -1):
+            opened = self._stack[i]
+            if opened.length >= TEXT_LIMIT:
+                break
+            self._append(opened, text)
+
+    def _pruned_elements(self) -> list:
+        # dom_id は全要素での通し番号のまま残し、操作可能な要素だけに絞る。
+        # parent_id は残した要素の中で最も近い祖先を指す
+        pruned = []
+        for record, enclosing_label, preceding_text, kept_parent in self._interactive:
+            label = self._resolve_label(record, enclosing_label, preceding_text)
+            if label and label != record.text:
+                record.label = label
+            record.parent_id = kept_parent
+            pruned.append(record)
+        return pruned
+
+    def _resolve_label(self, record: DOMElement, enclosing_label, preceding_text: str) -> str:
+        attributes = record.attributes
+        if attributes.get('aria-label'):
+            return attributes['aria-label'][:TEXT_LIMIT]
+        labelled = self._labels_by_for.get(attributes.get('id'))
+        if labelled is not None and labelled.text:
+            return labelled.text
+        if enclosing_label is not None and enclosing_label.text:
+            return enclosing_label.text
+        for name in ('placeholder', 'title', 'alt'):
+            if attributes.get(name):
+                return attributes[name][:TEXT_LIMIT]
+        if record.tag in ('input', 'select', 'textarea'):
+            return preceding_text
+        return ''
+
+    @staticmethod
+    def _append(opened: _OpenElement, text: str):
+        if opened.length < TEXT_LIMIT:
+            opened.parts.append(text)
+            opened.length += len(text)
+
 
 class DOMParser:
     @staticmethod
-    def parse(html_source: str) -> list:
+    def parse(html_source: str, engine: str = 'stream', prune: bool = False) -> list:
+        if engine == 'soup':
+            if prune:
+                raise ValueError("プルーニングは engine='stream' でのみ利用できます。")
+            elements = DOMParser._parse_with_soup(html_source)
+        else:
+            parser = _SinglePassParser(prune=prune)
+            parser.feed(html_source)
+            parser.close()
+            elements = parser.elements
+            if prune:
+                logging.info(f"操作可能な要素のみに絞り込みました: {parser.total_elements} -> {len(elements)}")
+        logging.info(f"DOMの要素数: {len(elements)}")
+        return elements
+
+    @staticmethod
+    def _parse_with_soup(html_source: str) -> list:
+        # 旧実装。ストリーム解析結果との突き合わせ用に残している
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(html_source, 'html.parser')
         elements = []
+        dom_ids = {}
         for i, el in enumerate(soup.find_all(True)):
+            dom_ids[id(el)] = i
             elements.append({
                 'dom_id': i,
                 'tag': el.name,
                 'attributes': dict(el.attrs),
-                'text': (el.get_text(strip=True) or '')[:100],
+                'text': (el.get_text(strip=True) or '')[:TEXT_LIMIT],
+                'parent_id': dom_ids.get(id(el.parent)),
             })
-        total_chars = sum(len(json.dumps(e, ensure_ascii=False)) for e in elements)
-        logging.info(f"DOMの要素数: {len(elements)}, 合計文字数: {total_chars}")
         return elements
@@ -0,0 +1,322 @@
+# parsers/selector_validator.py
+
+import logging
+import re
+from typing import List, Optional
+
+# 事前検証の対象にする操作 (セレクタの要素を待つもの)
+VALIDATED_ACTIONS = ("CLICK", "TYPE")
+
+# 修復時に一意なセレクタを組み立てる際に試す属性 (優先順)
+REPAIR_ATTRIBUTES = ("name", "data-testid", "aria-label", "placeholder", "href", "title", "alt", "for", "value")
+
+_IDENTIFIER = re.compile(r'-?[_a-zA-Z][\w-]*$')
+_TAG = re.compile(r'\*|[a-zA-Z][\w-]*')
+_SIMPLE = re.compile(
+    r'''\#(?P<id>[\w-]+)'''
+    r'''|\.(?P<cls>[\w-]+)'''
+    r'''|\[\s*(?P<attr>[\w:.@-]+)\s*(?:(?P<op>[~^$*|]?=)\s*(?:"(?P<dq>(?:[^"\\]|\\.)*)"|'(?P<sq>(?:[^'\\]|\\.)*)'|(?P<bare>[^\]\s]+)))?\s*\]'''
+    r'''|:nth-of-type\(\s*(?P<nth>\d+)\s*\)'''
+)
+_ESCAPE = re.compile(r'\\(.)')
+
+
+class _Compound:
+    __slots__ = ('tag', 'ids', 'classes', 'attributes', 'nth')
+
+    def __init__(self):
+        self.tag = None
+        self.ids = []
+        self.classes = []
+        self.attributes = []
+        self.nth = None
+
+
+def _parse_compound(text: str) -> Optional[_Compound]:
+    compound = _Compound()
+    position = 0
+    tag_match = _TAG.match(text)
+    if tag_match:
+        if tag_match.group() != '*':
+            compound.tag = tag_match.group().lower()
+        position = tag_match.end()
+    while position < len(text):
+        match = _SIMPLE.match(text, position)
+        if not match:
+            return None
+        if match.group('id'):
+            compound.ids.append(match.group('id'))
+        elif match.group('cls'):
+            compound.classes.append(match.group('cls'))
+        elif match.group('attr'):
+            value = match.group('dq') if match.group('dq') is not None else match.group('sq')
+            if value is None:
+                value = match.group('bare')
+            if value is not None:
+                value = _ESCAPE.sub(r'\1', value)
+            compound.attributes.append((match.group('attr').lower(), match.group('op'), value))
+        else:
+            compound.nth = int(match.group('nth'))
+        position = match.end()
+    if position == 0:
+        return None
+    return compound
+
+
+def parse_selector(selector: str) -> Optional[list]:
+    # 子孫 (空白) と子 (>) の結合子だけを扱う。それ以外の構文は None を返し、検証の対象外とする。
+    # Playwright の >> (セレクタの連結) も子結合子と区別して None を返す
+    parts = []
+    current = []
+    combinator = None
+    quote = None
+    depth = 0
+    for char in selector.strip():
+        if quote:
+            current.append(char)
+            if char == quote and current[-2] != '\\':
+                quote = None
+            continue
+        if depth == 0 and (char.isspace() or char == '>'):
+            if current:
+                parts.append(''.join(current))
+                current = []
+            if char == '>':
+                if combinator == '>':
+                    return None
+                combinator = '>'
+            elif combinator is None:
+                combinator = ' '
+            continue
+        if depth == 0 and char in ',+~':
+            return None
+        if combinator is not None:
+            if not parts:
+                return None
+            parts.append(combinator)
+            combinator = None
+        if char in '"\'' and depth:
+            quote = char
+        elif char in '[(':
+            depth += 1
+        elif char in '])':
+            depth -= 1
+            if depth < 0:
+                return None
+        current.append(char)
+    if current:
+        parts.append(''.join(current))
+    if not parts or combinator is not None or quote or depth:
+        return None
+    compounds = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            compounds.append(part)
+            continue
+        compound = _parse_compound(part)
+        if compound is None:
+            return None
+        compounds.append(compound)
+    return compounds
+
+
+def parse_dom_id(value) -> Optional[int]:
+    # モデルが "#12" や "12" のように返した dom_id も数値として扱う
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lstrip('#').isdigit():
+        return int(value.strip().lstrip('#'))
+    return None
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class SelectorValidator:
+    # 解析済みの DOM 要素から id/class/name/タグの索引を作り、ブラウザを使わずにセレクタの一致件数を調べる。
+    # complete=False (プルーニング後の要素など) の場合は兄弟順を使うセレクタを検証・生成しない
+    def __init__(self, dom_elements: list, complete: bool = True):
+        self.elements = dom_elements
+        self.complete = complete
+        self._position = {element['dom_id']: i for i, element in enumerate(dom_elements)}
+        self._parents = [self._position.get(element.get('parent_id')) for element in dom_elements]
+        self._by_tag = {}
+        self._by_id = {}
+        self._by_class = {}
+        self._nth_of_type = []
+        sibling_counts = {}
+        for i, element in enumerate(dom_elements):
+            self._by_tag.setdefault(element['tag'], []).append(i)
+            attributes = element.get('attributes', {})
+            if attributes.get('id'):
+                self._by_id.setdefault(attributes['id'], []).append(i)
+            for cls in self._classes(attributes):
+                self._by_class.setdefault(cls, []).append(i)
+            key = (self._parents[i], element['tag'])
+            sibling_counts[key] = sibling_counts.get(key, 0) + 1
+            self._nth_of_type.append(sibling_counts[key])
+
+    def resolve(self, selector: str) -> Optional[List[int]]:
+        # 一致する要素の位置を返す。検証できない構文の場合は None
+        if not selector:
+            return None
+        compounds = parse_selector(selector)
+        if compounds is None:
+            return None
+        if not self.complete and any(c.nth is not None for c in compounds[::2]):
+            return None
+        # プルーニングで除かれた祖先を指している可能性があるため、どこにも一致しない祖先は判定しない
+        if not self.complete:
+            for compound in compounds[-3::-2]:
+                if not any(self._matches(compound, i) for i in self._candidates(compound)):
+                    return None
+        subject = compounds[-1]
+        matches = [i for i in self._candidates(subject) if self._matches(subject, i)]
+        if len(compounds) > 1:
+            index = len(compounds) - 3
+            matches = [i for i in matches if self._has_ancestor(i, compounds[index], compounds, index, compounds[index + 1])]
+        return matches
+
+    def check(self, selector: str) -> str:
+        matches = self.resolve(selector)
+        if matches is None:
+            return "unsupported"
+        if not matches:
+            return "missing"
+        return "ok" if len(matches) == 1 else "ambiguous"
+
+    def unique_selector(self, dom_id) -> Optional[str]:
+        position = self._position.get(dom_id)
+        if position is None:
+            return None
+        element = self.elements[position]
+        tag = element['tag']
+        attributes = element.get('attributes', {})
+        candidates = []
+        element_id = attributes.get('id')
+        if element_id:
+            candidates.append(f"#{element_id}" if _IDENTIFIER.match(element_id) else f"{tag}[id={_quote(element_id)}]")
+        for name in REPAIR_ATTRIBUTES:
+            value = attributes.get(name)
+            if isinstance(value, str) and value:
+                candidates.append(f"{tag}[{name}={_quote(value)}]")
+        classes = [c for c in self._classes(attributes) if _IDENTIFIER.match(c)]
+        if classes:
+            candidates.append(tag + "".join(f".{c}" for c in classes))
+        if self.complete:
+            candidates.append(self._structural_selector(position))
+        for candidate in candidates:
+            if candidate and self.resolve(candidate) == [position]:
+                return candidate
+        return None
+
+    def validate(self, actions: List[dict]) -> List[dict]:
+        # dom_id で修復できるものはその場で書き換え、残った問題を返す。
+        # NAVIGATE 以降は別のページになるため検証しない
+        problems = []
+        for index, action in enumerate(actions, start=1):
+            if action.get("action") == "NAVIGATE":
+                break
+            problem = self.validate_action(index, action)
+            if problem:
+                problems.append(problem)
+        return problems
+
+    def validate_action(self, index: int, action: dict) -> Optional[dict]:
+        if action.get("action") not in VALIDATED_ACTIONS:
+            return None
+        selector = action.get("selector") or ""
+        status = self.check(selector)
+        if status in ("ok", "unsupported"):
+            return None
+        repaired = self.unique_selector(parse_dom_id(action.get("dom_id")))
+        if repaired:
+            logging.info(f"アクション {index} のセレクタを dom_id から修復しました: {selector} -> {repaired}")
+            action["selector"] = repaired
+            return None
+        matches = self.resolve(selector) or []
+        logging.warning(f"アクション {index} のセレクタがDOMに一意に一致しません ({status}, {len(matches)}件): {selector}")
+        return {"index": index, "action": action.get("action"), "selector": selector, "status": status,
+                "matches": len(matches)}
+
+    @staticmethod
+    def _classes(attributes: dict) -> list:
+        classes = attributes.get('class') or []
+        return classes if isinstance(classes, list) else str(classes).split()
+
+    def _candidates(self, compound: _Compound) -> List[int]:
+        if compound.ids:
+            return self._by_id.get(compound.ids[0], [])
+        if compound.classes:
+            return self._by_class.get(compound.classes[0], [])
+        if compound.tag:
+            return self._by_tag.get(compound.tag, [])
+        return range(len(self.elements))
+
+    def _matches(self, compound: _Compound, position: int) -> bool:
+        element = self.elements[position]
+        if compound.tag and element['tag'] != compound.tag:
+            return False
+        attributes = element.get('attributes', {})
+        if any(attributes.get('id') != element_id for element_id in compound.ids):
+            return False
+        if compound.classes:
+            classes = self._classes(attributes)
+            if any(cls not in classes for cls in compound.classes):
+                return False
+        for name, op, expected in compound.attributes:
+            if name not in attributes:
+                return False
+            if op is None:
+                continue
+            value = attributes[name]
+            actual = " ".join(value) if isinstance(value, list) else str(value)
+            if op == '=' and actual != expected:
+                return False
+            if op == '~=' and expected not in actual.split():
+                return False
+            if op == '^=' and not (expected and actual.startswith(expected)):
+                return False
+            if op == '$=' and not (expected and actual.endswith(expected)):
+                return False
+            if op == '*=' and not (expected and expected in actual):
+                return False
+            if op == '|=' and actual != expected and not actual.startswith(expected + '-'):
+                return False
+        if compound.nth is not None and self._nth_of_type[position] != compound.nth:
+            return False
+        return True
+
+    def _has_ancestor(self, position: int, compound: _Compound, compounds: list, index: int, combinator: str) -> bool:
+        parent = self._parents[position]
+        while parent is not None:
+            if self._matches(compound, parent) and self._matches_left(parent, compounds, index):
+                return True
+            if combinator == '>':
+                return False
+            parent = self._parents[parent]
+        return False
+
+    def _matches_left(self, position: int, compounds: list, index: int) -> bool:
+        if index == 0:
+            return True
+        return self._has_ancestor(position, compounds[index - 2], compounds, index - 2, compounds[index - 1])
+
+    def _structural_selector(self, position: int) -> Optional[str]:
+        # 一意な id を持つ祖先 (なければ body) からの兄弟順のパス
+        steps = []
+        current = position
+        while current is not None:
+            element = self.elements[current]
+            element_id = element.get('attributes', {}).get('id')
+            if current != position and element_id and _IDENTIFIER.match(element_id) and len(self._by_id.get(element_id, [])) == 1:
+                return f"#{element_id}" + "".join(steps)
+            if element['tag'] == 'body':
+                return "body" + "".join(steps)
+            parent = self._parents[current]
+            # html.parser の結果には tbody が補われないため、table 直下の tr は子孫結合子でつなぐ
+            combinator = " " if element['tag'] == 'tr' and parent is not None and self.elements[parent]['tag'] == 'table' else " > "
+            steps.insert(0, f"{combinator}{element['tag']}:nth-of-type({self._nth_of_type[current]})")
+            current = parent
+        return None
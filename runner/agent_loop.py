@@ -0,0 +1,151 @@
+# runner/agent_loop.py
+
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+from clients.openai_client import OpenAIClient
+from controllers.dom_snapshot import agent_selector, diff_snapshots
+from controllers.playwright_controller import PlaywrightController
+from parsers.dom_chunker import DOMChunk, dom_format_note
+from parsers.selector_validator import parse_dom_id
+from .pipeline import is_cancelled, split_instruction
+
+STEP_ACTIONS = ("CLICK", "TYPE", "NAVIGATE", "SCREENSHOT")
+# モデルに送るこれまでの操作の履歴の最大件数と、現在の状態の要約に載せる表示名の最大文字数
+HISTORY_LIMIT = 10
+SUMMARY_TEXT_LIMIT = 40
+
+def summarize_element(element: dict) -> str:
+    # 現在の状態の要約用に、要素を「dom_id: タグ[type] "表示名"」の1行にまとめる
+    attributes = element.get("attributes") or {}
+    kind = element["tag"] + (f"[{attributes['type']}]" if attributes.get("type") else "")
+    name = (element.get("label") or element.get("text") or attributes.get("aria-label") or attributes.get("placeholder")
+            or attributes.get("name") or attributes.get("id") or "")
+    name = " ".join(str(name).split())[:SUMMARY_TEXT_LIMIT]
+    return f'{element["dom_id"]}: {kind} "{name}"' if name else f'{element["dom_id"]}: {kind}'
+
+def summarize_step(step: int, action: dict, success: bool) -> str:
+    target = action.get("original_selector") or action.get("selector") or ""
+    if action.get("dom_id") is not None:
+        target = f"{target} (dom_id: {action['dom_id']})".strip()
+    value = f" 値: {str(action.get('value'))[:SUMMARY_TEXT_LIMIT]}" if action.get("value") else ""
+    return f"{step}. {action.get('action')} {target}{value} → {'成功' if success else '失敗'}"
+
+class AgentLoop:
+    # 1操作ごとにページを観察し、前回からの差分だけをモデルに送って次の操作を決める。
+    # 過去の観察結果や応答は送り直さず、毎回「直近の操作の履歴 + 現在の状態の要約 + 差分」の1メッセージだけを送る
+    def __init__(self, openai_client: OpenAIClient, playwright_controller: PlaywrightController, max_steps: int = 20):
+        self.openai_client = openai_client
+        self.playwright_controller = playwright_controller
+        self.max_steps = max_steps
+
+    def run(self, model: str, user_instruction: str, callback: Optional[Callable] = None,
+            on_action: Optional[Callable[[int, dict], None]] = None, deadline: Optional[float] = None,
+            cancel: Optional[threading.Event] = None) -> dict:
+        url, task = split_instruction(user_instruction)
+        result = {"actions": [], "wait_metrics": [], "done": False, "steps": 0, "cancelled": False}
+        history = []
+        session = self.playwright_controller.open_session(url or None)
+        try:
+            previous = None
+            for step in range(1, self.max_steps + 1):
+                if deadline is not None and time.monotonic() > deadline:
+                    logging.warning(f"期限を過ぎたため、ステップ {step} の前で打ち切ります。")
+                    break
+                if is_cancelled(cancel):
+                    logging.warning(f"中止が要求されたため、ステップ {step} の前で打ち切ります。")
+                    result["cancelled"] = True
+                    break
+                snapshot = session.snapshot()
+                conversation = [{"role": "user", "content": self.describe_history(history) + self.describe(previous, snapshot)}]
+                action, raw_response = self.openai_client.generate_next_action(model, task, conversation, cancel)
+                if is_cancelled(cancel):
+                    logging.warning(f"中止が要求されたため、ステップ {step} の操作を実行せずに打ち切ります。")
+                    result["cancelled"] = True
+                    break
+                if action is None:
+                    logging.error(f"ステップ {step} の操作を生成できませんでした。")
+                    break
+                if action.get("action") == "DONE":
+                    logging.info(f"ステップ {step} で指示が完了したと判定されました: {action.get('value')}")
+                    result["done"] = True
+                    break
+                if action.get("action") not in STEP_ACTIONS:
+                    logging.warning(f"未知の操作が返されたため打ち切ります: {action}")
+                    break
+                self.resolve_target(action, snapshot)
+
+                succeeded = []
+
+                def step_callback(index, act, selector, value, code_snippet='', success=True):
+                    succeeded.append(success)
+                    if callback:
+                        callback(index, act, selector, value, code_snippet, success=success)
+
+                if on_action:
+                    on_action(step, action)
+                result["wait_metrics"].extend(session.perform_actions([action], step_callback, start_index=step,
+                                                                      cancel=cancel, deadline=deadline) or [])
+                result["actions"].append(action)
+                history.append(summarize_step(step, action, bool(succeeded) and all(succeeded)))
+                result["steps"] = step
+                previous = snapshot
+            else:
+                logging.warning(f"最大ステップ数 ({self.max_steps}) に達したため打ち切ります。")
+        finally:
+            session.close()
+        return result
+
+    @staticmethod
+    def describe_history(history: List[str]) -> str:
+        if not history:
+            return ""
+        lines = ["これまでの操作:"]
+        if len(history) > HISTORY_LIMIT:
+            lines.append(f"(それ以前の {len(history) - HISTORY_LIMIT} 件は省略)")
+        lines.extend(history[-HISTORY_LIMIT:])
+        return "\n".join(lines) + "\n"
+
+    def describe(self, previous: Optional[dict], snapshot: dict) -> str:
+        # 初回と別ページへの遷移後はページ全体を送る。それ以外は追加・変更された要素と、
+        # 残りの要素を1行ずつにまとめた現在の状態の要約を送る
+        encoding = self.openai_client.dom_encoding
+        lines = [f"URL: {snapshot['url']} / タイトル: {snapshot['title']}"]
+        diff = diff_snapshots(previous, snapshot)
+        if diff is None:
+            chunk = DOMChunk(snapshot["elements"], encoding=encoding)
+            lines.append(f"ページ内の操作可能な要素 ({len(chunk)}件):{dom_format_note(chunk)}")
+            lines.append(chunk.payload() if chunk else "なし")
+            logging.info(f"ページ全体の操作可能な要素を送信します: {len(chunk)}件")
+            return "\n".join(lines)
+        if not any(diff.values()):
+            lines.append("前回の操作の後、操作可能な要素に変化はありません。")
+        for label, elements in (("追加された要素", diff["added"]), ("変更された要素", diff["changed"])):
+            if elements:
+                chunk = DOMChunk(elements, encoding=encoding)
+                lines.append(f"前回の操作の後に{label} ({len(chunk)}件):{dom_format_note(chunk)}")
+                lines.append(chunk.payload())
+        if diff["removed"]:
+            lines.append(f"なくなった要素の dom_id: {', '.join(str(dom_id) for dom_id in diff['removed'])}")
+        updated = {element["dom_id"] for element in diff["added"] + diff["changed"]}
+        unchanged = [element for element in snapshot["elements"] if element["dom_id"] not in updated]
+        lines.append(f"変わっていない操作可能な要素 ({len(unchanged)}件、dom_id: タグ \"表示名\"):")
+        lines.extend(summarize_element(element) for element in unchanged)
+        logging.info(
+            f"前回からの差分を送信します: 追加 {len(diff['added'])}件 / 変更 {len(diff['changed'])}件 / 削除 {len(diff['removed'])}件 "
+            f"(全体 {len(snapshot['elements'])}件)"
+        )
+        return "\n".join(lines)
+
+    @staticmethod
+    def resolve_target(action: dict, snapshot: dict):
+        # dom_id が現在のページの要素を指していれば、振った番号で確実に特定できるセレクタを使う
+        dom_id = parse_dom_id(action.get("dom_id"))
+        if action.get("action") not in ("CLICK", "TYPE") or dom_id is None:
+            return
+        if any(element["dom_id"] == dom_id for element in snapshot["elements"]):
+            if action.get("selector"):
+                action["original_selector"] = action["selector"]
+            action["selector"] = agent_selector(dom_id)
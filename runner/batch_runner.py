@@ -0,0 +1,190 @@
+# runner/batch_runner.py
+
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, List
+
+from clients.openai_client import OpenAIClient
+from controllers.playwright_controller import PlaywrightController
+from controllers.wait_strategy import remaining_ms
+from utils.tracing import bind, trace_run
+from .pipeline import InstructionPipeline, extract_url
+
+def load_jobs(path: str) -> List[dict]:
+    # 1行1ジョブの JSONL。url と task、または URL を含む instruction を指定する
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                job = {"error": f"JSONの解析に失敗しました: {e}"}
+            if not isinstance(job, dict):
+                job = {"error": "ジョブはオブジェクトで指定してください。"}
+            job.setdefault("id", line_number)
+            jobs.append(job)
+    return jobs
+
+def job_instruction(job: dict) -> str:
+    if job.get("instruction"):
+        return job["instruction"]
+    return f"{job.get('url', '')} {job.get('task', '')}".strip()
+
+class BatchRunner:
+    # 複数のジョブを、ワーカーごとに専用のブラウザを持たせて並列に実行する
+    def __init__(self, openai_client: OpenAIClient, controller_factory: Callable[[], PlaywrightController],
+                 model: str = "Claude", concurrency: int = 4, job_timeout: float = 300.0,
+                 chunking_enabled: bool = True, pruning_enabled: bool = False, relevance_enabled: bool = False,
+                 live_dom_enabled: bool = False):
+        self.pipeline = InstructionPipeline(openai_client)
+        self.controller_factory = controller_factory
+        self.model = model
+        self.concurrency = concurrency
+        self.job_timeout = job_timeout
+        self.chunking_enabled = chunking_enabled
+        self.pruning_enabled = pruning_enabled
+        self.relevance_enabled = relevance_enabled
+        self.live_dom_enabled = live_dom_enabled
+        self.trace_dir = openai_client.config.TRACE_REPORT_DIR
+        self._output_lock = threading.Lock()
+
+    def run(self, jobs: List[dict], output_path: str) -> dict:
+        concurrency = max(1, min(self.concurrency, len(jobs)))
+        logging.info(f"バッチ実行を開始します。ジョブ数: {len(jobs)} / 並列数: {concurrency} / タイムアウト: {self.job_timeout}秒")
+        started = time.monotonic()
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        summary = {}
+
+        # ブラウザのインストール確認が重ならないよう、コントローラーは先にまとめて作る
+        controllers = [self.controller_factory() for _ in range(concurrency)]
+        llm_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-llm")
+        try:
+            with open(output_path, "w", encoding="utf-8") as output:
+                workers = [
+                    threading.Thread(
+                        target=self._worker, args=(controller, pending, llm_executor, output, summary),
+                        name=f"batch-worker-{i}", daemon=True
+                    )
+                    for i, controller in enumerate(controllers, start=1)
+                ]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            # 期限切れで結果を待たなかった LLM 呼び出しの完了は待たない
+            llm_executor.shutdown(wait=False, cancel_futures=True)
+
+        summary["total"] = len(jobs)
+        summary["elapsed_seconds"] = round(time.monotonic() - started, 3)
+        logging.info(f"バッチ実行が完了しました。{summary}")
+        return summary
+
+    def _worker(self, controller: PlaywrightController, pending: queue.Queue, llm_executor: ThreadPoolExecutor,
+                output, summary: dict):
+        try:
+            while True:
+                try:
+                    job = pending.get_nowait()
+                except queue.Empty:
+                    return
+                result = self.run_job(controller, job, llm_executor)
+                with self._output_lock:
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    output.flush()
+                    summary[result["status"]] = summary.get(result["status"], 0) + 1
+                logging.info(f"ジョブ {result['id']} が終了しました。ステータス: {result['status']} ({result['elapsed_seconds']}秒)")
+        finally:
+            controller.shutdown()
+
+    def run_job(self, controller: PlaywrightController, job: dict, llm_executor: ThreadPoolExecutor) -> dict:
+        # ジョブごとに処理時間の内訳を記録し、結果にも含める
+        with trace_run("batch", self.trace_dir, job_id=job["id"], model=job.get("model", self.model)) as trace:
+            result = self._run_job(controller, job, llm_executor)
+        result["phases"] = trace.phases()
+        return result
+
+    def _run_job(self, controller: PlaywrightController, job: dict, llm_executor: ThreadPoolExecutor) -> dict:
+        started = time.monotonic()
+        deadline = started + self.job_timeout
+        instruction = job_instruction(job)
+        url = extract_url(instruction)
+        model = job.get("model", self.model)
+        result = {
+            "id": job["id"], "url": url, "task": job.get("task", instruction), "model": model,
+            "status": "error", "actions": [], "steps": [], "wait_metrics": [], "error": job.get("error"),
+        }
+        if result["error"] is None and not instruction:
+            result["error"] = "url と task、または instruction を指定してください。"
+        if result["error"] is not None:
+            result["elapsed_seconds"] = 0.0
+            return result
+
+        session = None
+        # 期限になったらセットし、LLM 呼び出しの残りのチャンクの送信とリトライ、アクションの実行と対象の待機を打ち切る。
+        # ページの読み込みは中断できないため、残り時間をタイムアウトとして渡す
+        cancel = threading.Event()
+        timer = threading.Timer(max(0.0, deadline - time.monotonic()), cancel.set)
+        timer.daemon = True
+        timer.start()
+        try:
+            html_content = None
+            if self.live_dom_enabled and url:
+                session = controller.open_session(url, remaining_ms(deadline))
+                html_content = session.content()
+            future = llm_executor.submit(
+                bind(self.pipeline.process_instruction), model, instruction, self.chunking_enabled,
+                self.pruning_enabled, self.relevance_enabled, html_content, cancel
+            )
+            actions, _ = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            result["actions"] = actions
+            if not actions:
+                result["status"] = "failed"
+                result["error"] = "アクションの生成に失敗しました。"
+                return result
+
+            steps = result["steps"]
+
+            def callback(index, action, selector, value, code_snippet='', success=True):
+                steps.append({"index": index, "action": action, "selector": selector, "value": value,
+                              "code": code_snippet, "success": success})
+
+            if session:
+                result["wait_metrics"] = session.perform_actions(actions, callback, cancel=cancel, deadline=deadline) or []
+            else:
+                result["wait_metrics"] = controller.perform_actions(actions, url, callback, cancel,
+                                                                    remaining_ms(deadline)) or []
+
+            if len(steps) == len(actions) and all(step["success"] for step in steps):
+                result["status"] = "success"
+            elif cancel.is_set():
+                result["status"] = "timeout"
+                result["error"] = f"{self.job_timeout}秒以内に完了しませんでした。({len(steps)}/{len(actions)} アクション実行済み)"
+            else:
+                result["status"] = "failed"
+        except FutureTimeoutError:
+            cancel.set()
+            result["status"] = "timeout"
+            result["error"] = f"{self.job_timeout}秒以内にアクションを生成できませんでした。"
+        except Exception as e:
+            if cancel.is_set() or time.monotonic() >= deadline:
+                result["status"] = "timeout"
+                result["error"] = f"{self.job_timeout}秒以内に完了しませんでした。({e})"
+            else:
+                logging.error(f"ジョブ {job['id']} の実行中にエラーが発生しました: {e}")
+                result["error"] = str(e)
+        finally:
+            timer.cancel()
+            if session:
+                session.close()
+            result["elapsed_seconds"] = round(time.monotonic() - started, 3)
+        return result
@@ -0,0 +1,180 @@
+# runner/page_cache.py
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from parsers.dom_element import DOMElement
+
+# 解析結果の保存形式や DOMParser の出力が変わったら上げ、古い解析結果を使わないようにする
+PARSED_FORMAT_VERSION = 1
+
+def parsed_key(content_hash: str, prune: bool) -> str:
+    return f"{PARSED_FORMAT_VERSION}:{'pruned' if prune else 'full'}:{content_hash}"
+
+class PageCache:
+    # 取得した HTML を再検証用のヘッダー (ETag / Last-Modified) と一緒に SQLite に保存する。
+    # 解析済みの DOM は本文のハッシュをキーにメモリ上の LRU と SQLite に保存する
+    def __init__(self, path: Optional[str] = "page_cache.sqlite3", max_disk_entries: int = 500,
+                 max_memory_entries: int = 1):
+        self.max_disk_entries = max_disk_entries
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.revalidated = 0
+        self.parsed_hits = 0
+        self.parsed_misses = 0
+        self._db = None
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS pages ("
+                    "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body TEXT, fetched_at REAL, accessed_at REAL)"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, value TEXT, accessed_at REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_pages_accessed_at ON pages (accessed_at)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_parsed_accessed_at ON parsed (accessed_at)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"ページキャッシュのデータベースを開けませんでした。解析結果のみメモリに保存します: {e}")
+                self._db = None
+
+    def get_page(self, url: str) -> Optional[dict]:
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute("SELECT etag, last_modified, body FROM pages WHERE url = ?", (url,)).fetchone()
+            except sqlite3.Error as e:
+                logging.warning(f"ページキャッシュの読み込みに失敗しました: {e}")
+                return None
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "body": row[2]}
+
+    def put_page(self, url: str, etag: Optional[str], last_modified: Optional[str], body: str):
+        now = time.time()
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO pages (url, etag, last_modified, body, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, etag, last_modified, body, now, now)
+                )
+                self._evict_disk("pages", "url")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"ページキャッシュへの保存に失敗しました: {e}")
+
+    def touch_page(self, url: str):
+        # 304 で変更がないと確認できたページの最終利用日時を更新する
+        now = time.time()
+        with self._lock:
+            self.revalidated += 1
+            if self._db is None:
+                return
+            try:
+                self._db.execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"ページキャッシュの更新に失敗しました: {e}")
+
+    def delete_page(self, url: str):
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"ページキャッシュの削除に失敗しました: {e}")
+
+    def get_parsed(self, key: str) -> Optional[List[DOMElement]]:
+        # 返した要素は呼び出し側で共有されるため、変更しないこと
+        with self._lock:
+            elements = self._memory.get(key)
+            if elements is not None:
+                self._memory.move_to_end(key)
+                self.parsed_hits += 1
+                return elements
+            elements = self._get_parsed_from_disk(key)
+            if elements is None:
+                self.parsed_misses += 1
+                return None
+            self.parsed_hits += 1
+            self._remember(key, elements)
+            return elements
+
+    def put_parsed(self, key: str, elements: List[DOMElement]):
+        now = time.time()
+        with self._lock:
+            self._remember(key, elements)
+            if self._db is None:
+                return
+            try:
+                value = json.dumps([element.to_row() for element in elements], ensure_ascii=False)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO parsed (key, value, accessed_at) VALUES (?, ?, ?)", (key, value, now)
+                )
+                self._evict_disk("parsed", "key")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"解析結果のキャッシュへの保存に失敗しました: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.parsed_hits + self.parsed_misses
+            return {
+                "revalidated": self.revalidated,
+                "parsed_hits": self.parsed_hits,
+                "parsed_misses": self.parsed_misses,
+                "parsed_hit_rate": round(self.parsed_hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _remember(self, key: str, elements: List[DOMElement]):
+        self._memory[key] = elements
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _get_parsed_from_disk(self, key: str) -> Optional[List[DOMElement]]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("SELECT value FROM parsed WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE parsed SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"解析結果のキャッシュの読み込みに失敗しました: {e}")
+            return None
+        return [DOMElement.from_row(item) for item in json.loads(row[0])]
+
+    def _evict_disk(self, table: str, key_column: str):
+        count = self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if count > self.max_disk_entries:
+            self._db.execute(
+                f"DELETE FROM {table} WHERE {key_column} IN "
+                f"(SELECT {key_column} FROM {table} ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_disk_entries,)
+            )
@@ -0,0 +1,106 @@
+# runner/page_fetcher.py
+
+import hashlib
+import logging
+from http.cookiejar import DefaultCookiePolicy
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+from parsers.dom_parser import DOMParser
+from utils.tracing import span
+from .page_cache import PageCache, parsed_key
+
+def content_hash(html: str) -> str:
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+class PageFetcher:
+    # 接続を再利用する requests.Session で HTML を取得する。Accept-Encoding は requests の既定値
+    # (gzip / deflate、brotli がインストールされていれば br も) を送る。
+    # キャッシュ済みのページには If-None-Match / If-Modified-Since を付けて送り、304 なら保存済みの本文を使う
+    def __init__(self, cache: Optional[PageCache] = None, pool_size: int = 10, timeout: float = 60):
+        self.cache = cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        # 従来どおり取得ごとに独立させるため、Cookie は保持しない
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_config(cls, config: Config) -> "PageFetcher":
+        cache = None
+        if config.PAGE_CACHE_ENABLED:
+            cache = PageCache(
+                path=config.PAGE_CACHE_PATH,
+                max_disk_entries=config.PAGE_CACHE_DISK_ENTRIES,
+                max_memory_entries=config.PAGE_CACHE_MEMORY_ENTRIES
+            )
+        return cls(cache, pool_size=config.HTTP_POOL_SIZE)
+
+    def fetch_html(self, url: str) -> Optional[str]:
+        logging.info(f"指定されたURLからHTMLコンテンツを取得します: {url}")
+        with span("fetch", url=url) as attributes:
+            cached = self.cache.get_page(url) if self.cache is not None else None
+            headers = {}
+            if cached is not None:
+                if cached["etag"]:
+                    headers["If-None-Match"] = cached["etag"]
+                if cached["last_modified"]:
+                    headers["If-Modified-Since"] = cached["last_modified"]
+            try:
+                response = self.session.get(url, timeout=self.timeout, headers=headers)
+                attributes["status"] = response.status_code
+                if response.status_code == 304 and cached is not None:
+                    self.cache.touch_page(url)
+                    attributes["bytes"] = 0
+                    attributes["revalidated"] = True
+                    logging.info("ページは変更されていないため、保存済みのHTMLコンテンツを使用します。")
+                    return cached["body"]
+                response.raise_for_status()
+                logging.info("HTMLコンテンツの取得に成功しました。")
+                attributes["bytes"] = len(response.content)
+                html = response.text
+                self._store(url, response, html, cached)
+                return html
+            except requests.exceptions.Timeout:
+                logging.error(f"タイムアウトエラー: URL '{url}' のページをロードできませんでした。")
+                attributes["error"] = "Timeout"
+                return None
+            except requests.exceptions.RequestException as e:
+                logging.error(f"HTMLコンテンツの取得に失敗しました: {e}")
+                attributes["error"] = type(e).__name__
+                return None
+
+    def parse_dom(self, html: str, prune: bool = False) -> Tuple[List, bool]:
+        # 本文が同じなら保存済みの解析結果を返す。2つ目の値は解析結果のキャッシュを使ったかどうか
+        if self.cache is None:
+            return DOMParser.parse(html, prune=prune), False
+        key = parsed_key(content_hash(html), prune)
+        elements = self.cache.get_parsed(key)
+        if elements is not None:
+            logging.info(f"解析済みのDOMを再利用します。{self.cache.stats()}")
+            return elements, True
+        elements = DOMParser.parse(html, prune=prune)
+        self.cache.put_parsed(key, elements)
+        return elements, False
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _store(self, url: str, response: requests.Response, html: str, cached: Optional[dict]):
+        # 再検証できるヘッダーを返したページだけを保存する
+        if self.cache is None:
+            return
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        no_store = "no-store" in response.headers.get("Cache-Control", "").lower()
+        if (etag or last_modified) and not no_store:
+            self.cache.put_page(url, etag, last_modified, html)
+        elif cached is not None:
+            self.cache.delete_page(url)
@@ -0,0 +1,294 @@
+# runner/pipeline.py
+
+import bisect
+import json
+import logging
+import re
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from clients.action_stream import ActionStream
+from clients.openai_client import OpenAIClient
+from parsers.dom_parser import is_interactive
+from parsers.dom_index import DOMRelevanceIndex
+from parsers.dom_chunker import DOMChunk, chunk_dom_elements
+from parsers.selector_validator import VALIDATED_ACTIONS, SelectorValidator, parse_dom_id
+from utils.tracing import span
+from .page_fetcher import PageFetcher
+from .plan_merger import is_plan_complete, merge_plans
+
+URL_PATTERN = re.compile(r'https?://\S+')
+
+# 修正依頼に含める候補の要素数と、失敗したアクションの dom_id の前後から含める要素数
+CORRECTION_CANDIDATES = 50
+CORRECTION_NEIGHBORS = 3
+
+SELECTOR_CORRECTION_INSTRUCTION = """次のアクションのセレクタは、ページ内の要素に一意に一致しませんでした。
+DOM要素から正しい操作対象を選び、修正したアクションだけを出力してください。
+各アクションには元の番号を "index" として含め、"selector" は対象の要素だけに一致する CSS セレクタにしてください。
+元の指示: {task}
+{problems}"""
+
+def extract_url(user_instruction: str) -> str:
+    url_match = URL_PATTERN.search(user_instruction)
+    return url_match.group() if url_match else ""
+
+def is_cancelled(cancel: Optional[threading.Event]) -> bool:
+    return cancel is not None and cancel.is_set()
+
+def split_instruction(user_instruction: str) -> Tuple[str, str]:
+    url = extract_url(user_instruction)
+    task = user_instruction.replace(url, "") if url else user_instruction
+    return url, task
+
+class InstructionPipeline:
+    # HTML の取得から DOM の解析・チャンク分割・アクション生成までを行う。GUI とバッチ実行で共通に使う
+    def __init__(self, openai_client: OpenAIClient, selector_validation: Optional[bool] = None,
+                 selector_correction: Optional[bool] = None, page_fetcher: Optional[PageFetcher] = None):
+        self.openai_client = openai_client
+        config = openai_client.config
+        self.page_fetcher = page_fetcher or PageFetcher.from_config(config)
+        self.selector_validation = config.SELECTOR_VALIDATION if selector_validation is None else selector_validation
+        self.selector_correction = config.SELECTOR_CORRECTION if selector_correction is None else selector_correction
+        self.chunk_early_stop = config.CHUNK_EARLY_STOP
+
+    def process_instruction(self, model: str, user_instruction: str, chunking_enabled: bool,
+                            pruning_enabled: bool = False, relevance_enabled: bool = False,
+                            html_content: Optional[str] = None, cancel: Optional[threading.Event] = None):
+        # cancel がセットされたら、まだ送信していない LLM へのリクエストを送らずに空の結果を返す
+        url, task = split_instruction(user_instruction)
+        live_dom = html_content is not None
+
+        dom_elements = []
+        if url:
+            prepared = self.prepare_chunks(model, task, url, chunking_enabled, pruning_enabled, relevance_enabled, html_content)
+            if prepared is None or is_cancelled(cancel):
+                return [], ""
+            dom_elements, chunks = prepared
+            actions, raw_response = self.generate_for_chunks(model, task, chunks, cancel)
+            if actions and self.selector_validation:
+                self.validate_actions(model, task, actions, dom_elements, complete=not pruning_enabled, cancel=cancel,
+                                      live_dom=live_dom)
+            return actions, raw_response
+        else:
+            actions, raw_response = self.openai_client.generate_actions(model, task, dom_elements, cancel)
+            if raw_response:
+                logging.debug("APIからの生のレスポンス: %s", raw_response)
+            logging.info("生成されたアクション: %s", actions)
+            return actions, raw_response
+
+    def stream_instruction(self, model: str, user_instruction: str, chunking_enabled: bool,
+                           pruning_enabled: bool = False, relevance_enabled: bool = False,
+                           html_content: Optional[str] = None,
+                           cancel: Optional[threading.Event] = None) -> Optional[ActionStream]:
+        url, task = split_instruction(user_instruction)
+        live_dom = html_content is not None
+
+        dom_elements = []
+        if url:
+            prepared = self.prepare_chunks(model, task, url, chunking_enabled, pruning_enabled, relevance_enabled, html_content)
+            if prepared is None:
+                return None
+            all_elements, chunks = prepared
+            if len(chunks) > 1:
+                # 複数チャンクの結果は結合してから実行するため、ストリーミングは1チャンクの場合に限る
+                logging.info(f"{len(chunks)}チャンクに分割されたため、ストリーミングを使わずに生成します。")
+                actions, _ = self.generate_for_chunks(model, task, chunks, cancel)
+                if actions and self.selector_validation:
+                    self.validate_actions(model, task, actions, all_elements, complete=not pruning_enabled, cancel=cancel,
+                                          live_dom=live_dom)
+                return ActionStream(actions, cancel)
+            dom_elements = chunks[0] if chunks else []
+            actions = self.openai_client.stream_actions(model, task, dom_elements, cancel)
+            if self.selector_validation:
+                # ストリーミングでは修正依頼を待たず、dom_id での修復と見つからないセレクタの印付けだけを行う
+                actions = self.validate_stream(actions, SelectorValidator(all_elements, complete=not pruning_enabled),
+                                               live_dom)
+            return ActionStream(actions, cancel)
+        return ActionStream(self.openai_client.stream_actions(model, task, dom_elements, cancel), cancel)
+
+    def prepare_chunks(self, model: str, task: str, url: str, chunking_enabled: bool,
+                       pruning_enabled: bool = False, relevance_enabled: bool = False,
+                       html_content: Optional[str] = None) -> Optional[Tuple[list, List[DOMChunk]]]:
+        if html_content is None:
+            html_content = self.fetch_html(url)
+            if html_content is None:
+                return None
+
+        with span("parse", html_chars=len(html_content or ""), prune=pruning_enabled) as attributes:
+            dom_elements, attributes["cached"] = self.page_fetcher.parse_dom(html_content or "", pruning_enabled)
+            attributes["elements"] = len(dom_elements)
+
+        # 関連要素で絞り込めた場合は1チャンクで送信し、信頼度が低い場合は通常のチャンク処理に戻す
+        encoding = self.openai_client.dom_encoding
+        candidates = None
+        if relevance_enabled:
+            with span("relevance") as attributes:
+                candidates = DOMRelevanceIndex(dom_elements).select(task)
+                attributes["candidates"] = len(candidates) if candidates is not None else 0
+        with span("chunk", encoding=encoding) as attributes:
+            if candidates is not None:
+                chunks = [DOMChunk(candidates, encoding=encoding)]
+            elif chunking_enabled:
+                chunks = chunk_dom_elements(dom_elements, self.openai_client.chunk_token_budget(model), encoding)
+            else:
+                chunks = [DOMChunk(dom_elements, encoding=encoding)]  # チャンク処理を無効にする場合、全体を一つのチャンクとして扱う
+            attributes["chunks"] = len(chunks)
+            attributes["tokens"] = sum(chunk.tokens for chunk in chunks)
+        return dom_elements, chunks
+
+    def generate_for_chunks(self, model: str, task: str, chunks: List[DOMChunk], cancel: Optional[threading.Event] = None):
+        complete = []
+
+        def is_complete(index: int, actions: List[dict]) -> bool:
+            if is_plan_complete(actions, chunks[index]):
+                complete.append(index)
+                return True
+            return False
+
+        early_stop = self.chunk_early_stop and len(chunks) > 1
+        results = self.openai_client.generate_actions_for_chunks(model, task, chunks, is_complete if early_stop else None,
+                                                                 cancel)
+        if is_cancelled(cancel):
+            # 一部のチャンクだけの計画は実行しない
+            logging.info("中止が要求されたため、生成済みのアクションを破棄します。")
+            return [], ""
+        if complete:
+            # 完結した計画があればそのチャンクの計画だけを使う
+            all_actions = list(results[complete[0]][0])
+        else:
+            all_actions = merge_plans(results, chunks)
+
+        if not all_actions:
+            logging.error("すべてのチャンクでアクションの生成に失敗しました。")
+            return [], ""
+
+        generated = sum(len(result[0]) for result in results if result)
+        sent = sum(1 for result in results if result is not None)
+        logging.info(f"全チャンクから生成されたアクションの総数: {generated} -> 統合後: {len(all_actions)} (送信したチャンク: {sent}/{len(chunks)})")
+        return all_actions, ""
+
+    def validate_actions(self, model: str, task: str, actions: List[dict], dom_elements: list,
+                         complete: bool = True, cancel: Optional[threading.Event] = None,
+                         live_dom: bool = True) -> List[dict]:
+        # ブラウザを起動する前に、解析済みの DOM でセレクタを検証する。
+        # dom_id で修復できないものはまとめて1回だけモデルに修正を依頼する。
+        # 静的な HTML (live_dom=False) には JavaScript で描画される要素が含まれないため、警告を出すだけで変更しない
+        if not live_dom:
+            validator = SelectorValidator(dom_elements, complete)
+            for index, action in enumerate(actions, start=1):
+                if action.get("action") == "NAVIGATE":
+                    break
+                self.report_selector(index, action, validator)
+            return []
+        with span("validate_selectors", actions=len(actions)) as attributes:
+            validator = SelectorValidator(dom_elements, complete)
+            problems = validator.validate(actions)
+            attributes["problems"] = len(problems)
+        if problems and self.selector_correction and not is_cancelled(cancel):
+            problems = self.correct_selectors(model, task, actions, problems, validator, dom_elements, cancel)
+        for problem in problems:
+            if problem["status"] == "missing":
+                # 実行時は長いタイムアウトを待たずに打ち切れるよう印を付ける
+                actions[problem["index"] - 1]["selector_status"] = "missing"
+        if problems:
+            logging.warning(f"セレクタの事前検証で解決できなかったアクション: {[p['index'] for p in problems]}")
+        return problems
+
+    def correct_selectors(self, model: str, task: str, actions: List[dict], problems: List[dict],
+                          validator: SelectorValidator, dom_elements: list,
+                          cancel: Optional[threading.Event] = None) -> List[dict]:
+        lines = []
+        for problem in problems:
+            reason = "一致する要素がありません" if problem["status"] == "missing" else f"{problem['matches']}件の要素に一致します"
+            lines.append(f"{problem['index']}: {json.dumps(actions[problem['index'] - 1], ensure_ascii=False)} ({reason})")
+        instruction = SELECTOR_CORRECTION_INSTRUCTION.format(task=task, problems="\n".join(lines))
+
+        # 修正依頼には操作可能な要素だけを送る。1チャンクに収まらない場合は失敗したアクションに近い要素に絞り、
+        # それでも収まらなければ正しい要素を見せられないため依頼しない
+        candidates = [e for e in dom_elements if is_interactive(e['tag'], e.get('attributes', {}))] or dom_elements
+        budget = self.openai_client.chunk_token_budget(model)
+        encoding = self.openai_client.dom_encoding
+        chunks = chunk_dom_elements(candidates, budget, encoding)
+        if len(chunks) > 1:
+            nearby = self.correction_candidates(task, actions, problems, candidates)
+            chunks = chunk_dom_elements(nearby, budget, encoding) if nearby else []
+            if len(chunks) != 1:
+                logging.warning("修正に必要な要素を1チャンクに収められないため、セレクタの修正を依頼しません。")
+                return problems
+        if not chunks:
+            return problems
+        logging.info(f"{len(problems)}件のセレクタの修正をまとめて依頼します。")
+        corrections, _ = self.openai_client.generate_actions(model, instruction, chunks[0], cancel)
+
+        corrected_by_index = {}
+        for correction in corrections:
+            index = parse_dom_id(correction.get("index"))
+            if index is not None:
+                corrected_by_index[index] = correction
+        remaining = []
+        for problem in problems:
+            correction = corrected_by_index.get(problem["index"])
+            action = actions[problem["index"] - 1]
+            if correction and correction.get("selector"):
+                candidate = dict(action, selector=correction["selector"], dom_id=correction.get("dom_id"))
+                if validator.validate_action(problem["index"], candidate) is None:
+                    logging.info(f"アクション {problem['index']} のセレクタを修正しました: {action.get('selector')} -> {candidate['selector']}")
+                    action["selector"] = candidate["selector"]
+                    action["dom_id"] = candidate.get("dom_id")
+                    continue
+            remaining.append(problem)
+        return remaining
+
+    @staticmethod
+    def correction_candidates(task: str, actions: List[dict], problems: List[dict], candidates: list) -> list:
+        # 失敗したアクションごとに、dom_id の前後の要素と、指示・セレクタ・値に関連する要素 (BM25) を交互に選ぶ
+        dom_ids = [element['dom_id'] for element in candidates]
+        index = DOMRelevanceIndex(candidates)
+        rankings = []
+        for problem in problems:
+            action = actions[problem["index"] - 1]
+            ranked = []
+            dom_id = parse_dom_id(action.get("dom_id"))
+            if dom_id is not None:
+                center = bisect.bisect_left(dom_ids, dom_id)
+                ranked.extend(range(max(0, center - CORRECTION_NEIGHBORS), min(len(candidates), center + CORRECTION_NEIGHBORS + 1)))
+            query = f"{task} {action.get('selector') or ''} {action.get('value') or ''}"
+            scores = index.score(query)
+            ranked.extend(sorted(scores, key=scores.get, reverse=True))
+            rankings.append(ranked)
+        selected = {}
+        for depth in range(max((len(ranked) for ranked in rankings), default=0)):
+            for ranked in rankings:
+                if depth < len(ranked):
+                    selected.setdefault(ranked[depth], None)
+            if len(selected) >= CORRECTION_CANDIDATES:
+                break
+        return [candidates[position] for position in sorted(list(selected)[:CORRECTION_CANDIDATES])]
+
+    def validate_stream(self, actions: Iterable[dict], validator: SelectorValidator,
+                        live_dom: bool = True) -> Iterator[dict]:
+        navigated = False
+        for index, action in enumerate(actions, start=1):
+            if action.get("action") == "NAVIGATE":
+                navigated = True
+            if not navigated and not live_dom:
+                self.report_selector(index, action, validator)
+            elif not navigated:
+                problem = validator.validate_action(index, action)
+                if problem and problem["status"] == "missing":
+                    action["selector_status"] = "missing"
+            yield action
+
+    @staticmethod
+    def report_selector(index: int, action: dict, validator: SelectorValidator):
+        if action.get("action") not in VALIDATED_ACTIONS:
+            return
+        selector = action.get("selector") or ""
+        status = validator.check(selector)
+        if status in ("missing", "ambiguous"):
+            logging.warning(f"アクション {index} のセレクタが取得したHTMLに一意に一致しません ({status})。"
+                            f"ページ上で描画される要素の可能性があるため、そのまま実行します: {selector}")
+
+    def fetch_html(self, url: str) -> Optional[str]:
+        return self.page_fetcher.fetch_html(url)
@@ -0,0 +1,90 @@
+# runner/plan_merger.py
+
+import logging
+from typing import List, Optional, Tuple
+
+from parsers.selector_validator import SelectorValidator, parse_dom_id
+
+# 対象の要素を持つ操作
+TARGETED_ACTIONS = ("CLICK", "TYPE")
+
+class ChunkGrounding:
+    # チャンクに含まれる要素だけで、アクションの対象がそのチャンク内にあるかを判定する
+    def __init__(self, chunk: list):
+        self.validator = SelectorValidator(chunk, complete=False)
+        self.dom_ids = {element['dom_id'] for element in chunk}
+
+    def is_grounded(self, action: dict) -> Optional[bool]:
+        # True: チャンク内に対象がある / False: ない / None: 判定できない
+        if action.get("action") not in TARGETED_ACTIONS:
+            return None
+        if parse_dom_id(action.get("dom_id")) in self.dom_ids:
+            return True
+        matches = self.validator.resolve(action.get("selector") or "")
+        if matches is None:
+            return None
+        return bool(matches)
+
+def is_plan_complete(actions: List[dict], chunk: list) -> bool:
+    # 対象を持つ操作が1つ以上あり、その対象がすべてそのチャンク内で見つかる計画は、他のチャンクを待たずに実行できるとみなす。
+    # NAVIGATE や SCREENSHOT だけの計画は、対象を含まないチャンクからも返るため完結とはみなさない
+    targeted = [action for action in actions if action.get("action") in TARGETED_ACTIONS]
+    if not targeted:
+        return False
+    grounding = ChunkGrounding(chunk)
+    return all(grounding.is_grounded(action) for action in targeted)
+
+def _action_key(action: dict) -> tuple:
+    selector = " ".join((action.get("selector") or "").split())
+    if action.get("action") in TARGETED_ACTIONS:
+        return action.get("action"), selector, action.get("value")
+    return action.get("action"), action.get("value")
+
+def merge_plans(results: List[Optional[Tuple[List[dict], str]]], chunks: List[list]) -> List[dict]:
+    entries = []
+    for i, result in enumerate(results):
+        if result is None:
+            continue
+        actions = result[0]
+        if not actions:
+            logging.warning(f"チャンク {i + 1} でアクションの生成に失敗しました。")
+            continue
+        grounding = ChunkGrounding(chunks[i])
+        for position, action in enumerate(actions):
+            entries.append((i, action, grounding.is_grounded(action), position))
+
+    # 自チャンクに対象のない推測のアクションは、同じ手順を別のチャンクが対象を見つけて返している場合だけ除く。
+    # 同じ手順とは、計画内の位置が同じ同種の操作、または同じ dom_id を対象とする同種の操作のこと
+    grounded_positions = set()
+    grounded_targets = set()
+    for _, action, grounded, position in entries:
+        if grounded:
+            grounded_positions.add((action.get("action"), position))
+            dom_id = parse_dom_id(action.get("dom_id"))
+            if dom_id is not None:
+                grounded_targets.add((action.get("action"), dom_id))
+
+    def superseded(action: dict, position: int) -> bool:
+        if (action.get("action"), position) in grounded_positions:
+            return True
+        dom_id = parse_dom_id(action.get("dom_id"))
+        return dom_id is not None and (action.get("action"), dom_id) in grounded_targets
+
+    entries = [entry for entry in entries if entry[2] is not False or not superseded(entry[1], entry[3])]
+
+    # 別のチャンクと重複するアクションは1つにまとめる。スクリーンショットは最後のもの、それ以外は最初のものを残す
+    first_chunk = {}
+    last_chunk = {}
+    for i, action, _, _ in entries:
+        key = _action_key(action)
+        first_chunk.setdefault(key, i)
+        last_chunk[key] = i
+    kept = []
+    for i, action, _, position in entries:
+        key = _action_key(action)
+        keep_chunk = last_chunk[key] if action.get("action") == "SCREENSHOT" else first_chunk[key]
+        if i == keep_chunk:
+            kept.append((position, i, action))
+    # 各チャンクの計画はいずれも全体の手順なので、計画内の順番をチャンクの順序より優先して並べる
+    kept.sort(key=lambda entry: (entry[0], entry[1]))
+    return [action for _, _, action in kept]
@@ -0,0 +1,65 @@
+# tests/test_dom_parser.py
+
+import pytest
+
+from parsers.dom_parser import TEXT_LIMIT, DOMParser
+
+pytest.importorskip("bs4")
+
+# engine='stream' は旧実装 (engine='soup') と同じ結果を返すこと
+CASES = {
+    "void_elements": (
+        '<div>前<br>後<img src="a.png" alt="画像">続き<input type="text" name="q"></div>'
+        '<p>改行<br/>のあと</p><hr><span>終わり</span>'
+    ),
+    "stray_void_end_tags": '<div>あ<br></br>い<input name="x"></input>う</div>',
+    "script_style_template": (
+        '<div>本文<script>var s = "<b>ではない</b>";</script>'
+        '<style>.a { color: red; }</style><template><button>中</button></template>後</div>'
+    ),
+    "nested_string_containers": '<template><div>外<template>内</template></div></template><p>外の文</p>',
+    "cdata": '<div>前<![CDATA[x < y && z]]>後</div><svg><![CDATA[図形]]></svg>',
+    "comments_and_declarations": '<!DOCTYPE html><div>前<!-- 注釈 -->後<?xml version="1.0"?></div>',
+    "misnested_tags": '<div><b>太字<i>斜体</b>残り</i></div><p>段落<div>ブロック</p>閉じ忘れ',
+    "unmatched_end_tags": '</span><div>本文</section></div></div><p>後</p>',
+    "unclosed_at_eof": '<ul><li>一<li>二<li>三',
+    "multi_valued_attributes": (
+        '<a class=" x  y " rel="nofollow noopener" href="/">リンク</a>'
+        '<td headers="h1 h2">セル</td><div accesskey="a b" data-x="1 2">属性</div><input disabled>'
+    ),
+    "whitespace_only_text": '<div>\n  <span>  </span>\n\t<b> 前後の空白 </b>\n</div>',
+    "character_references": '<p>&lt;tag&gt; &amp; &quot;引用&quot; &#12354;&#x3044;</p>',
+    "text_truncation": (
+        '<div>' + 'あ' * 60 + '<span>' + 'い' * 60 + '</span>' + 'う' * 10 + '</div>'
+        '<p>' + 'x' * (TEXT_LIMIT * 3) + '</p>'
+    ),
+    "truncation_in_deep_nesting": '<section><div>' + '語' * 30 + '</div>' + ''.join(
+        f'<div><span>{i}' + 'か' * 25 + '</span></div>' for i in range(10)
+    ) + '</section>',
+}
+
+
+def stream_elements(html: str, prune: bool = False) -> list:
+    return [element.to_dict() for element in DOMParser.parse(html, engine='stream', prune=prune)]
+
+
+@pytest.mark.parametrize("html", list(CASES.values()), ids=list(CASES))
+def test_stream_matches_soup(html):
+    assert stream_elements(html) == DOMParser.parse(html, engine='soup')
+
+
+def test_text_is_truncated_to_limit():
+    html = CASES["text_truncation"]
+    for element in stream_elements(html):
+        assert len(element['text']) <= TEXT_LIMIT
+
+
+def test_prune_is_stream_only():
+    with pytest.raises(ValueError):
+        DOMParser.parse('<div></div>', engine='soup', prune=True)
+
+
+def test_prune_keeps_anchor_without_href_with_role():
+    html = '<nav><a role="button" tabindex="0">メニュー</a><a>ただの文字</a><a href="/top">トップ</a></nav>'
+    kept = [(element['tag'], element['text']) for element in stream_elements(html, prune=True)]
+    assert kept == [('a', 'メニュー'), ('a', 'トップ')]
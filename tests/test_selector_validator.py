@@ -0,0 +1,133 @@
+# tests/test_selector_validator.py
+
+import pytest
+
+from parsers.dom_parser import DOMParser
+from parsers.selector_validator import SelectorValidator, parse_selector
+
+HTML = """
+<html><body>
+<div id="main" class="content wide">
+  <form id="login" action="/login">
+    <label for="user">ユーザー名</label><input id="user" name="user" type="text">
+    <input name="password" type="password" placeholder="パスワード">
+    <button type="submit" class="btn primary" data-testid="login-button">ログイン</button>
+  </form>
+  <ul class="menu">
+    <li><a href="/home" rel="nofollow noopener">ホーム</a></li>
+    <li><a href="/news" lang="ja-JP">お知らせ</a></li>
+    <li><a href="/help" title="ヘルプ &quot;FAQ&quot;">ヘルプ</a></li>
+  </ul>
+  <table><tr><td><button class="btn">行1</button></td></tr><tr><td><button class="btn">行2</button></td></tr></table>
+</div>
+<div class="content"><span><button class="btn">外側</button></span></div>
+</body></html>
+"""
+
+
+@pytest.fixture(scope="module")
+def elements():
+    return DOMParser.parse(HTML)
+
+
+@pytest.fixture(scope="module")
+def validator(elements):
+    return SelectorValidator(elements)
+
+
+@pytest.mark.parametrize("selector", [
+    "#main",
+    "button.btn.primary",
+    "form#login > button",
+    "div ul > li a",
+    "*[data-testid]",
+    'a[href="/news"]',
+    "a[href='/home']",
+    "input[name=user]",
+    'a[title="ヘルプ \\"FAQ\\""]',
+    "li:nth-of-type(2) > a",
+    "div  >  form",
+])
+def test_parse_selector_supported(selector):
+    assert parse_selector(selector) is not None
+
+
+@pytest.mark.parametrize("selector", [
+    "div >> button",
+    "div>>button",
+    "button:has-text('ログイン')",
+    "text=ログイン",
+    "xpath=//button",
+    "a, button",
+    "label + input",
+    "label ~ input",
+    "button:visible",
+    "div >",
+    "> div",
+    "a[href",
+    "",
+])
+def test_parse_selector_unsupported(selector):
+    assert parse_selector(selector) is None
+
+
+@pytest.mark.parametrize("selector, status", [
+    ("#user", "ok"),
+    ("button[data-testid='login-button']", "ok"),
+    ("form > button", "ok"),
+    ("a[rel~=noopener]", "ok"),
+    ("a[href^='/he']", "ok"),
+    ("a[href$=ews]", "ok"),
+    ("a[href*=om]", "ok"),
+    ("a[lang|=ja]", "ok"),
+    ("li:nth-of-type(3) a", "ok"),
+    ("#main button.btn", "ambiguous"),
+    ("button.btn", "ambiguous"),
+    ("#missing", "missing"),
+    ("ul > a", "missing"),
+    ("span > li", "missing"),
+    ("a[href^='']", "missing"),
+    ("div >> button", "unsupported"),
+    ("text=ログイン", "unsupported"),
+])
+def test_check(validator, selector, status):
+    assert validator.check(selector) == status
+
+
+def test_resolve_matches_soupsieve(elements, validator):
+    bs4 = pytest.importorskip("bs4")
+    soup = bs4.BeautifulSoup(HTML, "html.parser")
+    positions = {id(element): i for i, element in enumerate(soup.find_all(True))}
+    for selector in ["div button", "div > button", "td button", "form#login input", ".content span > .btn",
+                     "li:nth-of-type(1) a", "[type]", "*", "a[rel~=nofollow]", "#main > table tr:nth-of-type(2) button"]:
+        expected = sorted(positions[id(element)] for element in soup.select(selector))
+        assert validator.resolve(selector) == expected, selector
+
+
+def test_incomplete_dom_skips_structural_checks():
+    pruned = DOMParser.parse(HTML, prune=True)
+    validator = SelectorValidator(pruned, complete=False)
+    # 兄弟順は除かれた要素で変わるため検証しない
+    assert validator.check("li:nth-of-type(2) > a") == "unsupported"
+    # どこにも一致しない祖先はプルーニングで除かれた可能性があるため判定しない
+    assert validator.check("#main form > button") == "unsupported"
+    assert validator.check("button[type=submit]") == "ok"
+    assert validator.check("#nothing-like-this") == "missing"
+    for element in pruned:
+        selector = validator.unique_selector(element["dom_id"])
+        if selector is not None:
+            assert ":nth-of-type" not in selector
+
+
+def test_unique_selector_round_trip(elements, validator):
+    for position, element in enumerate(elements):
+        selector = validator.unique_selector(element["dom_id"])
+        if element["tag"] in ("html", "body", "table"):
+            continue
+        assert selector is not None, element
+        assert validator.resolve(selector) == [position], selector
+
+
+def test_unique_selector_unknown_dom_id(validator):
+    assert validator.unique_selector(None) is None
+    assert validator.unique_selector(10_000) is None
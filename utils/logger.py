@@ -1,11 +1,93 @@
 # utils/logger.py
 
+import atexit
 import logging
+import logging.handlers
+import queue
+import random
+import threading
+from typing import Any
 
-def setup_logging():
-    logging.basicConfig(
-        filename='web_agent.log',
-        level=logging.DEBUG,  # デバッグレベルに設定
-        format='%(asctime)s:%(levelname)s:%(message)s'
-    )
-    logging.info("WebAgentAIアプリケーションが起動しました。")
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(message)s'
+
+# 完全なプロンプトと応答を書き出すロガー。通常のログには流さない
+PAYLOAD_LOGGER_NAME = "web_agent.payload"
+# 通常のログに載せる応答の先頭部分の最大文字数
+PREVIEW_LIMIT = 200
+
+_listener = None
+_queue_handler = None
+_setup_lock = threading.Lock()
+_payload_sample_rate = 0.0
+
+class _ExcludePayload(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.name != PAYLOAD_LOGGER_NAME
+
+def setup_logging(config=None):
+    # ファイルへの書き込みは QueueListener のスレッドで行い、呼び出し元では待たない。
+    # main と GUI の両方から呼ばれるため、2回目以降は何もしない
+    global _listener, _queue_handler, _payload_sample_rate
+    with _setup_lock:
+        if _listener is not None:
+            return
+        level = getattr(config, "LOG_LEVEL", "INFO")
+        handler = logging.handlers.RotatingFileHandler(
+            getattr(config, "LOG_FILE", "web_agent.log"),
+            maxBytes=getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024),
+            backupCount=getattr(config, "LOG_BACKUP_COUNT", 5),
+            encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(_ExcludePayload())
+        handlers = [handler]
+
+        payload_path = getattr(config, "PAYLOAD_LOG_FILE", "")
+        payload_logger = logging.getLogger(PAYLOAD_LOGGER_NAME)
+        if payload_path:
+            payload_handler = logging.handlers.RotatingFileHandler(
+                payload_path,
+                maxBytes=getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024),
+                backupCount=getattr(config, "LOG_BACKUP_COUNT", 5),
+                encoding="utf-8"
+            )
+            payload_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            payload_handler.addFilter(logging.Filter(PAYLOAD_LOGGER_NAME))
+            handlers.append(payload_handler)
+            payload_logger.setLevel(logging.DEBUG)
+            _payload_sample_rate = getattr(config, "PAYLOAD_LOG_SAMPLE_RATE", 1.0)
+
+        log_queue = queue.Queue(-1)
+        root = logging.getLogger()
+        root.setLevel(level)
+        _queue_handler = logging.handlers.QueueHandler(log_queue)
+        root.addHandler(_queue_handler)
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+    logging.info("WebAgentAIアプリケーションが起動しました。(ログレベル: %s)", level)
+
+def shutdown_logging():
+    # キューに残っているログを書き出してから終了する
+    global _listener, _queue_handler
+    with _setup_lock:
+        listener, _listener = _listener, None
+        if _queue_handler is not None:
+            logging.getLogger().removeHandler(_queue_handler)
+            _queue_handler = None
+    if listener is not None:
+        listener.stop()
+
+def preview(text: Any, limit: int = PREVIEW_LIMIT) -> str:
+    # 通常のログ用に先頭だけを切り出す。全文は log_payload で書き出す
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(全{len(text)}文字)"
+
+def log_payload(provider: str, prompt: Any, response: Any):
+    # プロンプトと応答の全文は、別のファイルが設定されている場合にリクエスト単位でサンプリングして書き出す。
+    # 文字列への変換はサンプリングされた場合だけ行う
+    if _payload_sample_rate <= 0 or random.random() >= _payload_sample_rate:
+        return
+    logging.getLogger(PAYLOAD_LOGGER_NAME).debug("%s プロンプト:\n%s\n%s 応答:\n%s", provider, prompt, provider, response)
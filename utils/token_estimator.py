@@ -0,0 +1,16 @@
+# utils/token_estimator.py
+
+# トークナイザを使わずにトークン数を見積もる。
+# ASCII はおおよそ4文字で1トークン、日本語などの非ASCII文字はおおよそ1文字1トークンとして数える
+ASCII_CHARS_PER_TOKEN = 4
+NON_ASCII_TOKENS_PER_CHAR = 1.0
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    char_count = len(text)
+    # UTF-8 で2バイト以上になる文字数を、バイト長との差から求める (CJK は3バイト)
+    extra_bytes = len(text.encode("utf-8")) - char_count
+    non_ascii = min(char_count, (extra_bytes + 1) // 2)
+    ascii_count = char_count - non_ascii
+    return int(ascii_count / ASCII_CHARS_PER_TOKEN + non_ascii * NON_ASCII_TOKENS_PER_CHAR) + 1
@@ -0,0 +1,138 @@
+# utils/tracing.py
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator, Optional
+
+# 実行中のトレース。スレッドをまたぐ場合は bind で呼び出し元のものを引き継ぐ
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# 数値でも処理ごとの合計に含めない属性
+NON_ADDITIVE_ATTRIBUTES = ("index", "status", "first_action_seconds", "hedge_delay_seconds")
+
+class RunTrace:
+    # 1回の実行で、処理ごとの所要時間と件数などの属性を記録する
+    def __init__(self, name: str, **attributes):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attributes = attributes
+        self.started_at = datetime.now()
+        self.total_seconds = None
+        self.spans = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, started: float, seconds: float, attributes: dict):
+        entry = {
+            "name": name,
+            "start_seconds": round(started - self._started, 4),
+            "seconds": round(seconds, 4),
+            "thread": threading.current_thread().name,
+            "attributes": attributes,
+        }
+        with self._lock:
+            self.spans.append(entry)
+
+    def finish(self):
+        self.total_seconds = round(time.perf_counter() - self._started, 4)
+
+    def phases(self) -> dict:
+        # 処理名ごとに回数・合計・最大と、数値の属性の合計をまとめる
+        phases = {}
+        with self._lock:
+            spans = list(self.spans)
+        for entry in spans:
+            phase = phases.setdefault(entry["name"], {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "totals": {}})
+            phase["count"] += 1
+            phase["total_seconds"] = round(phase["total_seconds"] + entry["seconds"], 4)
+            phase["max_seconds"] = max(phase["max_seconds"], entry["seconds"])
+            for key, value in entry["attributes"].items():
+                if key in NON_ADDITIVE_ATTRIBUTES:
+                    continue
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    phase["totals"][key] = round(phase["totals"].get(key, 0) + value, 4)
+        return phases
+
+    def report(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda entry: entry["start_seconds"])
+        return {
+            "run_id": self.run_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "total_seconds": self.total_seconds,
+            "attributes": self.attributes,
+            "phases": self.phases(),
+            "spans": spans,
+        }
+
+    def summary(self) -> str:
+        phases = sorted(self.phases().items(), key=lambda item: item[1]["total_seconds"], reverse=True)
+        lines = [f"処理時間の内訳 (全体 {self.total_seconds or 0:.2f}秒)"]
+        for name, phase in phases:
+            totals = " ".join(f"{key}={value}" for key, value in phase["totals"].items())
+            lines.append(
+                f"  {name}: {phase['count']}回 / 合計 {phase['total_seconds']:.2f}秒 / 最大 {phase['max_seconds']:.2f}秒"
+                + (f" ({totals})" if totals else "")
+            )
+        return "\n".join(lines)
+
+def current_trace() -> Optional[RunTrace]:
+    return _current_trace.get()
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[dict]:
+    # 処理の中で件数などを追加できるよう、属性の辞書を返す。トレース中でなければ記録しない
+    trace = _current_trace.get()
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        if trace is not None:
+            trace.record(name, started, time.perf_counter() - started, attributes)
+
+def record_span(name: str, seconds: float, **attributes):
+    # 別に計測した所要時間を記録する
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(name, time.perf_counter() - seconds, seconds, attributes)
+
+def bind(fn: Callable) -> Callable:
+    # 別スレッドで実行する関数に、呼び出し時点のトレースを引き継ぐ。呼び出しごとに bind すること
+    return functools.partial(contextvars.copy_context().run, fn)
+
+@contextmanager
+def trace_run(name: str, report_dir: Optional[str] = None, **attributes) -> Iterator[RunTrace]:
+    trace = RunTrace(name, **attributes)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finish()
+        logging.info(f"[{trace.run_id}] {trace.summary()}")
+        if report_dir:
+            write_report(trace, report_dir)
+
+def write_report(trace: RunTrace, report_dir: str) -> Optional[str]:
+    path = os.path.join(report_dir, f"{trace.started_at:%Y%m%d-%H%M%S}_{trace.name}_{trace.run_id}.json")
+    try:
+        os.makedirs(report_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace.report(), f, ensure_ascii=False, indent=2, default=str)
+    except OSError as e:
+        logging.warning(f"実行レポートの保存に失敗しました: {e}")
+        return None
+    logging.info(f"実行レポートを保存しました: {path}")
+    return path